@@ -0,0 +1,82 @@
+"""Benchmark of the GLCM features of the neural network input.
+
+Compute the GLCM features at bin widths 5, 25 and 50 with pyradiomics,
+and with covidlib.extract.RoiCache, where the bin-25 and bin-50 matrices
+are block sums of the bin-5 one, then compare latency and features.
+The features agree if their relative difference is at most --tolerance;
+the exit status is 1 otherwise.
+
+Usage:
+    python benchmarks/bench_glcm.py patient_dir [...] [--ivd 1.4] [--mask mask_R231CW_ISO_1.40_bilat]
+
+Each patient directory must contain the CT_ISO_{ivd}.nii file and the
+ISO mask written by the pipeline.
+"""
+
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+from radiomics.glcm import RadiomicsGLCM
+
+from covidlib.extract import RoiCache
+from covidlib.imagestore import ImageStore
+
+BIN_WIDTHS = (5, 25, 50)
+
+
+def settings(bin_width):
+    """Settings of the GLCM of the neural network input, as in FeaturesExtractor.run."""
+    return {
+        'label': 1,
+        'resegmentRange': [-1020, 180],
+        'binWidth': bin_width,
+        'binCount': int(1200/bin_width)
+    }
+
+
+def main():
+    """Run the benchmark and print a summary."""
+    parser = argparse.ArgumentParser("bench_glcm")
+    parser.add_argument('patients', nargs='+', help='Patient directories')
+    parser.add_argument('--ivd', type=float, default=1.4, help='Isotropic voxel dimension')
+    parser.add_argument('--mask', help='Mask filename, without .nii (default: mask_R231CW_ISO_{ivd}_bilat)')
+    parser.add_argument('--tolerance', type=float, default=1e-9, help='Maximum relative difference')
+    args = parser.parse_args()
+    maskname = args.mask or f'mask_R231CW_ISO_{args.ivd:.2f}_bilat'
+
+    store = ImageStore()
+    t_ref, t_out, worst = 0., 0., 0.
+    for patient in args.patients:
+        image = store.read_ct(os.path.join(patient, f'CT_ISO_{args.ivd:.2f}.nii'))
+        mask = store.read_labels(os.path.join(patient, maskname + '.nii'))
+
+        start = time.perf_counter()
+        ref = [RadiomicsGLCM(image, mask, **settings(bw)).execute() for bw in BIN_WIDTHS]
+        t_ref += time.perf_counter() - start
+
+        start = time.perf_counter()
+        roi = RoiCache(image, mask)
+        out = [roi.features(RadiomicsGLCM, settings(bw)).execute() for bw in BIN_WIDTHS]
+        t_out += time.perf_counter() - start
+
+        derived = sum(roi.nested.values())
+        diff = max(abs(float(b[name]) - float(a[name])) / max(abs(float(a[name])), 1e-12)
+            for a, b in zip(ref, out) for name in a if not np.isnan(float(a[name])))
+        worst = max(worst, diff)
+        print(f"{patient}: {derived}/{len(BIN_WIDTHS) - 1} matrices derived, "
+              f"max relative difference {diff:.3g}")
+
+    print(f"pyradiomics: {t_ref:8.2f} s")
+    print(f"RoiCache   : {t_out:8.2f} s   speedup {t_ref / t_out:.2f}x")
+
+    if worst > args.tolerance:
+        print(f"FAILED: relative difference {worst:.3g} above tolerance {args.tolerance}")
+        sys.exit(1)
+    print(f"OK: relative difference <= {args.tolerance}")
+
+
+if __name__ == '__main__':
+    main()
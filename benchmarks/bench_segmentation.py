@@ -0,0 +1,74 @@
+"""Benchmark of the lung segmentation backends of covidlib.masks.
+
+Segment some CT volumes with lungmask (PyTorch, one patient at a time)
+and with the ONNX Runtime backend, then compare latency and masks.
+The masks agree if the Dice coefficient of each lung label is at least
+--tolerance; the exit status is 1 otherwise.
+
+Usage:
+    python benchmarks/bench_segmentation.py path/to/CT_3mm.nii [...] [--threads 4] [--batch 20]
+
+The ONNX model is exported on the first run and cached in ~/.cache/clearlung.
+"""
+
+import argparse
+import sys
+import time
+
+import numpy as np
+from lungmask import LMInferer
+
+from covidlib.ctlibrary import read_ct
+from covidlib.segment import BatchSegmenter, onnx_predictor
+
+from common import dice
+
+
+def main():
+    """Run the benchmark and print a summary."""
+    parser = argparse.ArgumentParser("bench_segmentation")
+    parser.add_argument('images', nargs='+', help='Paths to CT_{st}mm.nii files')
+    parser.add_argument('--threads', type=int, help='ONNX Runtime intra-op threads')
+    parser.add_argument('--batch', type=int, default=20, help='Slices per ONNX Runtime call')
+    parser.add_argument('--tolerance', type=float, default=0.99, help='Minimum Dice per lung label')
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    inferer = LMInferer(modelname="R231CovidWeb", tqdm_disable=True)
+    t_setup_torch = time.perf_counter() - start
+    start = time.perf_counter()
+    segmenter = BatchSegmenter(onnx_predictor("R231CovidWeb", threads=args.threads),
+        batch_size=args.batch)
+    t_setup_onnx = time.perf_counter() - start
+    print(f"setup  torch: {t_setup_torch:7.2f} s   onnx: {t_setup_onnx:7.2f} s")
+
+    images = {path: read_ct(path) for path in args.images}
+
+    start = time.perf_counter()
+    ref = {path: inferer.apply(image) for path, image in images.items()}
+    t_torch = time.perf_counter() - start
+
+    start = time.perf_counter()
+    out = {path: segm for path, _, segm in segmenter.run(images, images.get)}
+    t_onnx = time.perf_counter() - start
+
+    n_slices = sum(image.GetDepth() for image in images.values())
+    print(f"torch: {t_torch:8.2f} s  ({1e3 * t_torch / n_slices:.1f} ms/slice)")
+    print(f"onnx : {t_onnx:8.2f} s  ({1e3 * t_onnx / n_slices:.1f} ms/slice)")
+    print(f"speedup: {t_torch / t_onnx:.2f}x")
+
+    worst = 1.
+    for path in images:
+        scores = [dice(ref[path], out[path], label) for label in (1, 2)]
+        worst = min(worst, *scores)
+        print(f"{path}: Dice right {scores[0]:.5f}, left {scores[1]:.5f}, "
+              f"identical voxels {np.mean(ref[path] == out[path]):.6f}")
+
+    if worst < args.tolerance:
+        print(f"FAILED: Dice {worst:.5f} below tolerance {args.tolerance}")
+        sys.exit(1)
+    print(f"OK: Dice >= {args.tolerance}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,16 @@
+"""Helpers shared by the benchmark scripts.
+
+The scripts are run as python benchmarks/<script>.py, so this directory
+is on the import path and they import it as a top-level module.
+"""
+
+import numpy as np
+
+
+def dice(mask_a, mask_b, label):
+    """Dice coefficient of one label between two label maps."""
+    in_a, in_b = mask_a == label, mask_b == label
+    total = np.count_nonzero(in_a) + np.count_nonzero(in_b)
+    if total == 0:
+        return 1.
+    return 2. * np.count_nonzero(in_a & in_b) / total
@@ -0,0 +1,101 @@
+"""Validation of the int8 quantized lung segmentation (--fast-segmentation).
+
+Segment a reference set of patients with the full-precision network and
+with the int8 network, then report:
+- wall time of both
+- Dice of the right and left lung labels
+- the change in QCT lung volume and WAVE for the bilateral, right and left ROIs
+
+Usage:
+    python benchmarks/validate_fast_segmentation.py patient_dir [...] [--st 3] [--reference torch]
+
+Each patient directory must contain the CT_{st}mm.nii file written by the pipeline.
+"""
+
+import argparse
+import os
+import time
+
+import numpy as np
+import SimpleITK as sitk
+
+from covidlib.ctlibrary import read_ct
+from covidlib.qct import fit_healthy_peak
+from covidlib.segment import BatchSegmenter, onnx_predictor, torch_predictor
+
+from common import dice
+
+# ROI name: labels of the lungmask label map
+ROIS = {'bilat': (1, 2), 'right': (1,), 'left': (2,)}
+
+
+def roi_metrics(image, segm, labels, slice_thk):
+    """QCT volume (mL) and WAVE of a ROI, as computed by QCT.run."""
+    selected = np.isin(segm, labels)
+    spacing = image.GetSpacing()
+    volume = spacing[0] * spacing[1] * slice_thk * np.count_nonzero(selected) / 1000
+
+    grey_pixels = sitk.GetArrayViewFromImage(image)[selected]
+    grey_pixels = grey_pixels[(grey_pixels >= -1020) & (grey_pixels <= 180)]
+    counts, bins = np.histogram(grey_pixels, bins=240, range=(-1020, 180), density=True)
+    _, _, wave = fit_healthy_peak(counts, bins[:-1] + 2.5)
+    return volume, (np.nan if isinstance(wave, str) else wave)
+
+
+def segment_all(segmenter, images):
+    """Masks of all the images, and the wall time."""
+    start = time.perf_counter()
+    masks = {key: segm for key, _, segm in segmenter.run(images, images.get)}
+    return masks, time.perf_counter() - start
+
+
+def main():
+    """Run the validation and print a report."""
+    parser = argparse.ArgumentParser("validate_fast_segmentation")
+    parser.add_argument('patients', nargs='+', help='Patient directories')
+    parser.add_argument('--st', type=float, default=3, help='Slice thickness of the CT_{st}mm.nii files')
+    parser.add_argument('--reference', choices=['torch', 'onnx'], default='torch',
+        help='Full-precision network to compare with')
+    parser.add_argument('--threads', type=int, help='ONNX Runtime intra-op threads')
+    parser.add_argument('--batch', type=int, default=20, help='Slices per network call')
+    args = parser.parse_args()
+
+    if args.reference == 'torch':
+        from lungmask import LMInferer
+        reference = torch_predictor(LMInferer(modelname="R231CovidWeb", tqdm_disable=True))
+    else:
+        reference = onnx_predictor("R231CovidWeb", threads=args.threads)
+    fast = onnx_predictor("R231CovidWeb", threads=args.threads, quantized=True)
+
+    images = {patient: read_ct(os.path.join(patient, f'CT_{args.st:.0f}mm.nii'))
+              for patient in args.patients}
+    ref_masks, t_ref = segment_all(BatchSegmenter(reference, batch_size=args.batch), images)
+    fast_masks, t_fast = segment_all(BatchSegmenter(fast, batch_size=args.batch), images)
+
+    print(f"{args.reference} float32: {t_ref:8.2f} s")
+    print(f"onnx int8    : {t_fast:8.2f} s   speedup {t_ref / t_fast:.2f}x\n")
+
+    print(f"{'patient':30s} {'dice R':>8s} {'dice L':>8s} {'ROI':>6s} "
+          f"{'vol [mL]':>9s} {'d vol':>8s} {'WAVE':>7s} {'d WAVE':>7s}")
+    deltas = {'dice': [], 'volume': [], 'wave': []}
+    for patient, image in images.items():
+        ref, out = ref_masks[patient], fast_masks[patient]
+        scores = [dice(ref, out, label) for label in (1, 2)]
+        deltas['dice'].extend(scores)
+        for roi, labels in ROIS.items():
+            vol_ref, wave_ref = roi_metrics(image, ref, labels, args.st)
+            vol_fast, wave_fast = roi_metrics(image, out, labels, args.st)
+            deltas['volume'].append(abs(vol_fast - vol_ref) / vol_ref if vol_ref else np.nan)
+            deltas['wave'].append(abs(wave_fast - wave_ref))
+            name = os.path.basename(os.path.normpath(patient)) if roi == 'bilat' else ''
+            dice_cols = f"{scores[0]:8.4f} {scores[1]:8.4f}" if roi == 'bilat' else ' ' * 17
+            print(f"{name:30s} {dice_cols} {roi:>6s} {vol_ref:9.1f} {vol_fast - vol_ref:+8.1f} "
+                  f"{wave_ref:7.3f} {wave_fast - wave_ref:+7.3f}")
+
+    print(f"\nmin Dice {np.min(deltas['dice']):.4f}, "
+          f"max relative volume change {100 * np.nanmax(deltas['volume']):.2f}%, "
+          f"max WAVE change {np.nanmax(deltas['wave']):.3f}")
+
+
+if __name__ == '__main__':
+    main()
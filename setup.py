@@ -56,7 +56,7 @@ setup(
         "Pillow>=9.2.0",
         "pydicom>=2.3.0",
         "pynetdicom>=2.0.2",
-        "pyradiomics>=3.0.1",
+        "pyradiomics>=3.0.1,<3.2",
         "scipy>=1.7.3",
         "setuptools>=59.4.0",
         "SimpleITK>=2.1.1.2",
@@ -78,6 +78,10 @@ setup(
         ],
         "tests": [
             "pytest",
+        ],
+        "onnx": [
+            "onnx>=1.12.0",
+            "onnxruntime>=1.13.1",
         ]
         },
     python_requires=">=3.8.0",
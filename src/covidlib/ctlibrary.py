@@ -1,43 +1,296 @@
 """Helper for i/o with DICOM files."""
 
 import glob
+import hashlib
+import json
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
 import pydicom
 import numpy as np
+import SimpleITK as sitk
+
+# Tags read from the series header. Every stage of the pipeline
+# takes its patient, series and acquisition metadata from this list.
+SERIES_TAGS = [
+    (0x0008, 0x0018),  # SOP Instance UID
+    (0x0008, 0x0022),  # Acquisition Date
+    (0x0008, 0x0050),  # Accession Number
+    (0x0008, 0x0060),  # Modality
+    (0x0008, 0x0070),  # Manufacturer
+    (0x0008, 0x1030),  # Study Description
+    (0x0008, 0x103e),  # Series Description
+    (0x0008, 0x1090),  # Manufacturer Model Name
+    (0x0010, 0x0010),  # Patient Name
+    (0x0010, 0x0020),  # Patient ID
+    (0x0010, 0x0030),  # Patient Birth Date
+    (0x0010, 0x0040),  # Patient Sex
+    (0x0010, 0x1010),  # Patient Age
+    (0x0018, 0x0015),  # Body Part Examined
+    (0x0018, 0x0050),  # Slice Thickness
+    (0x0018, 0x0060),  # KVP
+    (0x0018, 0x0088),  # Spacing Between Slices
+    (0x0018, 0x1100),  # Reconstruction Diameter
+    (0x0018, 0x1152),  # Exposure
+    (0x0018, 0x1210),  # Convolution Kernel
+    (0x0018, 0x9306),  # Single Collimation Width
+    (0x0018, 0x9307),  # Total Collimation Width
+    (0x0018, 0x9311),  # Spiral Pitch Factor
+    (0x0018, 0x9345),  # CTDIvol
+    (0x0020, 0x000d),  # Study Instance UID
+    (0x0020, 0x000e),  # Series Instance UID
+]
+
+# Tags read from every slice to build the per-slice exposure vectors.
+EXPOSURE_TAGS = {
+    'ctdi': (0x0018, 0x9345),          # CTDIvol
+    'exposure': (0x0018, 0x1152),      # Exposure [mAs]
+    'tube_current': (0x0018, 0x1151),  # X-Ray Tube Current [mA]
+}
+POSITION_TAG = (0x0020, 0x0032)        # Image Position (Patient)
+
+# On-disk voxel types of the pipeline intermediates:
+# HU values of CT volumes are int16, label maps are uint8
+CT_PIXEL_TYPE = sitk.sitkInt16
+LABEL_PIXEL_TYPE = sitk.sitkUInt8
+_PIXEL_DTYPES = {sitk.sitkInt16: np.int16, sitk.sitkUInt8: np.uint8}
+
+# Patient metadata file with the lung bounding box (see Rescaler.make_crop_box)
+CROP_FILE = 'crop.json'
+
+_series_cache = {}
+_exposure_cache = {}
+
+
+def _series_stamp(folder_name: str, files: list):
+    """Modification time of a series folder, with the path, size and
+    modification time of the files read from it, used to invalidate the caches.
+    Files overwritten in place keep the time of the folder, not their own.
+    :param folder_name: path of dicom folder
+    :param files: paths of the files the cached value is read from
+    """
+    try:
+        stamp = [os.stat(folder_name).st_mtime_ns]
+        for path in files:
+            stat = os.stat(path)
+            stamp.append((path, stat.st_size, stat.st_mtime_ns))
+    except OSError:
+        return None
+    return tuple(stamp)
+
+
+def series_files(folder_name: str) -> list:
+    """Sorted list of the files in a DICOM series folder.
+    :param folder_name: path of dicom folder
+    """
+    return sorted(path for path in glob.glob(f"{folder_name}/*") if os.path.isfile(path))
 
 
 def dcmtagreader(folder_name: str):
     """CT image dicom reader.
+    Only the header of one slice is read (no pixel data, only SERIES_TAGS)
+    and the result is cached per series folder, so repeated calls from
+    different stages are served from memory. The cache entry is dropped
+    when the folder content or the header file changes.
     :param folder_name: path of dicom folder
     """
-    files_with_dcm = glob.glob(f"{folder_name}/*")
-    for inputfile in files_with_dcm:
-        data = pydicom.dcmread(inputfile, force=True)
-    if not data:
-        raise UnboundLocalError
-    else:
-        return data
+    files_with_dcm = series_files(folder_name)
+    if not files_with_dcm:
+        raise UnboundLocalError(f"No DICOM files found in {folder_name}")
+
+    folder_key = os.path.abspath(folder_name)
+    stamp = _series_stamp(folder_key, files_with_dcm[-1:])
+    cached = _series_cache.get(folder_key)
+    if cached is not None and cached[0] == stamp:
+        return cached[1]
+
+    data = pydicom.dcmread(files_with_dcm[-1], force=True,
+                           stop_before_pixels=True, specific_tags=SERIES_TAGS)
+    _series_cache[folder_key] = (stamp, data)
+    return data
+
+
+def clear_series_cache():
+    """Drop all the cached series headers and exposure vectors."""
+    _series_cache.clear()
+    _exposure_cache.clear()
+
+
+def _exposure_row(inputfile: str) -> list:
+    """Read the exposure tags (and the slice position) of a single file.
+    :param inputfile: path of the dicom file
+    """
+    data = pydicom.dcmread(inputfile, force=True, stop_before_pixels=True,
+                           specific_tags=list(EXPOSURE_TAGS.values()) + [POSITION_TAG])
+    row = []
+    for tag in EXPOSURE_TAGS.values():
+        try:
+            row.append(float(data[tag].value))
+        except (KeyError, TypeError, ValueError):
+            row.append(np.nan)
+    try:
+        row.append(float(data[POSITION_TAG].value[2]))
+    except (KeyError, TypeError, ValueError, IndexError):
+        row.append(np.nan)
+    return row
+
+
+def dcmexposurereader(folder_name: str, workers=None) -> dict:
+    """Per-slice exposure vectors of a DICOM series.
+    Only the needed tags are parsed and the files are read
+    by a pool of threads. The result is cached per series folder.
+    :param folder_name: path of dicom folder
+    :param workers: number of reader threads (default: ThreadPoolExecutor default)
+    :return: dict with the 'position', 'ctdi', 'exposure' and 'tube_current'
+        arrays, sorted by slice position. Missing values are NaN.
+    """
+    files_with_dcm = series_files(folder_name)
+    if not files_with_dcm:
+        raise UnboundLocalError(f"No DICOM files found in {folder_name}")
+
+    folder_key = os.path.abspath(folder_name)
+    stamp = _series_stamp(folder_key, files_with_dcm)
+    cached = _exposure_cache.get(folder_key)
+    if cached is not None and cached[0] == stamp:
+        return cached[1]
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        rows = np.array(list(pool.map(_exposure_row, files_with_dcm)), dtype=float)
+
+    order = np.argsort(rows[:, -1], kind='stable')
+    rows = rows[order]
+    exposure = {'position': rows[:, -1]}
+    for i, name in enumerate(EXPOSURE_TAGS):
+        exposure[name] = rows[:, i]
+
+    _exposure_cache[folder_key] = (stamp, exposure)
+    return exposure
+
 
 def dcmtagreaderCTDI(folder_name: str):
     """CT image dicom reader.
+    Return the mean CTDIvol over the slices of the series
+    together with the series header.
     :param folder_name: path of dicom folder
     """
-    files_with_dcm = glob.glob(f"{folder_name}/*")
-    ctdi_vec = []
-    for inputfile in files_with_dcm:
-        data = pydicom.dcmread(inputfile, force=True)
-        try:
-            ctdi = float(data[0x0018, 0x9345].value)
-        except:
-            ctdi = 'NaN'       
-        ctdi_vec.append(ctdi)
-    if not data:
-        raise UnboundLocalError
-    else:
-        for i in range(len(ctdi_vec)):
-            if ctdi_vec[i]=='NaN':
-                ctdi_vec[i] = np.nan
-        ctdi_def = np.nanmean(ctdi_vec)        
-        return ctdi_def, data
+    ctdi_vec = dcmexposurereader(folder_name)['ctdi']
+    ctdi_def = np.nanmean(ctdi_vec) if not np.all(np.isnan(ctdi_vec)) else np.nan
+    return ctdi_def, dcmtagreader(folder_name)
+
+
+def _fingerprint_row(inputfile: str) -> str:
+    """SOPInstanceUID, size and modification time of a single file."""
+    data = pydicom.dcmread(inputfile, force=True, stop_before_pixels=True,
+                           specific_tags=[(0x0008, 0x0018)])
+    sop_uid = data[0x0008, 0x0018].value if (0x0008, 0x0018) in data else ''
+    stat = os.stat(inputfile)
+    return f"{sop_uid}\t{stat.st_size}\t{stat.st_mtime_ns}"
+
+
+def series_fingerprint(folder_name: str, workers=None) -> str:
+    """Fingerprint of the content of a DICOM series.
+    It is a hash of the SOPInstanceUIDs, sizes and modification times
+    of all the files, so it changes whenever the series changes.
+    :param folder_name: path of dicom folder
+    :param workers: number of reader threads (default: ThreadPoolExecutor default)
+    """
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        rows = sorted(pool.map(_fingerprint_row, series_files(folder_name)))
+    return hashlib.sha256('\n'.join(rows).encode('utf-8')).hexdigest()
+
+
+def cast_image(image, pixel_type):
+    """Cast an image to an integer pixel type.
+    Values are rounded to the nearest integer and clipped to the type range.
+    :param image: SimpleITK image
+    :param pixel_type: CT_PIXEL_TYPE or LABEL_PIXEL_TYPE
+    """
+    if image.GetPixelID() == pixel_type:
+        return image
+    dtype = _PIXEL_DTYPES[pixel_type]
+    array = sitk.GetArrayViewFromImage(image)
+    if np.issubdtype(array.dtype, np.floating):
+        array = np.rint(array)
+    limits = np.iinfo(dtype)
+    out = sitk.GetImageFromArray(np.clip(array, limits.min, limits.max).astype(dtype))
+    out.CopyInformation(image)
+    return out
+
+
+def write_ct(image, path: str):
+    """Write a CT volume as int16 HU."""
+    sitk.WriteImage(cast_image(image, CT_PIXEL_TYPE), path)
+
+
+def write_labels(image, path: str):
+    """Write a label map as uint8."""
+    sitk.WriteImage(cast_image(image, LABEL_PIXEL_TYPE), path)
+
+
+def _read_checked(path: str, pixel_type):
+    """Read an intermediate image and check its voxel type."""
+    image = sitk.ReadImage(path)
+    if image.GetPixelID() != pixel_type:
+        logging.warning("%s is %s instead of %s, it was probably written by an older version",
+            path, image.GetPixelIDTypeAsString(), sitk.GetPixelIDValueAsString(pixel_type))
+        image = cast_image(image, pixel_type)
+    return image
+
+
+def read_ct(path: str):
+    """Read a CT intermediate (int16 HU)."""
+    return _read_checked(path, CT_PIXEL_TYPE)
+
+
+def read_labels(path: str):
+    """Read a label map intermediate (uint8)."""
+    return _read_checked(path, LABEL_PIXEL_TYPE)
+
+
+def read_geometry(path: str):
+    """Read only the header of an image.
+    :return: (size, spacing, origin, direction)
+    """
+    reader = sitk.ImageFileReader()
+    reader.SetFileName(path)
+    reader.ReadImageInformation()
+    return reader.GetSize(), reader.GetSpacing(), reader.GetOrigin(), reader.GetDirection()
+
+
+def write_crop_box(patient_dir: str, index, size, grid: str, margin: float):
+    """Store the lung bounding box of a patient.
+    :param patient_dir: patient directory
+    :param index: first voxel of the box, (x, y, z)
+    :param size: number of voxels of the box, (x, y, z)
+    :param grid: name of the image the box refers to
+    :param margin: margin around the lungs in mm
+    """
+    with open(os.path.join(patient_dir, CROP_FILE), 'w', encoding='utf-8') as fcrop:
+        json.dump({'index': [int(i) for i in index], 'size': [int(n) for n in size],
+                   'grid': grid, 'margin': margin}, fcrop)
+
+
+def read_crop_box(patient_dir: str):
+    """Lung bounding box of a patient, as a dict with 'index' and 'size'
+    in (x, y, z) order, or None if it was not computed."""
+    try:
+        with open(os.path.join(patient_dir, CROP_FILE), 'r', encoding='utf-8') as fcrop:
+            return json.load(fcrop)
+    except FileNotFoundError:
+        return None
+
+
+def crop_image(image, box, inplane=False):
+    """Crop an image to a box (see read_crop_box). The origin is updated.
+    :param image: SimpleITK image
+    :param box: dict with 'index' and 'size' in (x, y, z) order
+    :param inplane: if True, crop only along x and y and keep all the slices
+    """
+    index, size = list(box['index']), list(box['size'])
+    if inplane:
+        index[2], size[2] = 0, image.GetDepth()
+    return sitk.RegionOfInterest(image, size, index)
+
 
 def change_keys(dic: dict, suffix: str) -> dict:
     """Add suffix to all dictionary keys"""
@@ -15,6 +15,17 @@ logger.setLevel(logging.CRITICAL)
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
 os.environ['TF_ENABLE_ONEDNN_OPTS'] = '0'
 
+
+def model_features(model_path):
+    """Name of a model and names of its radiomic features, from model_path/features.txt.
+    :param model_path: path to the model directory
+    :return: (model name, list of feature names)
+    """
+    with open(os.path.join(model_path, 'features.txt'), "r", encoding='utf-8') as a_file:
+        lines = a_file.read().splitlines()
+    return lines[0], lines[1:]
+
+
 class ModelEvaluator():
     """Class to evaluate pre-trained model"""
 
@@ -79,12 +90,7 @@ class ModelEvaluator():
         scaled = scaler.transform(data_pre_scaled)
         data_scaled = pd.DataFrame(scaler.transform(scaled), columns=data_pre_scaled.columns)
 
-        with open(os.path.join(self.model_path, 'features.txt'),
-            "r", encoding='utf-8') as a_file:
-            lines = a_file.read()
-            cols_to_keep = lines.splitlines()
-
-        model_name = cols_to_keep.pop(0)
+        model_name, cols_to_keep = model_features(self.model_path)
         data_scaled = data_scaled[cols_to_keep + ['PatientSex', 'PatientAge']]
         data_copy['AccessionNumber'] = acc_number
         data_copy = data_copy[cols_to_keep]
@@ -5,21 +5,231 @@ from email.mime import base
 import os
 import csv
 import logging
-from glob import glob
+import re
+from contextlib import ExitStack
 from tqdm import tqdm
-import SimpleITK as sitk
+import numpy as np
 import pandas as pd
+import SimpleITK as sitk
 import radiomics
-from covidlib.ctlibrary import dcmtagreaderCTDI, change_keys, change_keys_2
+from radiomics import imageoperations
+from radiomics.base import RadiomicsFeaturesBase
+from radiomics.glcm import RadiomicsGLCM
+from covidlib.ctlibrary import change_keys, change_keys_2
+from covidlib.imagestore import ImageStore
+from covidlib.seriesindex import series_ctdi
 
 logger = logging.getLogger("radiomics")
 logger.setLevel(logging.ERROR)
 
+
+def settings_key(settings: dict) -> tuple:
+    """Hashable key of pyradiomics settings. Numbers given as strings
+    (e.g. from the command line) give the same key as the numbers."""
+    def value_key(value):
+        if isinstance(value, (list, tuple)):
+            return tuple(value_key(item) for item in value)
+        try:
+            return float(value)
+        except (TypeError, ValueError):
+            return value
+    return tuple(sorted((name, value_key(value)) for name, value in settings.items()))
+
+
+# pyradiomics versions (major, minor) checked against the private methods
+# overridden by RoiCache.features: _initSegmentBasedCalculation, _applyBinning
+# and RadiomicsGLCM._calculateMatrix. Other versions run the stock classes.
+CACHED_PYRADIOMICS = ((3, 0), (3, 1))
+
+
+def cache_supported(version=None) -> bool:
+    """True if RoiCache can override the private methods of a pyradiomics
+    version (default: the installed one, e.g. '3.0.1' or 'v3.1.0')."""
+    match = re.match(r'v?(\d+)\.(\d+)', version or radiomics.__version__)
+    return match is not None and (int(match[1]), int(match[2])) in CACHED_PYRADIOMICS
+
+
+def binning_key(settings: dict) -> tuple:
+    """Key of the discretization of pyradiomics settings: binCount if given,
+    otherwise binWidth (see imageoperations.getBinEdges)."""
+    bin_count = settings.get('binCount')
+    if bin_count is not None:
+        return ('binCount', int(bin_count))
+    return ('binWidth', float(settings.get('binWidth', 25)))
+
+
+class RoiCache():
+    """Image and mask of a patient cropped once to the bounding box of the ROI,
+    with the discretized image of each binning. The feature classes built by
+    RoiCache.features read their arrays from here instead of converting and
+    discretizing the whole volume again.
+    Voxels outside the bounding box are outside the ROI, so cropping does not
+    change the features: the texture matrices only count ROI voxels and their
+    ROI neighbours, and the gray levels and run lengths not found in the ROI
+    are dropped by pyradiomics anyway.
+    A GLCM with a bin count dividing the one of a GLCM already computed is
+    derived from it by block sums (see RoiCache.coarse_glcm).
+    With the pyradiomics versions not in CACHED_PYRADIOMICS only the crop is
+    shared, and the stock feature classes do the rest."""
+
+    def __init__(self, image, mask, label=1, enabled=None):
+        """Constructor for the RoiCache class.
+
+        :param image: SimpleITK CT image
+        :param mask: SimpleITK mask, on the grid of the image
+        :param label: label of the ROI in the mask
+        :param enabled: if False, RoiCache.features returns the stock feature classes
+            on the cropped images (default: True if cache_supported())
+        """
+        self.label = label
+        self.enabled = cache_supported() if enabled is None else enabled
+        in_roi = sitk.GetArrayViewFromImage(mask) == label
+        if in_roi.any():
+            lower, upper = [], []
+            for axis in (2, 1, 0):
+                extent = np.flatnonzero(in_roi.any(axis=tuple(a for a in range(3) if a != axis)))
+                lower.append(int(extent[0]))
+                upper.append(int(extent[-1]) + 1)
+            image = image[lower[0]:upper[0], lower[1]:upper[1], lower[2]:upper[2]]
+            mask = mask[lower[0]:upper[0], lower[1]:upper[1], lower[2]:upper[2]]
+            in_roi = in_roi[lower[2]:upper[2], lower[1]:upper[1], lower[0]:upper[0]]
+        self.image = image
+        self.mask = mask
+        self.mask_array = np.array(in_roi)
+        self.mask_array.setflags(write=False)
+        self.roi_values = sitk.GetArrayViewFromImage(image)[self.mask_array]
+        self.binned = {}
+        self.glcms = {}
+        self.nested = {}
+
+    def discretized(self, settings):
+        """Discretized image and gray levels in the ROI for some settings,
+        computed once per binning (see imageoperations.getBinEdges).
+
+        :param settings: dict of pyradiomics settings
+        :return: (int array of the cropped image, sorted gray levels in the ROI)
+        """
+        key = binning_key(settings)
+        if key not in self.binned:
+            matrix = np.zeros(self.mask_array.shape, dtype='int')
+            matrix[self.mask_array] = np.digitize(self.roi_values,
+                imageoperations.getBinEdges(self.roi_values, **settings))
+            matrix.setflags(write=False)
+            self.binned[key] = matrix, np.unique(matrix[self.mask_array])
+        return self.binned[key]
+
+    def is_nested(self, fine, coarse, factor):
+        """True if every bin of a coarse discretization of the ROI is made of
+        factor consecutive bins of a fine one. With bin counts N and N / factor
+        the edges of the coarse bins are edges of the fine bins, but only up to
+        rounding, so this is checked on the ROI voxels.
+
+        :param fine: settings of the fine discretization
+        :param coarse: settings of the coarse discretization
+        :param factor: ratio of the bin counts
+        """
+        key = (binning_key(fine), binning_key(coarse))
+        if key not in self.nested:
+            fine_matrix, _ = self.discretized(fine)
+            coarse_matrix, _ = self.discretized(coarse)
+            self.nested[key] = np.array_equal((fine_matrix[self.mask_array] - 1) // factor + 1,
+                coarse_matrix[self.mask_array])
+        return self.nested[key]
+
+    def keep_glcm(self, settings, gray_levels, P_glcm):
+        """Keep a GLCM computed by pyradiomics, to derive the coarser ones from.
+
+        :param settings: dict of pyradiomics settings of the GLCM
+        :param gray_levels: gray levels of the rows and columns of the GLCM
+        :param P_glcm: normalized GLCM, shape (1, Ng, Ng, angles)
+        """
+        if binning_key(settings)[0] != 'binCount':
+            return
+        others = settings_key({name: value for name, value in settings.items()
+            if name not in ('binWidth', 'binCount')})
+        self.glcms.setdefault(others, {})[int(settings['binCount'])] = (settings, gray_levels, P_glcm)
+
+    def coarse_glcm(self, settings, gray_levels):
+        """GLCM derived from a finer one of the ROI, or None.
+        Deleting the empty gray levels, symmetrizing, weighting the angles and
+        normalizing are linear, so they commute with summing the blocks of
+        fine gray levels that make up each coarse gray level.
+
+        :param settings: dict of pyradiomics settings of the GLCM
+        :param gray_levels: gray levels in the ROI with these settings
+        :return: normalized GLCM, as computed by RadiomicsGLCM._calculateMatrix
+        """
+        if binning_key(settings)[0] != 'binCount':
+            return None
+        bin_count = int(settings['binCount'])
+        others = settings_key({name: value for name, value in settings.items()
+            if name not in ('binWidth', 'binCount')})
+        for fine_count, (fine, fine_levels, P_glcm) in sorted(self.glcms.get(others, {}).items()):
+            if fine_count <= bin_count or fine_count % bin_count != 0:
+                continue
+            factor = fine_count // bin_count
+            if not self.is_nested(fine, settings, factor):
+                continue
+            # the fine gray levels are sorted, so each coarse level is a run of rows
+            coarse_levels = (fine_levels - 1) // factor + 1
+            starts = np.flatnonzero(np.diff(coarse_levels, prepend=0))
+            if not np.array_equal(coarse_levels[starts], gray_levels):
+                continue
+            return np.add.reduceat(np.add.reduceat(P_glcm, starts, axis=1), starts, axis=2)
+        return None
+
+    def features(self, feature_class, settings):
+        """Instance of a pyradiomics feature class on the cached arrays.
+
+        :param feature_class: pyradiomics feature class, e.g. radiomics.glcm.RadiomicsGLCM
+        :param settings: dict of pyradiomics settings
+        """
+        if not self.enabled:
+            return feature_class(self.image, self.mask, **dict(settings, label=self.label))
+        cache = self
+
+        class Cached(feature_class):
+            """Feature class reading the mask and the binned image from the cache."""
+
+            def _initSegmentBasedCalculation(self):
+                # the shape class pads the mask and builds its own arrays
+                if feature_class._initSegmentBasedCalculation is \
+                    RadiomicsFeaturesBase._initSegmentBasedCalculation:
+                    self.maskArray = cache.mask_array
+                else:
+                    super()._initSegmentBasedCalculation()
+
+            def _applyBinning(self, matrix):
+                matrix, gray_levels = cache.discretized(self.settings)
+                self.coefficients['grayLevels'] = gray_levels
+                self.coefficients['Ng'] = int(np.max(gray_levels))
+                return matrix
+
+        if issubclass(feature_class, RadiomicsGLCM):
+
+            class CachedGLCM(Cached):
+                """GLCM class deriving the matrix from a finer one when possible."""
+
+                def _calculateMatrix(self, voxelCoordinates=None):
+                    if self.voxelBased:
+                        return super()._calculateMatrix(voxelCoordinates)
+                    P_glcm = cache.coarse_glcm(self.settings, self.coefficients['grayLevels'])
+                    if P_glcm is None:
+                        P_glcm = super()._calculateMatrix(voxelCoordinates)
+                        cache.keep_glcm(self.settings, self.coefficients['grayLevels'], P_glcm)
+                    return P_glcm
+
+            Cached = CachedGLCM
+
+        Cached.__name__ = feature_class.__name__
+        return Cached(self.image, self.mask, **dict(settings, label=self.label))
+
 class FeaturesExtractor:
     """Class to handle radiomic feature extraction with pyradiomics"""
 
     def __init__(self, base_dir, single_mode, output_dir, maskname, ivd, tag,
-        ford_p, glcm_p, glszm_p, glrlm_p, ngtdm_p, gldm_p, shape3d_p, ad):
+        ford_p, glcm_p, glszm_p, glrlm_p, ngtdm_p, gldm_p, shape3d_p, ad, index=None, store=None,
+        features=None):
         """Constructor for the FeaturesExtractor class. 
         
 
@@ -38,9 +248,17 @@ class FeaturesExtractor:
         :param gldm_p: params (left, right, bin_width) for GLDM radiomic features
         :param shape3d_p: params (left, right, bin_width) for 3D shape radiomic features 
         :param ad: Analysis date and time
+        :param index: SeriesIndex to read the DICOM tags from (optional)
+        :param store: ImageStore to read the images from (default: on disk)
+        :param features: names of the neural network features to compute, e.g. the ones
+            used by the model (see evaluate.model_features). The other features of the
+            neural network are set to NaN and the optional feature classes (ford_p, glcm_p, ...)
+            are skipped. Default: all the features
         """
 
         self.base_dir = base_dir
+        self.index = index
+        self.store = store if store is not None else ImageStore()
         self.output_dir = output_dir
         self.ivd = ivd
         self.tag = tag
@@ -51,9 +269,9 @@ class FeaturesExtractor:
             self.ct_paths = [os.path.join(base_dir, f"CT_ISO_{ivd:.2f}.nii")]
             self.mask_paths = [os.path.join(base_dir, maskname + '.nii')]
         else:
-            self.base_paths = glob(base_dir + '/*')
-            self.ct_paths = glob(base_dir + f'/*/CT_ISO_{ivd:.2f}.nii')
-            self.mask_paths = glob(base_dir + '/*/' + maskname + '.nii')
+            self.base_paths = self.store.glob(base_dir + '/*')
+            self.ct_paths = self.store.glob(base_dir + f'/*/CT_ISO_{ivd:.2f}.nii')
+            self.mask_paths = self.store.glob(base_dir + '/*/' + maskname + '.nii')
 
         if len(self.ct_paths)==0:
             raise ValueError
@@ -66,13 +284,15 @@ class FeaturesExtractor:
         self.gldm_p = gldm_p
         self.shape3d_p = shape3d_p
         self.ad = ad
-            
+        self.features = None if features is None else set(features)
+        self.executed = {}
+        self.roi = None
+
 
     def setup_round(self, ct_path):
         """Define some boring settings for the DICOM tag reader"""
 
-        ctdi_mean, searchtag = dcmtagreaderCTDI(ct_path)
-        ctdi_mean, searchtag = dcmtagreaderCTDI(ct_path)
+        ctdi_mean, searchtag = series_ctdi(ct_path, self.index)
         try:
             acqdate = searchtag[0x0008,0x0022].value
         except:
@@ -227,30 +447,74 @@ class FeaturesExtractor:
         return my_dict
 
 
+    def selected(self, feature_class, bin_width):
+        """Names of the features of a class needed at a bin width by self.features,
+        or None if all the features are computed.
+
+        :param feature_class: pyradiomics feature class, e.g. radiomics.glcm.RadiomicsGLCM
+        :param bin_width: bin width, suffix of the feature names
+        """
+        if self.features is None:
+            return None
+        return [name for name, deprecated in feature_class.getFeatureNames().items()
+            if not deprecated and f'{name}_{bin_width}' in self.features]
+
+    def execute(self, feature_class, settings, names=None):
+        """Features of a pyradiomics feature class, computed at most once per
+        patient for the same settings: later requests reuse the result.
+        The classes share the cropped and discretized arrays of self.roi.
+
+        :param feature_class: pyradiomics feature class, e.g. radiomics.glcm.RadiomicsGLCM
+        :param settings: dict of pyradiomics settings
+        :param names: names of the features to compute, the other features of the
+            class are NaN (default: all the features)
+        """
+        key = (feature_class.__name__, settings_key(settings), None if names is None else tuple(names))
+        if key not in self.executed:
+            if names is None:
+                self.executed[key] = self.roi.features(feature_class, settings).execute()
+            else:
+                # same keys, in the same order, as with all the features
+                values = {name: np.nan for name, deprecated in feature_class.getFeatureNames().items()
+                    if not deprecated}
+                if names:
+                    features = self.roi.features(feature_class, settings)
+                    for name in names:
+                        features.enableFeatureByName(name)
+                    values.update(features.execute())
+                self.executed[key] = values
+        return self.executed[key]
+
     def run(self):
         """Execute main method of FeaturesExtractor class.
             Extract radiomic features from nifti file"""
         features_df = pd.DataFrame()
         total_df = pd.DataFrame()
 
-        with open(os.path.join( self.output_dir, 'radiomic_total.csv'),'a') as fall, open(
-            os.path.join( self.output_dir, 'radiomic_features_append.csv'),'a') as f_NN_append, open(
-            os.path.join( self.output_dir, 'radiomic_features.csv'),'w', encoding='utf-8') as f_NN:
-
-            fall_wr = csv.writer(fall, delimiter='\t')
-            f_NN_append_wr = csv.writer(f_NN_append, delimiter='\t')
+        with ExitStack() as files:
+            f_NN = files.enter_context(open(
+                os.path.join( self.output_dir, 'radiomic_features.csv'),'w', encoding='utf-8'))
             f_NN_wr = csv.writer(f_NN, delimiter='\t')
 
+            # the cumulative files only get complete rows: a model-only run
+            # (NaN for the other features, no optional classes) is not appended
+            if self.features is None:
+                fall = files.enter_context(open(os.path.join( self.output_dir, 'radiomic_total.csv'),'a'))
+                f_NN_append = files.enter_context(open(
+                    os.path.join( self.output_dir, 'radiomic_features_append.csv'),'a'))
+                fall_wr = csv.writer(fall, delimiter='\t')
+                f_NN_append_wr = csv.writer(f_NN_append, delimiter='\t')
+
             p_bar = tqdm(total=len(self.base_paths)*9, colour='red',desc='Radiomic features  ')
 
             for base_path, ct_path, mask_path in zip(self.base_paths, self.ct_paths, self.mask_paths):
 
                 result_1 = self.setup_round (os.path.join(base_path, 'CT'))
                 result_all = result_1
-                result_NN = self.setup_round(os.path.join(base_path, 'CT'))
+                result_NN = dict(result_1)
 
-                image = sitk.ReadImage(ct_path)
-                mask = sitk.ReadImage(mask_path)
+                self.executed = {}
+                self.roi = RoiCache(self.store.read_ct(ct_path), self.store.read_labels(mask_path))
                 ## FIRST ORDER - FOR NEURAL NETWORK
                 p, j= 5, 240
 
@@ -262,8 +526,8 @@ class FeaturesExtractor:
                     'binCount': j
                 }
 
-                extr_1ord = radiomics.firstorder.RadiomicsFirstOrder(image, mask, **settings)
-                feat_1ord = change_keys(extr_1ord.execute(), str(p))
+                feat_1ord = change_keys(self.execute(radiomics.firstorder.RadiomicsFirstOrder, settings,
+                    self.selected(radiomics.firstorder.RadiomicsFirstOrder, p)), str(p))
 
                 result_all.update(feat_1ord)
                 result_NN.update(feat_1ord)
@@ -284,9 +548,8 @@ class FeaturesExtractor:
                         'binCount': j
                     }
 
-                    glcm_features = radiomics.glcm.RadiomicsGLCM(
-                        image, mask, **settings)
-                    feat_glcm = change_keys(glcm_features.execute(), str(bin_width))
+                    feat_glcm = change_keys(self.execute(radiomics.glcm.RadiomicsGLCM, settings,
+                        self.selected(radiomics.glcm.RadiomicsGLCM, bin_width)), str(bin_width))
                     result_glcm.update(feat_glcm)
 
                 result_NN.update(result_glcm)
@@ -305,10 +568,8 @@ class FeaturesExtractor:
                         'binCount': j
                     }
 
-                    glszm_features = radiomics.glszm.RadiomicsGLSZM(
-                        image, mask, **settings)
-
-                    feat_glszm = change_keys(glszm_features.execute(), str(bin_width))
+                    feat_glszm = change_keys(self.execute(radiomics.glszm.RadiomicsGLSZM, settings,
+                        self.selected(radiomics.glszm.RadiomicsGLSZM, bin_width)), str(bin_width))
                     result_glszm.update(feat_glszm)
 
                 result_NN.update(result_glszm)
@@ -326,7 +587,7 @@ class FeaturesExtractor:
 
                 n = 'FIRSTORDER'
                 n = 'FIRSTORDER'
-                if int(on)==1:
+                if int(on)==1 and self.features is None:
                     settings = {
                         'voxelArrayShift': 0,
                         'label': 1,
@@ -335,10 +596,7 @@ class FeaturesExtractor:
                         'binCount': j
                     }
 
-                    res_1ord = radiomics.firstorder.RadiomicsFirstOrder(image, mask, **settings)
-                    dict_1ord = change_keys_2(str(n), res_1ord.execute())
-                    dict_1ord = change_keys(dict_1ord, str(bin_width))
-                    dict_1ord = change_keys_2(str(n), res_1ord.execute())
+                    dict_1ord = change_keys_2(str(n), self.execute(radiomics.firstorder.RadiomicsFirstOrder, settings))
                     dict_1ord = change_keys(dict_1ord, str(bin_width))
                     dict_1ord = change_keys(dict_1ord, str(l))
                     dict_1ord = change_keys(dict_1ord, str(r))
@@ -353,18 +611,14 @@ class FeaturesExtractor:
                 n = 'GLCM'
                 n = 'GLCM'
 
-                if int(on)==1:
+                if int(on)==1 and self.features is None:
                     settings = {
                         'label': 1,
                         'resegmentRange': [l, r],
                         'binWidth': bin_width,
                         'binCount': j
                     }
-                    glcm_features = radiomics.glcm.RadiomicsGLCM(
-                        image, mask, **settings)
-                    feat_glcm = change_keys_2(str(n), glcm_features.execute())
-                    feat_glcm = change_keys(feat_glcm, str(bin_width))
-                    feat_glcm = change_keys_2(str(n), glcm_features.execute())
+                    feat_glcm = change_keys_2(str(n), self.execute(radiomics.glcm.RadiomicsGLCM, settings))
                     feat_glcm = change_keys(feat_glcm, str(bin_width))
                     feat_glcm = change_keys(feat_glcm, str(l))
                     feat_glcm = change_keys(feat_glcm, str(r))
@@ -380,7 +634,7 @@ class FeaturesExtractor:
                 n = 'GLSZM'
                 n = 'GLSZM'
 
-                if int(on)==1:
+                if int(on)==1 and self.features is None:
 
                     settings = {
                         'label': 1  ,
@@ -389,12 +643,7 @@ class FeaturesExtractor:
                         'binCount': j
                     }
 
-                    glszm_features = radiomics.glszm.RadiomicsGLSZM(
-                        image, mask, **settings)
-
-                    feat_glszm = change_keys_2(str(n), glszm_features.execute())
-                    feat_glszm = change_keys(feat_glszm, str(bin_width))
-                    feat_glszm = change_keys_2(str(n), glszm_features.execute())
+                    feat_glszm = change_keys_2(str(n), self.execute(radiomics.glszm.RadiomicsGLSZM, settings))
                     feat_glszm = change_keys(feat_glszm, str(bin_width))
                     feat_glszm = change_keys(feat_glszm, str(l))
                     feat_glszm = change_keys(feat_glszm, str(r))
@@ -411,7 +660,7 @@ class FeaturesExtractor:
                 n = 'GLRLM'
                 n = 'GLRLM'
 
-                if int(on)==1:
+                if int(on)==1 and self.features is None:
 
                     settings = {
                         'label': 1  ,
@@ -420,10 +669,7 @@ class FeaturesExtractor:
                         'binCount': j
                     }
 
-                    glrlm_features = radiomics.glrlm.RadiomicsGLRLM(image, mask, **settings)
-                    feat_glrlm = change_keys_2(str(n), glrlm_features.execute())
-                    feat_glrlm = change_keys(feat_glrlm, str(bin_width))
-                    feat_glrlm = change_keys_2(str(n), glrlm_features.execute())
+                    feat_glrlm = change_keys_2(str(n), self.execute(radiomics.glrlm.RadiomicsGLRLM, settings))
                     feat_glrlm = change_keys(feat_glrlm, str(bin_width))
                     feat_glrlm = change_keys(feat_glrlm, str(l))
                     feat_glrlm = change_keys(feat_glrlm, str(r))
@@ -440,7 +686,7 @@ class FeaturesExtractor:
                 n = 'NGTDM'
                 n = 'NGTDM'
 
-                if int(on)==1:
+                if int(on)==1 and self.features is None:
 
                     settings = {
                         'label': 1  ,
@@ -450,10 +696,7 @@ class FeaturesExtractor:
                     }
 
 
-                    ngtdm_features = radiomics.ngtdm.RadiomicsNGTDM(image, mask, **settings)
-                    feat_ngtdm = change_keys_2(str(n), ngtdm_features.execute())
-                    feat_ngtdm = change_keys(feat_ngtdm, str(bin_width))
-                    feat_ngtdm = change_keys_2(str(n), ngtdm_features.execute())
+                    feat_ngtdm = change_keys_2(str(n), self.execute(radiomics.ngtdm.RadiomicsNGTDM, settings))
                     feat_ngtdm = change_keys(feat_ngtdm, str(bin_width))
                     feat_ngtdm = change_keys(feat_ngtdm, str(l))
                     feat_ngtdm = change_keys(feat_ngtdm, str(r))
@@ -470,7 +713,7 @@ class FeaturesExtractor:
                 n = 'GLDM'
                 n = 'GLDM'
 
-                if int(on)==1:
+                if int(on)==1 and self.features is None:
 
                     settings = {
                         'label': 1  ,
@@ -479,10 +722,7 @@ class FeaturesExtractor:
                         'binCount': j
                     }
 
-                    gldm_features = radiomics.gldm.RadiomicsGLDM(image, mask, **settings)
-                    feat_gldm = change_keys_2(str(n), gldm_features.execute())
-                    feat_gldm = change_keys(feat_gldm, str(bin_width))
-                    feat_gldm = change_keys_2(str(n), gldm_features.execute())
+                    feat_gldm = change_keys_2(str(n), self.execute(radiomics.gldm.RadiomicsGLDM, settings))
                     feat_gldm = change_keys(feat_gldm, str(bin_width))
                     feat_gldm = change_keys(feat_gldm, str(l))
                     feat_gldm = change_keys(feat_gldm, str(r))
@@ -500,7 +740,7 @@ class FeaturesExtractor:
                 n = 'SHAPE3D'
                 n = 'SHAPE3D'
 
-                if int(on)==1:
+                if int(on)==1 and self.features is None:
 
 
                     settings = {
@@ -510,10 +750,7 @@ class FeaturesExtractor:
                         'binCount': j
                     }
 
-                    sh3_features = radiomics.shape.RadiomicsShape(image, mask, **settings)
-                    feat_sh3 = change_keys_2(str(n), sh3_features.execute())
-                    feat_sh3 = change_keys(feat_sh3, str(bin_width))
-                    feat_sh3 = change_keys_2(str(n), sh3_features.execute())
+                    feat_sh3 = change_keys_2(str(n), self.execute(radiomics.shape.RadiomicsShape, settings))
                     feat_sh3 = change_keys(feat_sh3, str(bin_width))
                     feat_sh3 = change_keys(feat_sh3, str(l))
                     feat_sh3 = change_keys(feat_sh3, str(r))
@@ -536,24 +773,18 @@ class FeaturesExtractor:
                     new = pd.DataFrame({k: [v] for k, v in result_all.items()})
                     total_df = pd.concat([total_df, new], ignore_index=True)
 
-                if fall.tell()==0:
-                    fall_wr.writerow(result_all.keys())
-                    fall_wr.writerow(result_all.values())
-                else:
-                    fall_wr.writerow(result_all.values())
-
-                # if f_NN_append.tell()==0:
-                #     f_NN_append_wr.writerow(result_NN.keys())
-                #     f_NN_append_wr.writerow(result_NN.values())
-                # else:
-                #     f_NN_append_wr.writerow(result_NN.values())
-                #     fall_wr.writerow(result_all.values())
-
-                if f_NN_append.tell()==0:
-                    f_NN_append_wr.writerow(result_NN.keys())
-                    f_NN_append_wr.writerow(result_NN.values())
-                else:
-                    f_NN_append_wr.writerow(result_NN.values())
+                if self.features is None:
+                    if fall.tell()==0:
+                        fall_wr.writerow(result_all.keys())
+                        fall_wr.writerow(result_all.values())
+                    else:
+                        fall_wr.writerow(result_all.values())
+
+                    if f_NN_append.tell()==0:
+                        f_NN_append_wr.writerow(result_NN.keys())
+                        f_NN_append_wr.writerow(result_NN.values())
+                    else:
+                        f_NN_append_wr.writerow(result_NN.values())
 
                 if f_NN.tell()==0:
                     f_NN_wr.writerow(result_NN.keys())
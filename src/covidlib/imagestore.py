@@ -0,0 +1,197 @@
+"""Module to pass images between the pipeline stages.
+Images are addressed by the path of their NIfTI file. In disk mode
+(default) every read and write is a file operation; in memory mode
+the images are kept in a dictionary, so the patient folder works as a
+per-patient context, and writing the files is optional.
+The stages run over all the patients in turn, so in memory mode every
+image stays in the store until the end of the run: the pipeline only
+allows it for a single patient (clearlung --single).
+Large volumes can also be read a z-slab at a time (see VolumeSlabs)."""
+
+import fnmatch
+import glob
+import os
+
+import numpy as np
+import SimpleITK as sitk
+
+from covidlib.ctlibrary import (CT_PIXEL_TYPE, LABEL_PIXEL_TYPE, cast_image, crop_image,
+    read_ct, read_geometry, read_labels, write_ct, write_labels)
+
+
+class ImageStore():
+    """Images of the pipeline intermediates, on disk or in memory."""
+
+    def __init__(self, in_memory=False, persist=True):
+        """Constructor for the ImageStore class.
+
+        :param in_memory: if True, keep the images in memory between stages
+        :param persist: in memory mode, also write the images to disk (e.g. for audit).
+            It has no effect in disk mode
+        """
+        self.in_memory = in_memory
+        self.persist = persist or not in_memory
+        self.images = {}
+
+    def _put(self, image, path):
+        """Keep an image in memory."""
+        self.images[os.path.normpath(path)] = image
+
+    def _get(self, path):
+        """Image kept in memory for a path, or None.
+        A shallow copy is returned, so that changes to the metadata
+        do not affect the stored image."""
+        image = self.images.get(os.path.normpath(path))
+        return None if image is None else sitk.Image(image)
+
+    def write_image(self, image, path):
+        """Store an image as is (e.g. the native CT).
+        :param image: SimpleITK image
+        :param path: path of the NIfTI file
+        """
+        if self.in_memory:
+            self._put(image, path)
+        if self.persist:
+            sitk.WriteImage(image, path)
+
+    def write_ct(self, image, path):
+        """Store a CT volume as int16 HU (see ctlibrary.write_ct)."""
+        if self.in_memory:
+            self._put(cast_image(image, CT_PIXEL_TYPE), path)
+        if self.persist:
+            write_ct(image, path)
+
+    def write_labels(self, image, path):
+        """Store a label map as uint8 (see ctlibrary.write_labels)."""
+        if self.in_memory:
+            self._put(cast_image(image, LABEL_PIXEL_TYPE), path)
+        if self.persist:
+            write_labels(image, path)
+
+    def read_image(self, path, pixel_type=sitk.sitkUnknown):
+        """Image for a path, as stored.
+        :param pixel_type: if given, the image is cast to this pixel type
+        """
+        image = self._get(path)
+        if image is None:
+            return sitk.ReadImage(path, pixel_type)
+        if pixel_type != sitk.sitkUnknown and image.GetPixelID() != pixel_type:
+            image = sitk.Cast(image, pixel_type)
+        return image
+
+    def read_ct(self, path):
+        """CT volume for a path, as int16 HU (see ctlibrary.read_ct)."""
+        image = self._get(path)
+        return read_ct(path) if image is None else image
+
+    def read_labels(self, path):
+        """Label map for a path, as uint8 (see ctlibrary.read_labels)."""
+        image = self._get(path)
+        return read_labels(path) if image is None else image
+
+    def read_slab(self, path, start, stop, pixel_type=None):
+        """Slices [start, stop) of an image along z. From disk, only these slices are read.
+        :param pixel_type: if given (CT_PIXEL_TYPE or LABEL_PIXEL_TYPE), the slab is cast to it
+        """
+        image = self.images.get(os.path.normpath(path))
+        if image is None:
+            reader = sitk.ImageFileReader()
+            reader.SetFileName(path)
+            reader.ReadImageInformation()
+            size = reader.GetSize()
+            reader.SetExtractIndex((0, 0, start))
+            reader.SetExtractSize((size[0], size[1], stop - start))
+            image = reader.Execute()
+        else:
+            image = image[:, :, start:stop]
+        return image if pixel_type is None else cast_image(image, pixel_type)
+
+    def geometry(self, path):
+        """(size, spacing, origin, direction) of an image, without reading the voxels from disk."""
+        image = self.images.get(os.path.normpath(path))
+        if image is None:
+            return read_geometry(path)
+        return image.GetSize(), image.GetSpacing(), image.GetOrigin(), image.GetDirection()
+
+    def exists(self, path):
+        """Check if an image is available for a path."""
+        return os.path.normpath(path) in self.images or os.path.exists(path)
+
+    def glob(self, pattern):
+        """Sorted paths matching a glob pattern, on disk or in memory.
+        A path kept in memory is returned only if it is not on disk."""
+        paths = glob.glob(pattern)
+        on_disk = {os.path.normpath(path) for path in paths}
+        depth = os.path.normpath(pattern).count(os.sep)
+        for key in self.images:
+            if key not in on_disk and key.count(os.sep) == depth and \
+                fnmatch.fnmatchcase(key, os.path.normpath(pattern)):
+                paths.append(key)
+        return sorted(paths)
+
+    def clear(self):
+        """Forget all the images kept in memory."""
+        self.images.clear()
+
+
+def slab_height(budget, slice_bytes, fixed_bytes=0):
+    """Number of slices that fit in a memory budget (at least one).
+    :param budget: memory budget in bytes
+    :param slice_bytes: bytes of working arrays per slice
+    :param fixed_bytes: bytes needed whatever the number of slices (e.g. halo slices)
+    """
+    return max(1, int((budget - fixed_bytes) // slice_bytes))
+
+
+class VolumeSlabs():
+    """Stored image seen as a lazy (z, y, x) numpy array.
+    Indexing along z reads only the slices spanned by the index, so a
+    volume-wide stage can stream through it a slab at a time."""
+
+    def __init__(self, store, path, pixel_type=None, box=None, geometry=None):
+        """Constructor for the VolumeSlabs class.
+
+        :param store: ImageStore holding the image
+        :param path: path of the image
+        :param pixel_type: pixel type to cast the slices to (default: as stored)
+        :param box: crop box, applied in-plane (see ctlibrary.crop_image)
+        :param geometry: (spacing, origin, direction) replacing the ones of the image
+        """
+        self.store = store
+        self.path = path
+        self.pixel_type = pixel_type
+        self.box = box
+        size, spacing, origin, direction = store.geometry(path)
+        if geometry is not None:
+            spacing, origin, direction = geometry
+        self.geometry = (spacing, origin, direction)
+        self.depth = size[2]
+
+        first = self.image(0, 1)
+        self.size = first.GetSize()[:2] + (self.depth,)
+        self.spacing = first.GetSpacing()
+        self.shape = (self.depth, first.GetHeight(), first.GetWidth())
+        self.dtype = sitk.GetArrayViewFromImage(first).dtype
+
+    def image(self, start, stop):
+        """SimpleITK image of the slices [start, stop), with its geometry."""
+        slab = self.store.read_slab(self.path, start, stop, self.pixel_type)
+        spacing, origin, direction = self.geometry
+        slab.SetSpacing(spacing)
+        slab.SetDirection(direction)
+        slab.SetOrigin(tuple(np.asarray(origin) + np.reshape(direction, (3, 3)) @
+            (np.asarray(spacing) * (0, 0, start))))
+        if self.box is not None:
+            slab = crop_image(slab, self.box, inplane=True)
+        return slab
+
+    def __getitem__(self, index):
+        """Slices of a z index: a slice or an array of integers."""
+        if isinstance(index, slice):
+            index = np.arange(*index.indices(self.depth))
+        index = np.asarray(index)
+        if index.size == 0:
+            return np.empty((0,) + self.shape[1:], dtype=self.dtype)
+        first = int(index.min())
+        array = sitk.GetArrayFromImage(self.image(first, int(index.max()) + 1))
+        return array[index - first]
@@ -2,6 +2,7 @@
 They are necessary to execute the whole pipeline and to build wrappers around it."""
 
 import argparse
+import glob
 import os
 import sys
 import pathlib
@@ -22,9 +23,13 @@ from covidlib.pacs import DicomLoader
 from covidlib.pdfgen import PDFHandler
 from covidlib.rescale import Rescaler
 from covidlib.masks import MaskCreator
+from covidlib.segment import require_onnx
 from covidlib.extract import FeaturesExtractor
-from covidlib.evaluate import ModelEvaluator
+from covidlib.evaluate import ModelEvaluator, model_features
 from covidlib.qct import QCT
+from covidlib.seriesindex import SeriesIndex
+from covidlib.imagestore import ImageStore
+from covidlib.maskcache import MASK_CACHE, MaskCache
 
 if sys.platform == 'linux':
     from covidlib.watcher import PathWatcher
@@ -53,20 +58,58 @@ def main():
     parser.add_argument('--automatic', action="store_true", help='Pipeline starts on automatic')
 
     parser.add_argument('-n','--skipnifti', action="store_true", default=False, help='Use pre-existing nii images')
+    parser.add_argument('--nifti_backend', type=str, choices=['dcm2niix', 'pydicom'], default='dcm2niix',
+        help='Convert DICOM to nifti with dcm2niix or with the in-process pydicom loader')
+    parser.add_argument('--incremental', action="store_true", default=False,
+        help='Convert to nifti only the series that changed since the last conversion')
     parser.add_argument('-r3','--skiprescaling3mm', action="store_true", default=False, help='Use pre-existing 3mm rescaled nii images and masks')
     parser.add_argument('-ri','--skiprescalingiso', action="store_true", default=False, help='Use pre-existing ISO rescaled nii images and masks')
     parser.add_argument('-k','--skipmask', action="store_true", default=False, help='Use pre-existing masks')
     parser.add_argument('--radqct', action="store_true", default=False, help='Skip radiomics and qct')
     parser.add_argument('--skippdf', action="store_true", default=False, help='Skip pdf generation')
+    parser.add_argument('--plot_workers', type=int,
+        help='Number of processes to render the QCT histogram figures (default: number of CPUs)')
 
     parser.add_argument('--base_dir', type=str, required=True, help='path to folder containing patient data')
     parser.add_argument('--target_dir', type=str, default='CT', help='Name of the subfolder with the DICOM series')
     parser.add_argument('--output_dir', type=str, required=True, help='Path to output features')
     parser.add_argument('--slice_thickness_qct', type=float, default=3, help='Slice thickness in mm for QCT', dest='st')
     parser.add_argument('--slice_thickness_iso', type=float, default=1.15, help='Voxel dimension for ISO rescaling', dest='ivd')
+    parser.add_argument('--resample_backend', type=str, choices=['skimage', 'sitk'], default='skimage',
+        help='Backend for the ISO rescaling (sitk is multithreaded)')
+    parser.add_argument('--mask_resampling', type=str, choices=['nearest', 'partial'], default='nearest',
+        help='ISO resampling of the masks: nearest neighbour or partial volume')
+    parser.add_argument('--crop', action="store_true", default=False,
+        help='Crop ISO rescaling and QCT to the lung bounding box')
+    parser.add_argument('--crop_margin', type=float, default=10., help='Margin around the lungs in mm for --crop')
+    parser.add_argument('--seg_backend', type=str, choices=['torch', 'onnx'], default='torch',
+        help='Run the segmentation network in PyTorch or in ONNX Runtime (CPU), which needs pip install covidlib[onnx]')
+    parser.add_argument('--fast-segmentation', action="store_true", default=False, dest='fast_segmentation',
+        help='Segment with the int8 quantized network in ONNX Runtime (see benchmarks/validate_fast_segmentation.py)')
+    parser.add_argument('--seg_threads', type=int, help='Number of intra-op threads for --seg_backend onnx')
+    parser.add_argument('--mask_cache_dir', type=str, default=MASK_CACHE,
+        help='Directory of the content-addressed cache of lung masks')
+    parser.add_argument('--mask_cache_size', type=float, default=2048, help='Size limit of the mask cache in MB')
+    parser.add_argument('--no_mask_cache', action="store_true", default=False,
+        help='Always recompute the lung masks')
+    parser.add_argument('--memory_budget', type=float,
+        help='Process the rescaling and QCT volumes in z-slabs, with working arrays of about this many MB')
+    parser.add_argument('--seg_batch_size', type=int,
+        help='Segment all the patients together, with batches of this many slices')
+    parser.add_argument('--in_memory', action="store_true", default=False,
+        help='Pass the images between the pipeline stages in memory instead of through .nii files. '
+        'The images are kept until the end of the run, so it requires --single')
+    parser.add_argument('--persist', action="store_true", default=False,
+        help='With --in_memory, also write the intermediate .nii files (e.g. for audit)')
     parser.add_argument('--history_path', type=str, help="Path to the directory where to save analysis history")
+    parser.add_argument('--index_path', type=str, help="Path to the SQLite index of the ingested series")
+    parser.add_argument('--skip_analysed', action="store_true", default=False,
+        help='Exit if all the series are already marked as analysed in the index')
 
     parser.add_argument('--model', type=str, required=True, help='Path to pre-trained model')
+    parser.add_argument('--model_only', action="store_true", default=False,
+        help='Compute only the radiomic features used by the model (see features.txt in the model directory) '
+        'and skip the optional feature classes. The rows are not appended to radiomic_total.csv')
     parser.add_argument('--tag', help='Tag to add to output files')
     parser.add_argument('--subroi', action="store_true", help='Execute QCT analysis on subROIs and write it on the final csv file')
 
@@ -94,21 +137,64 @@ def main():
     parser.add_argument('--FORD_params', action='store', dest='ford', type=str, nargs=4, default=[1, -1020, 180, 25],
      help="Custom params for first order features")
     args = parser.parse_args()
+    if args.in_memory and not args.single:
+        parser.error('--in_memory keeps every image until the end of the run and requires --single')
+    if args.seg_backend == 'onnx' or args.fast_segmentation:
+        try:
+            require_onnx()
+        except ImportError as err:
+            parser.error(str(err))
 
     print("Args parsed")
 
     import warnings
     warnings.filterwarnings("ignore")
 
+    index = SeriesIndex(args.index_path) if args.index_path else None
+    try:
+        run_pipeline(args, index, start)
+    finally:
+        if index is not None:
+            index.close()
+
+
+def run_pipeline(args, index, start):
+    """Run the pipeline stages for the parsed command line arguments.
+
+    :param args: parsed arguments of clearlung
+    :param index: SeriesIndex of the ingested series, or None
+    :param start: start time, for the elapsed time report
+    """
+    store = ImageStore(in_memory=args.in_memory, persist=args.persist)
+
     loader = DicomLoader(ip_add=args.ip, port=args.port, aetitle=args.aetitle,
                             patient_id=args.patientID, study_id=args.studyUID,
-                            series_id=args.seriesUID, output_path=args.base_dir)
+                            series_id=args.seriesUID, output_path=args.base_dir,
+                            index=index)
 
     if args.from_pacs:
         loader.download()
         print("DICOM series correctly downloaded")
         args.base_dir = os.path.join(args.base_dir, args.patientID)
 
+    if args.single:
+        series_paths = [os.path.join(args.base_dir, args.target_dir)]
+    else:
+        series_paths = glob.glob(os.path.join(args.base_dir, '*', args.target_dir))
+
+    if index is not None and args.skip_analysed and series_paths:
+        # the series are identified by the SeriesInstanceUID of their headers:
+        # a folder name can be reused by a new study, or a series re-sent elsewhere
+        try:
+            series_uids = [index.register(path) for path in series_paths]
+        except UnboundLocalError:
+            series_uids = []
+        if series_uids and all(index.is_analysed(series_uid) for series_uid in series_uids):
+            print("All the series were already analysed. Goodbye!")
+            if args.automatic:
+                loader.move_to_analyzed()
+            return
+
     parts = ['bilat', 'left', 'right', 'upper', 'lower', 'ventral', 'dorsal']
     analysis_date_for_image = datetime.now().strftime("%Y%m%d_%H%M%S")
 
@@ -119,7 +205,9 @@ def main():
         os.mkdir(args.output_dir)
 
     if not args.skipnifti:
-        nif = Niftizator(base_dir=args.base_dir, target_dir_name=args.target_dir, single_mode=args.single)
+        nif = Niftizator(base_dir=args.base_dir, target_dir_name=args.target_dir, single_mode=args.single,
+                         index=index, backend=args.nifti_backend,
+                         incremental=args.incremental, store=store)
         try:
             nif.run()
         except TraitError:
@@ -141,7 +229,13 @@ def main():
     rescale = Rescaler(base_dir=args.base_dir,
         single_mode=args.single,
         iso_vox_dim=args.ivd,
-        slice_thk=args.st)
+        slice_thk=args.st,
+        backend=args.resample_backend,
+        mask_mode=args.mask_resampling,
+        store=store,
+        crop=args.crop,
+        crop_margin=args.crop_margin,
+        memory_budget=args.memory_budget)
 
     if not args.skiprescaling3mm:
         rescale.run_xmm(args.st)
@@ -149,11 +243,19 @@ def main():
         print(f"Loading pre existing *_{args.st}mm.nii")
 
     if not args.skipmask:
-        mask = MaskCreator(base_dir=args.base_dir, single_mode=args.single, st=args.st, ivd=args.ivd)
+        mask_cache = None if args.no_mask_cache else \
+            MaskCache(args.mask_cache_dir, max_bytes=int(args.mask_cache_size * 2**20))
+        mask = MaskCreator(base_dir=args.base_dir, single_mode=args.single, st=args.st, ivd=args.ivd,
+            store=store, batch_size=args.seg_batch_size,
+            backend=args.seg_backend, threads=args.seg_threads, fast=args.fast_segmentation,
+            cache=mask_cache)
         mask.run()
     else:
         print(f"Loading pre-existing mask_R231CW_{args.st:.0f}mm.nii")
 
+    if args.crop:
+        rescale.make_crop_box()
+
     if not args.skiprescalingiso:
         try:
             rescale.run_iso()
@@ -165,9 +267,7 @@ def main():
         print(f"Loading pre esisting *_ISO_{args.ivd}.nii")
 
     try:
-        rescale.make_upper_mask()
-        rescale.make_ventral_mask()
-        rescale.make_mixed_mask()
+        rescale.make_subroi_mask()
     except FileNotFoundError as ex:
         print(ex)
         print("Some files were not found. Terminating the program.")
@@ -183,7 +283,8 @@ def main():
                     glcm_p=args.GLCM, glszm_p=args.GLSZM,
                     glrlm_p=args.GLRLM, ngtdm_p=args.NGTDM,
                     gldm_p=args.GLDM, shape3d_p=args.shape3D,
-                    ford_p=args.ford, ad=analysis_date_for_image)
+                    ford_p=args.ford, ad=analysis_date_for_image, index=index, store=store,
+                    features=model_features(args.model)[1] if args.model_only else None)
 
     except:
         print("###########################################")
@@ -206,7 +307,9 @@ def main():
         model_ev.run()
 
         qct = QCT(base_dir=args.base_dir, parts=parts, single_mode=args.single,
-            out_dir=args.output_dir, st=args.st, ad= analysis_date_for_image)
+            out_dir=args.output_dir, st=args.st, ad= analysis_date_for_image, index=index,
+            store=store, crop=args.crop, plots=not args.skippdf, plot_workers=args.plot_workers,
+            memory_budget=args.memory_budget)
         qct.run()
     else:
         print("Skipping QCT and radiomic analysis")
@@ -220,10 +323,14 @@ def main():
                      st=args.st,
                      ivd=args.ivd,
                      single_mode=args.single,
-                     data_rad=pd.read_csv(os.path.join(args.output_dir, 'radiomic_total.csv'), sep='\t'),
+                     # radiomic_total.csv only collects the full runs
+                     data_rad=pd.read_csv(os.path.join(args.output_dir,
+                        'radiomic_features.csv' if args.model_only else 'radiomic_total.csv'), sep='\t'),
                      tag = args.tag,
                      history_path = args.history_path,
-                     ad = analysis_date_for_image)
+                     ad = analysis_date_for_image,
+                     index = index,
+                     store = store)
 
     if not args.skippdf:
         pdf.run()
@@ -233,6 +340,13 @@ def main():
         loader.upload(encapsulated_today)
         print("Report uploaded on PACS")
 
+    store.clear()
+
+    # --radqct and --model_only runs do not produce the full analysis
+    if index is not None and not args.radqct and not args.model_only:
+        for path in series_paths:
+            index.mark_analysed(path, analysis_date_for_image)
+
     if args.automatic:
         loader.move_to_analyzed()
 
@@ -0,0 +1,108 @@
+"""Module to cache the lung masks on disk.
+The cache is content-addressed: the key is a hash of the CT voxels, of
+the image grid and of the segmentation model, so a cached mask is only
+reused for the very same input. The least recently used masks are
+evicted when the cache grows beyond its size limit."""
+
+import hashlib
+import os
+from importlib.metadata import PackageNotFoundError, version
+
+import numpy as np
+import SimpleITK as sitk
+
+MASK_CACHE = os.path.join(os.path.expanduser('~'), '.cache', 'clearlung', 'masks')
+
+
+def lungmask_version():
+    """Installed lungmask version, or None if it cannot be found.
+    Without a version, masks of different lungmask releases cannot be told
+    apart: the callers do not cache them then."""
+    try:
+        return version('lungmask')
+    except PackageNotFoundError:
+        return None
+
+
+class MaskCache():
+    """Size-bounded LRU cache of segmentation label maps."""
+
+    def __init__(self, cache_dir=MASK_CACHE, max_bytes=2 * 2**30):
+        """Constructor for the MaskCache class.
+
+        :param cache_dir: directory of the cached masks, created if needed
+        :param max_bytes: maximum total size of the cached files
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def key(image, model_id: str) -> str:
+        """Cache key of a CT volume segmented by a model.
+
+        :param image: SimpleITK image
+        :param model_id: name and version of the segmentation model
+        """
+        digest = hashlib.sha256()
+        digest.update(model_id.encode())
+        digest.update(repr((image.GetSize(), image.GetSpacing(), image.GetDirection(),
+            image.GetPixelIDValue())).encode())
+        digest.update(np.ascontiguousarray(sitk.GetArrayViewFromImage(image)).data)
+        return digest.hexdigest()
+
+    def _path(self, key):
+        """Path of the cached mask of a key."""
+        return os.path.join(self.cache_dir, key + '.npz')
+
+    def get(self, key, shape=None):
+        """Cached label map of a key, or None.
+
+        :param key: cache key (see MaskCache.key)
+        :param shape: expected shape of the label map, checked if given
+        """
+        path = self._path(key)
+        try:
+            with np.load(path) as data:
+                labels = data['labels']
+        except (FileNotFoundError, OSError, KeyError, ValueError):
+            return None
+        if shape is not None and labels.shape != tuple(shape):
+            return None
+        # the modification time is the last use time, for the LRU eviction
+        os.utime(path)
+        return labels
+
+    def put(self, key, labels):
+        """Store a label map and evict the least recently used ones if needed.
+
+        :param key: cache key (see MaskCache.key)
+        :param labels: numpy label array
+        """
+        path = self._path(key)
+        tmp_path = path + '.part.npz'
+        np.savez_compressed(tmp_path, labels=np.asarray(labels, dtype=np.uint8))
+        os.replace(tmp_path, path)
+        self.evict()
+
+    def evict(self):
+        """Remove the least recently used masks until the cache fits in max_bytes."""
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith('.npz') or name.endswith('.part.npz'):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.cache_dir, name))
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, name))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.cache_dir, name))
+            except FileNotFoundError:
+                pass
+            total -= size
@@ -3,39 +3,70 @@ This module requires the installation of lungmask
 pip install git+https://github.com/JoHof/lungmask
 """
 
-from glob import glob
 import logging
 import os
 import numpy as np
 from lungmask import mask, LMInferer
 from tqdm import tqdm
 import SimpleITK as sitk
+from covidlib.imagestore import ImageStore
+from covidlib.maskcache import lungmask_version
+from covidlib.segment import BatchSegmenter, onnx_predictor, torch_predictor
 
 logger = logging.getLogger()
 logger.setLevel(logging.CRITICAL)
 
+BACKENDS = ('torch', 'onnx')
+
+# slices per network call when the patients are segmented one at a time (lungmask default)
+DEFAULT_BATCH_SIZE = 20
+
 
 class MaskCreator:
     """Class to handle mask creation and storage in local memory."""
 
-    def __init__(self, base_dir, single_mode, st, ivd):
+    def __init__(self, base_dir, single_mode, st, ivd, store=None, batch_size=None,
+                 backend='torch', threads=None, fast=False, cache=None):
         """Constructor for the MaskCreator class.
         :param base_dir: Path to .nii CT
         :param single_mode: Flag to indicate if the code is running in single or multiple mode
         :param st: slice thickness. It is automatically casted to int
         :param ivd: Isotropic voxel dimension
+        :param store: ImageStore to read and write the images (default: on disk)
+        :param batch_size: if given, segment the patients together, with batches
+            of this many slices (see segment.BatchSegmenter)
+        :param backend: 'torch' (lungmask) or 'onnx' (ONNX Runtime on CPU)
+        :param threads: number of intra-op threads for the 'onnx' backend
+        :param fast: if True, run the int8 quantized network in ONNX Runtime
+            (see segment.quantize_onnx), whatever the backend
+        :param cache: MaskCache to reuse the masks of already segmented volumes (optional).
+            It is not used if the lungmask version is unknown
         """
 
+        if backend not in BACKENDS:
+            raise ValueError(f"Unknown backend {backend}, choose from {BACKENDS}")
+
         self.base_dir = base_dir
+        self.store = store if store is not None else ImageStore()
         self.ivd = ivd
         self.st = st
+        self.batch_size = batch_size
+        self.backend = backend
+        self.threads = threads
+        self.fast = fast
+        if cache is not None and lungmask_version() is None:
+            print("lungmask version unknown, the mask cache is disabled")
+            cache = None
+        self.cache = cache
+        # mask cache key of each CT still to be segmented (see use_cache)
+        self.cache_keys = {}
 
         if single_mode:
             self.pre_paths = [base_dir]
             self.nii_paths = [os.path.join(base_dir, f'CT_{st:.0f}mm.nii')]
         else:
-            self.pre_paths = glob(base_dir + '/*')
-            self.nii_paths = glob(base_dir + '/*' + f'/CT_{st:.0f}mm.nii')
+            self.pre_paths = self.store.glob(base_dir + '/*')
+            self.nii_paths = self.store.glob(base_dir + '/*' + f'/CT_{st:.0f}mm.nii')
 
         self.maskname =f'mask_R231CW_{self.st:.0f}mm'
 
@@ -44,19 +75,72 @@ class MaskCreator:
         """Execute main method of MaskCreator class.
         Produce masks and save them in local memory"""
 
+        nii_paths = self.nii_paths if self.cache is None else self.use_cache()
+        if not nii_paths:
+            return
+
+        if self.backend == 'onnx' or self.fast:
+            segmenter = BatchSegmenter(
+                onnx_predictor("R231CovidWeb", threads=self.threads, quantized=self.fast),
+                batch_size=self.batch_size or DEFAULT_BATCH_SIZE)
+        else:
+            inferer = LMInferer(modelname = "R231CovidWeb",  tqdm_disable = True)
+            #model = mask.get_model('unet', 'R231CovidWeb')
+            segmenter = BatchSegmenter(torch_predictor(inferer), batch_size=self.batch_size,
+                volume_postprocessing=inferer.volume_postprocessing) if self.batch_size else None
 
-        inferer = LMInferer(modelname = "R231CovidWeb",  tqdm_disable = True)
-        #model = mask.get_model('unet', 'R231CovidWeb')
+        if segmenter is not None:
+            for isoct_path, image, segm in tqdm(
+                segmenter.run(nii_paths, self.store.read_ct), total=len(nii_paths),
+                colour='MAGENTA', desc="Creating masks     "):
+                self.save(os.path.dirname(isoct_path), image, segm, self.cache_keys.get(isoct_path))
+            return
 
-        for pre_path, isoct_path in tqdm(
-            zip(self.pre_paths, self.nii_paths), total=len(self.pre_paths), colour='MAGENTA',
-            desc="Creating masks     "):
-            image = sitk.ReadImage(isoct_path)
+        for isoct_path in tqdm(nii_paths, colour='MAGENTA', desc="Creating masks     "):
+            image = self.store.read_ct(isoct_path)
             #segm = mask.apply(image, model)
-            segm = inferer.apply(image)
-            segm *= 10
-            result_out = sitk.GetImageFromArray(segm)
-            sitk.WriteImage(result_out, os.path.join(pre_path, self.maskname + '.nii'))
-            segm_one = 10*np.sign(segm)
-            result_out_one = sitk.GetImageFromArray(segm_one)
-            sitk.WriteImage(result_out_one, os.path.join(pre_path, self.maskname + "_bilat.nii"))
+            self.save(os.path.dirname(isoct_path), image, inferer.apply(image),
+                self.cache_keys.get(isoct_path))
+
+    def model_id(self):
+        """Name and version of the segmentation network, as used in the mask cache key."""
+        variant = 'onnx-int8' if self.fast else self.backend
+        return f"R231CovidWeb/{variant}/lungmask-{lungmask_version()}"
+
+    def use_cache(self):
+        """Save the masks found in the cache.
+        The key of each miss is kept in cache_keys, so that its mask is put
+        in the cache without hashing the volume again.
+        :return: paths of the CT volumes still to be segmented
+        """
+        misses = []
+        self.cache_keys = {}
+        for isoct_path in self.nii_paths:
+            image = self.store.read_ct(isoct_path)
+            key = self.cache.key(image, self.model_id())
+            segm = self.cache.get(key, image.GetSize()[::-1])
+            if segm is None:
+                misses.append(isoct_path)
+                self.cache_keys[isoct_path] = key
+            else:
+                self.save(os.path.dirname(isoct_path), image, segm)
+        return misses
+
+    def save(self, pre_path, image, segm, cache_key=None):
+        """Store the left/right and the bilateral masks of a patient.
+        :param pre_path: patient directory
+        :param image: CT image the mask was computed on
+        :param segm: lungmask label array (1 = right, 2 = left)
+        :param cache_key: if given, segm is also put in the mask cache under this key
+        """
+        if cache_key is not None:
+            self.cache.put(cache_key, segm)
+        segm = segm.astype(np.uint8)
+        segm *= 10
+        result_out = sitk.GetImageFromArray(segm)
+        result_out.CopyInformation(image)
+        self.store.write_labels(result_out, os.path.join(pre_path, self.maskname + '.nii'))
+        segm_one = 10*np.sign(segm)
+        result_out_one = sitk.GetImageFromArray(segm_one)
+        result_out_one.CopyInformation(image)
+        self.store.write_labels(result_out_one, os.path.join(pre_path, self.maskname + "_bilat.nii"))
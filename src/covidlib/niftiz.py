@@ -1,11 +1,15 @@
 """Module to convert a DICOM series into NIFTI (.nii) format."""
 
-import glob
 import logging
 import os
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pydicom
+import SimpleITK as sitk
 from nipype.interfaces.dcm2nii import Dcm2niix
 from tqdm import tqdm
-from covidlib.ctlibrary import dcmtagreader, WrongModalityError
+from covidlib.ctlibrary import dcmtagreader, series_files, series_fingerprint, WrongModalityError
+from covidlib.imagestore import ImageStore
 
 logger = logging.getLogger('nipype.interface')
 logger.setLevel(logging.CRITICAL)
@@ -13,21 +17,114 @@ logger.setLevel(logging.CRITICAL)
 logger2 = logging.getLogger('nipype.utils')
 logger2.setLevel(logging.CRITICAL)
 
+BACKENDS = ('dcm2niix', 'pydicom')
+
+
+def _read_slice(inputfile: str):
+    """Read and decode a single DICOM slice.
+    :param inputfile: path of the dicom file
+    :return: (dataset, HU pixel array), or None if the file has no image
+    """
+    data = pydicom.dcmread(inputfile, force=True)
+    if 'PixelData' not in data or 'ImagePositionPatient' not in data:
+        return None
+    slope = float(getattr(data, 'RescaleSlope', 1) or 1)
+    intercept = float(getattr(data, 'RescaleIntercept', 0) or 0)
+    pixels = data.pixel_array
+    if slope == int(slope) and intercept == int(intercept):
+        pixels = pixels.astype(np.int32) * int(slope) + int(intercept)
+    else:
+        pixels = pixels.astype(np.float32) * slope + intercept
+    return data, pixels
+
+
+def load_series(folder: str, out_path=None, workers=None) -> sitk.Image:
+    """Load a DICOM series in memory, without calling dcm2niix.
+    Slices are sorted along the slice normal (ImagePositionPatient),
+    rescale slope/intercept are applied and the pixel data are decoded
+    by a pool of threads.
+    The voxel layout is the same as a dcm2niix NIfTI read with SimpleITK:
+    rows are stored bottom-up, and the direction cosines account for it.
+
+    :param folder: path of dicom folder
+    :param out_path: if given, the volume is also written to this .nii path
+    :param workers: number of decoding threads (default: ThreadPoolExecutor default)
+    :return: SimpleITK image in HU: int16, or float32 if the rescaling is not integer
+        or the rescaled values do not fit in int16 (as dcm2niix, no value is clipped)
+    """
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        slices = [s for s in pool.map(_read_slice, series_files(folder)) if s is not None]
+    if not slices:
+        raise UnboundLocalError(f"No DICOM images found in {folder}")
+
+    # keep only the slices with the most common matrix size (drop localizers and the like)
+    shapes = [pixels.shape for _, pixels in slices]
+    main_shape = max(set(shapes), key=shapes.count)
+    slices = [s for s in slices if s[1].shape == main_shape]
+
+    orientation = np.array(slices[0][0].ImageOrientationPatient, dtype=float)
+    row_cos, col_cos = orientation[:3], orientation[3:]
+    normal = np.cross(row_cos, col_cos)
+
+    positions = np.array([np.dot(np.array(data.ImagePositionPatient, dtype=float), normal)
+                          for data, _ in slices])
+    order = np.argsort(positions, kind='stable')
+
+    int16 = np.iinfo(np.int16)
+    is_float = any(pixels.dtype == np.float32 or pixels.min() < int16.min or pixels.max() > int16.max
+                   for _, pixels in slices)
+    volume = np.empty((len(slices),) + main_shape, dtype=np.float32 if is_float else np.int16)
+    for k, i in enumerate(order):
+        volume[k] = slices[i][1][::-1, :]
+
+    first = slices[order[0]][0]
+    row_spacing, col_spacing = (float(sp) for sp in first.PixelSpacing)
+    if len(slices) > 1:
+        sp_z = float(np.median(np.diff(positions[order])))
+    else:
+        sp_z = float(getattr(first, 'SliceThickness', 1) or 1)
+
+    origin = np.array(first.ImagePositionPatient, dtype=float) + \
+        (main_shape[0] - 1) * row_spacing * col_cos
+    direction = np.stack([row_cos, -col_cos, normal], axis=1)
+
+    image = sitk.GetImageFromArray(volume)
+    image.SetSpacing((col_spacing, row_spacing, sp_z))
+    image.SetOrigin(tuple(origin))
+    image.SetDirection(tuple(direction.flatten()))
+
+    if out_path is not None:
+        sitk.WriteImage(image, out_path)
+    return image
+
 
 class Niftizator:
     """
     Converter from dicom series to nifti.
     """
 
-    def __init__(self, base_dir, single_mode: bool, target_dir_name="CT",):
+    def __init__(self, base_dir, single_mode: bool, target_dir_name="CT", index=None,
+                 backend='dcm2niix', incremental=False, store=None):
         """
         Constructor for the Niftizator class.
         :param base_dir: Path where to save .nii files
         :param single_mode: boolean flag to indicate if the pipeline is in single or multiple mode
         :param target_dir_name: name of the directory containing the .dcm slices
-        :param target_dir_name: name of the directory containing the .dcm slices
+        :param index: SeriesIndex where the converted series are registered (optional)
+        :param backend: 'dcm2niix' (external converter) or 'pydicom' (in-process loader)
+        :param incremental: if True, skip the series whose input did not change since
+            the last conversion (see series_fingerprint)
+        :param store: ImageStore where the pydicom backend puts the volumes (default: on disk)
         """
 
+        if backend not in BACKENDS:
+            raise ValueError(f"Unknown backend {backend}, choose from {BACKENDS}")
+
+        self.index = index
+        self.backend = backend
+        self.incremental = incremental
+        self.store = store if store is not None else ImageStore()
+
         if single_mode:
             self.base_dir = base_dir
             self.target_dir_name = target_dir_name
@@ -36,8 +133,8 @@ class Niftizator:
         else:
             self.base_dir = base_dir
             self.target_dir_name = target_dir_name
-            self.ct_paths = glob.glob(self.base_dir +  "/*/CT")
-            self.out_paths = glob.glob(self.base_dir + "/*/")
+            self.ct_paths = self.store.glob(self.base_dir +  "/*/CT")
+            self.out_paths = self.store.glob(self.base_dir + "/*/")
 
     def mod_check(self,):
         """Check if modality is CT, otherwise throw an exception"""
@@ -54,25 +151,52 @@ class Niftizator:
         for ct_path, out_dir in tqdm(zip(self.ct_paths, self.out_paths),
             total=len(self.ct_paths), colour='yellow', desc='Converting to nifti'):
 
+            if self.index is not None:
+                self.index.register(ct_path)
+
             out_path = os.path.join(out_dir, 'CT.nii')
+            fingerprint_path = os.path.join(out_dir, 'CT.fingerprint')
             nii_exists = os.path.exists(out_path)
             json_exists = os.path.exists(os.path.join(out_dir, 'CT.json'))
 
+            if self.incremental:
+                fingerprint = self.backend + ':' + series_fingerprint(ct_path)
+                if nii_exists and os.path.exists(fingerprint_path):
+                    with open(fingerprint_path, 'r', encoding='utf-8') as ffp:
+                        if ffp.read().strip() == fingerprint:
+                            continue
+
             if nii_exists:
                 os.remove(out_path)
             if json_exists:
                 os.remove(os.path.join(out_dir, 'CT.json'))
+            if os.path.exists(fingerprint_path):
+                os.remove(fingerprint_path)
 
-            converter = Dcm2niix()
-            converter.inputs.source_dir = ct_path
-            converter.inputs.compress = 'n'
-            converter.inputs.out_filename = 'CT'
-            converter.inputs.output_dir = out_dir
-            converter.inputs.merge_imgs = True
+            if self.backend == 'pydicom':
+                self.store.write_image(load_series(ct_path), out_path)
+            else:
+                self.run_dcm2niix(ct_path, out_dir)
+
+            if self.incremental and os.path.exists(out_path):
+                with open(fingerprint_path, 'w', encoding='utf-8') as ffp:
+                    ffp.write(fingerprint)
+
+    def run_dcm2niix(self, ct_path, out_dir):
+        """Convert a single series with the dcm2niix subprocess.
+        :param ct_path: path to the directory containing the .dcm slices
+        :param out_dir: directory where CT.nii and CT.json are written
+        """
+        converter = Dcm2niix()
+        converter.inputs.source_dir = ct_path
+        converter.inputs.compress = 'n'
+        converter.inputs.out_filename = 'CT'
+        converter.inputs.output_dir = out_dir
+        converter.inputs.merge_imgs = True
 
-            converter.run()
+        converter.run()
 
-            CT_eq_path = os.path.join(out_dir, 'CT_Eq_1.nii')
-            CT_eq_exist = os.path.exists(CT_eq_path)
-            if CT_eq_exist:
-                os.remove(CT_eq_path)
\ No newline at end of file
+        CT_eq_path = os.path.join(out_dir, 'CT_Eq_1.nii')
+        CT_eq_exist = os.path.exists(CT_eq_path)
+        if CT_eq_exist:
+            os.remove(CT_eq_path)
\ No newline at end of file
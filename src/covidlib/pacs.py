@@ -18,7 +18,8 @@ from pydicom.uid import ImplicitVRLittleEndian
 class DicomLoader():
     """Class to handle incoming communications with PACS"""
 
-    def __init__(self, ip_add, port, aetitle, patient_id, series_id, study_id, output_path):
+    def __init__(self, ip_add, port, aetitle, patient_id, series_id, study_id, output_path,
+                 index=None):
         """
         Constructor for the DicomLoader class.
 
@@ -29,6 +30,7 @@ class DicomLoader():
         :series_id: Series UID of the CT
         :study_id: Study UID of the CT
         :output_path: Path to results folder
+        :index: SeriesIndex where the downloaded series are registered (optional)
         """
 
         self.port = port
@@ -40,6 +42,7 @@ class DicomLoader():
         self.study_uid = study_id
         self.series_uid = series_id
         self.output_path = output_path
+        self.index = index
 
 
     def download(self,):
@@ -47,6 +50,7 @@ class DicomLoader():
         Download a CT series from a PACS node
         """
         #debug_logger()
+        stored_series = {}
 
         def handle_store(event):
             """Handle a C-STORE request event."""
@@ -64,6 +68,9 @@ class DicomLoader():
             dataset.save_as(os.path.join(target_dir, "CT", dataset.SOPInstanceUID  + '.dcm'),
                        write_like_original=False)
 
+            # Keep one header per series, it goes in the index once the transfer is over
+            stored_series.setdefault(os.path.join(target_dir, "CT"), dataset)
+
             # Return a 'Success' status
             return 0x0000
 
@@ -105,6 +112,10 @@ class DicomLoader():
         else:
             print('Association rejected, aborted or never connected')
 
+        if self.index is not None:
+            for folder, dataset in stored_series.items():
+                self.index.register(folder, header=dataset)
+
 
     def upload(self, files_to_send, our_aet= 'KOBE_CT'):
         """Upload encapsulated PDF reports to PACS
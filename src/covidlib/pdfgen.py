@@ -4,15 +4,15 @@ import csv
 import os
 import logging
 
-from glob import glob
 import pandas as pd
 import numpy as np
 import datetime
 
 from tqdm import tqdm
-import pydicom
 
-from covidlib.ctlibrary import change_keys, dcmtagreader
+from covidlib.ctlibrary import change_keys
+from covidlib.imagestore import ImageStore
+from covidlib.seriesindex import series_header
 from covidlib.pdfgraphics import PDF
 
 logger = logging.getLogger('imageio')
@@ -24,7 +24,7 @@ class PDFHandler():
 
     def __init__(self, base_dir, dcm_dir, data_ref, out_dir,
                  data_clinical, data_rad, parts,
-                single_mode, st, ivd, tag, history_path, ad):
+                single_mode, st, ivd, tag, history_path, ad, index=None, store=None):
         """Constructor for the PDFHandler class.
 
         :param base_dir: path to the data base directory
@@ -40,9 +40,13 @@ class PDFHandler():
         :param tag: Patient tag
         :param history_path: Path to history file
         :param ad: Analysis date and time
+        :param index: SeriesIndex to read the DICOM tags from (optional)
+        :param store: ImageStore to read the images from (default: on disk)
         """
 
         self.base_dir = base_dir
+        self.index = index
+        self.store = store if store is not None else ImageStore()
         self.dcm_dir = dcm_dir
         self.out_dir = out_dir
         self.parts = parts
@@ -60,11 +64,11 @@ class PDFHandler():
             self.mask_paths = [os.path.join(base_dir, f'mask_R231CW_{st:.0f}mm.nii')]
             self.mask_bilat_paths = [os.path.join(base_dir, f'mask_R231CW_{st:.0f}mm_bilat.nii')]
         else:
-            self.patient_paths = glob(base_dir + '/*/')
-            self.dcm_paths = glob(base_dir + '/*/' + self.dcm_dir + '/')
-            self.nii_paths = glob(base_dir + f'/*/CT_{st:.0f}mm.nii')
-            self.mask_bilat_paths = glob(base_dir + f'/*/mask_R231CW_{st:.0f}mm_bilat.nii')
-            self.mask_paths = glob(base_dir + f'/*/mask_R231CW_{st:.0f}mm.nii')
+            self.patient_paths = self.store.glob(base_dir + '/*/')
+            self.dcm_paths = self.store.glob(base_dir + '/*/' + self.dcm_dir + '/')
+            self.nii_paths = self.store.glob(base_dir + f'/*/CT_{st:.0f}mm.nii')
+            self.mask_bilat_paths = self.store.glob(base_dir + f'/*/mask_R231CW_{st:.0f}mm_bilat.nii')
+            self.mask_paths = self.store.glob(base_dir + f'/*/mask_R231CW_{st:.0f}mm.nii')
 
         self.data_clinical = data_clinical
         self.data = pd.merge(data_ref, data_clinical, on='AccessionNumber', how='inner')
@@ -82,7 +86,7 @@ class PDFHandler():
 
             # general features from DICOM file
             try:
-                searchtag = dcmtagreader(dcm_path)
+                searchtag = series_header(dcm_path, self.index)
             except UnboundLocalError:
                 logging.error("There was a problem while looking for DICOM tags. Exiting")
                 return
@@ -189,6 +193,7 @@ class PDFHandler():
                                       parts = self.parts,
                                       rsc_params = rescale_params,
                                       ad = self.ad,
+                                      store = self.store,
                                       **dicom_args,
                                       )
 
@@ -222,7 +227,8 @@ class PDFHandler():
 
     def encapsulate(self,):
         """Encapsulate dicom fields in a pdf file.
-        Dicom fields are taken from the first file in the series dir.
+        Dicom fields are taken from the cached series header,
+        the first file in the series dir is used as template.
         """
 
         encaps_today = []
@@ -230,7 +236,7 @@ class PDFHandler():
         for dcm_path, pdf_name in zip(self.dcm_paths, self.out_pdf_names):
             dcm_ref = os.path.join(dcm_path ,os.listdir(dcm_path)[0])
             dcm_ref = (os.path.abspath(dcm_ref))
-            ds = pydicom.dcmread(dcm_ref)
+            ds = series_header(dcm_path, self.index)
 
             if pdf_name[-4:]=='.pdf':
                 pdf_name = pdf_name[:-4]
@@ -11,12 +11,16 @@ from PIL import Image, ImageEnhance
 import SimpleITK as sitk
 import imageio
 import covidlib
+from covidlib.imagestore import ImageStore
 
-def make_nii_slices(ct_scan, mask):
+def make_nii_slices(ct_scan, mask, store=None):
     """
     Takes .nii paths for ct and mask, return a slice in the middle
+    :param store: ImageStore to read the images from (default: on disk)
     """
-    image, mask = sitk.ReadImage(ct_scan, sitk.sitkInt32), sitk.ReadImage(mask, sitk.sitkInt32)
+    if store is None:
+        store = ImageStore()
+    image, mask = store.read_image(ct_scan, sitk.sitkInt32), store.read_image(mask, sitk.sitkInt32)
 
     mask_rgb       = sitk.ScalarToRGBColormap(mask)
     image_rgb         = sitk.ScalarToRGBColormap(image)
@@ -118,7 +122,7 @@ class PDF(fpdf.FPDF):
 
 
     def run_single(self, nii, mask, out_name, out_dir,
-        parts, rsc_params, ad, **dcm_args):
+        parts, rsc_params, ad, store=None, **dcm_args):
 
         """Make body for one PDF report"""
         try:
@@ -189,7 +193,7 @@ class PDF(fpdf.FPDF):
         self.set_font('Arial', 'B', 15)
         self.cell(180, 70, 'AUTOMATIC SEGMENTATION EVALUATION', 0, 0, 'C')
 
-        slices_to_delete = make_nii_slices(nii, mask)
+        slices_to_delete = make_nii_slices(nii, mask, store)
 
         xpos = [10, 75, 140] * 4
         y_pos = [35] * 3 + [100] * 3 + [165] * 3 + [230] * 3
@@ -2,23 +2,53 @@
 on bilateral, left/right, upper/lower,
 ventral/dorsal lungs."""
 
-import glob
 import os
 import csv
 import pathlib
 import SimpleITK as sitk
 import numpy as np
-import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
 from tqdm import tqdm
+from concurrent.futures import ProcessPoolExecutor
 import scipy
-from scipy import stats
 import pandas as pd
 from scipy.optimize import curve_fit
-from covidlib.ctlibrary import dcmtagreader
-from datetime import datetime
+from covidlib.ctlibrary import CT_PIXEL_TYPE, LABEL_PIXEL_TYPE, crop_image, read_crop_box
+from covidlib.imagestore import ImageStore, VolumeSlabs, slab_height
+from covidlib.seriesindex import series_header
 
 # = ['bilat', 'left', 'right','upper', 'lower', 'ventral', 'dorsal']
-#analysis_date_for_image = datetime.now().strftime("%Y%m%d_%H%M%S")
+
+# Lung ROIs: suffix of the mask file and mask labels belonging to the ROI.
+# The sub-ROI labels are defined in Rescaler.make_subroi_mask
+REGIONS = {
+    'bilat':         ('_bilat', (10,)),
+    'right':         ('',       (10,)),
+    'left':          ('',       (20,)),
+    'lower':         ('_mixed', (11, 21)),
+    'upper':         ('_mixed', (22, 42)),
+    'dorsal':        ('_mixed', (11, 22)),
+    'ventral':       ('_mixed', (21, 42)),
+    'lower_dorsal':  ('_mixed', (11,)),
+    'lower_ventral': ('_mixed', (21,)),
+    'upper_dorsal':  ('_mixed', (22,)),
+    'upper_ventral': ('_mixed', (42,)),
+}
+
+# HU range of the QCT histograms: one bin per HU, and the 5 HU bins of the report
+HU_MIN, HU_MAX = -1020, 180
+N_HU = HU_MAX - HU_MIN + 1
+N_BINS, BIN_WIDTH = 240, 5
+
+
+def _mask_levels():
+    """Labels used by the regions, for each mask file suffix."""
+    levels = {}
+    for suffix, labels in REGIONS.values():
+        levels.setdefault(suffix, set()).update(labels)
+    return {suffix: sorted(labels) for suffix, labels in levels.items()}
+
+MASK_LEVELS = _mask_levels()
 
 def prod(tup1: tuple, tup2:tuple)-> float :
     """
@@ -39,13 +69,306 @@ def gauss(x, *p):
     return norm_coeff*np.exp(-(x-mea)**2/(2.*sigma**2))
 
 
+# Gaussian fit of the healthy peak: fit range, initial guess, bounds and acceptance range
+FIT_RANGE = (-950, -700)
+FIT_P0 = np.array([0.001, -800, 120])
+FIT_BOUNDS = (np.array([0.00001, -1000, 5]), np.array([1, -600, 350]))
+MU_RANGE, SIGMA_RANGE = (-950, -750), (5, 150)
+
+
+def _fit_windows(counts, bins_med):
+    """
+    Points used for the gaussian fit of each histogram: the rising edge of the
+    peak in the FIT_RANGE HU range, up to 7 bins after the first stationary
+    point of the smoothed histogram.
+    :return: (x_range, y_range, n_points): bin centers and counts in FIT_RANGE,
+        and the number of points to fit for each histogram
+    """
+    left_lim, right_lim = FIT_RANGE
+    in_range = (bins_med > left_lim) & (bins_med < right_lim)
+    x_range, y_range = bins_med[in_range], counts[:, in_range]
+
+    y_smooth = scipy.signal.medfilt(y_range, kernel_size=(1, 7))
+    grads = np.gradient(y_smooth, axis=1)
+    turning = grads[:, :-1] * grads[:, 1:] <= 0
+    i_max = np.where(turning.any(axis=1), np.argmax(turning, axis=1), 0)
+    return x_range, y_range, np.minimum(i_max + 7, len(x_range))
+
+
+def _log_parabola_guess(x, y, weights):
+    """
+    Closed-form gaussian parameters of each histogram, from a weighted least squares
+    fit of a parabola to log(y) (weights y^2, so that the tails count less).
+    The fixed FIT_P0 is used where the parabola is not a valid gaussian.
+    :return: (n, 3) array of (A, mu, sigma), within FIT_BOUNDS
+    """
+    positive = weights * (y > 0)
+    log_y = np.log(np.where(positive, y, 1.))
+    w_fit = positive * y**2
+    # center and scale x, to keep the normal equations well conditioned
+    x_0, x_s = x.mean(), x.std()
+    t = (x - x_0) / x_s
+    basis = np.stack([np.ones_like(t), t, t**2], axis=-1)
+    normal = np.einsum('nk,ki,kj->nij', w_fit, basis, basis)
+    rhs = np.einsum('nk,ki,nk->ni', w_fit, basis, log_y)
+
+    guess = np.tile(FIT_P0, (len(y), 1)).astype(np.float64)
+    valid = (positive.sum(axis=1) >= 3) & (np.abs(np.linalg.det(normal)) > 1e-12)
+    if valid.any():
+        coef = np.linalg.solve(normal[valid], rhs[valid][..., None])[..., 0]
+        c_0, c_1, c_2 = coef.T
+        with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+            sigma = x_s * np.sqrt(-1 / (2 * c_2))
+            mea = x_0 - x_s * c_1 / (2 * c_2)
+            norm_coeff = np.exp(c_0 - c_1**2 / (4 * c_2))
+        params = np.stack([norm_coeff, mea, sigma], axis=-1)
+        good = (c_2 < 0) & np.isfinite(params).all(axis=1) & \
+            (params > FIT_BOUNDS[0]).all(axis=1) & (params < FIT_BOUNDS[1]).all(axis=1)
+        rows = np.flatnonzero(valid)[good]
+        guess[rows] = params[good]
+    return guess
+
+
+def _batched_least_squares(x, y, weights, params, max_iter=200, tol=1e-12):
+    """
+    Levenberg-Marquardt least squares fit of a gaussian to several histograms at once,
+    with the parameters projected on FIT_BOUNDS.
+    :param x: (k,) bin centers
+    :param y: (n, k) counts
+    :param weights: (n, k) 1 for the points to fit, 0 otherwise
+    :param params: (n, 3) initial (A, mu, sigma)
+    :return: (params, converged): a fit is not converged if it stopped on a bound
+        or after max_iter iterations
+    """
+    lower, upper = FIT_BOUNDS
+
+    def residuals(p):
+        return weights * (gauss(x, *p.T[..., None]) - y)
+
+    params = params.copy()
+    res = residuals(params)
+    cost = np.sum(res**2, axis=1)
+    damping = np.full(len(y), 1e-3)
+    done = np.zeros(len(y), dtype=bool)
+
+    for _ in range(max_iter):
+        if done.all():
+            break
+        act = np.flatnonzero(~done)
+        norm_coeff, mea, sigma = params[act].T[..., None]
+        expo = np.exp(-(x - mea)**2 / (2 * sigma**2))
+        jac = weights[act, :, None] * np.stack([expo, norm_coeff * expo * (x - mea) / sigma**2,
+            norm_coeff * expo * (x - mea)**2 / sigma**3], axis=-1)
+        jtj = np.einsum('nki,nkj->nij', jac, jac)
+        grad = np.einsum('nki,nk->ni', jac, res[act])
+        diag = np.maximum(np.diagonal(jtj, axis1=1, axis2=2), np.finfo(float).tiny)
+        hess = jtj + damping[act, None, None] * diag[:, None, :] * np.eye(3)
+        step = np.linalg.solve(hess, -grad[..., None])[..., 0]
+
+        trial = np.clip(params[act] + step, lower, upper)
+        trial_res = weights[act] * (gauss(x, *trial.T[..., None]) - y[act])
+        trial_cost = np.sum(trial_res**2, axis=1)
+
+        better = trial_cost < cost[act]
+        moved = np.abs(trial - params[act]) <= tol * (np.abs(params[act]) + tol)
+        small = better & ((cost[act] - trial_cost) <= tol * cost[act])
+        improved = act[better]
+        params[improved], res[improved], cost[improved] = trial[better], trial_res[better], trial_cost[better]
+        damping[act] = np.where(better, damping[act] / 10, damping[act] * 10)
+        done[act[small | moved.all(axis=1) | (damping[act] > 1e12)]] = True
+
+    on_bound = np.isclose(params, lower, rtol=1e-9, atol=0).any(axis=1) | \
+        np.isclose(params, upper, rtol=1e-9, atol=0).any(axis=1)
+    return params, done & ~on_bound
+
+
+def fit_healthy_peaks(counts, bins_med):
+    """
+    Gaussian fit of the healthy lung peak of several density histograms.
+    The fit uses the rising edge of the peak in the (-950, -700) HU range.
+    The initial parameters come from a log-parabola fit, and all the histograms
+    are refined together by a vectorized least squares; the fits which do not
+    converge this way are repeated one by one with scipy curve_fit.
+
+    :param counts: (n, n_bins) histogram counts (density)
+    :param bins_med: bin centers
+    :return: list of (coeff, x_tofit, wave) for each histogram: the (A, mu, sigma)
+        parameters, the bin centers used for the fit and the WAVE (area of the gaussian
+        over the histogram), which is 'n.a.' if the fit is not acceptable
+    """
+    counts = np.atleast_2d(np.asarray(counts, dtype=np.float64))
+    bins_med = np.asarray(bins_med, dtype=np.float64)
+    if len(counts) == 0:
+        return []
+    finite = np.isfinite(counts).all(axis=1)
+    counts_fit = np.where(finite[:, None], counts, 0.)
+
+    x_range, y_range, n_points = _fit_windows(counts_fit, bins_med)
+    weights = (np.arange(len(x_range)) < n_points[:, None]).astype(np.float64)
+
+    guess = _log_parabola_guess(x_range, y_range, weights)
+    coeffs, converged = _batched_least_squares(x_range, y_range, weights, guess)
+
+    results = []
+    for i, coeff in enumerate(coeffs):
+        x_tofit = x_range[:n_points[i]]
+        if not finite[i]:
+            results.append((np.full(3, np.nan), x_tofit, 'n.a.'))
+            continue
+        if not converged[i]:
+            try:
+                coeff, _ = curve_fit(gauss, x_tofit, y_range[i, :n_points[i]],
+                    p0=guess[i], maxfev=10000, bounds=FIT_BOUNDS)
+            except RuntimeError:
+                results.append((coeff, x_tofit, 'n.a.'))
+                continue
+
+        if coeff[1]<MU_RANGE[0] or coeff[1]>MU_RANGE[1] or coeff[2]<SIGMA_RANGE[0] or coeff[2]>SIGMA_RANGE[1]:
+            results.append((coeff, x_tofit, 'n.a.'))
+            continue
+
+        wave = np.sum(gauss(bins_med, *coeff))/np.sum(counts[i])
+        results.append((coeff, x_tofit, np.round(wave, 3)))
+    return results
+
+
+def fit_healthy_peak(counts, bins_med):
+    """
+    Gaussian fit of the healthy lung peak of a density histogram (see fit_healthy_peaks).
+
+    :param counts: histogram counts (density)
+    :param bins_med: bin centers
+    :return: (coeff, x_tofit, wave)
+    """
+    return fit_healthy_peaks(np.asarray(counts)[None], bins_med)[0]
+
+
+def region_histograms(image_arr, masks, parts):
+    """
+    One-HU histograms of several lung regions, with a single bincount pass.
+    Every voxel gets a composite code, which combines its label in each mask
+    file; the (code, HU) pairs are counted once and each region sums the
+    rows of the codes it contains.
+
+    :param image_arr: integer HU numpy array
+    :param masks: dict mask file suffix -> uint8 label array, for the suffixes used by parts
+    :param parts: region names (keys of REGIONS)
+    :return: dict region -> (hist, n_voxels). hist has N_HU bins, from HU_MIN to HU_MAX;
+        n_voxels counts all the voxels of the region, also outside the HU range
+    """
+    suffixes = sorted({REGIONS[part][0] for part in parts})
+    code = np.zeros(image_arr.shape, dtype=np.int32)
+    radix, digits = 1, {}
+    for suffix in suffixes:
+        levels = MASK_LEVELS[suffix]
+        lut = np.zeros(256, dtype=np.int32)
+        lut[levels] = np.arange(1, len(levels) + 1)
+        code += lut[masks[suffix]] * radix
+        digits[suffix] = (radix, len(levels) + 1)
+        radix *= len(levels) + 1
+
+    inside = code > 0
+    codes, hu = code[inside], image_arr[inside].astype(np.int32)
+    n_by_code = np.bincount(codes, minlength=radix)
+    in_range = (hu >= HU_MIN) & (hu <= HU_MAX)
+    hist = np.bincount(codes[in_range] * N_HU + (hu[in_range] - HU_MIN),
+        minlength=radix * N_HU).reshape(radix, N_HU)
+
+    all_codes = np.arange(radix)
+    result = {}
+    for part in parts:
+        suffix, labels = REGIONS[part]
+        step, base = digits[suffix]
+        member = np.isin((all_codes // step) % base,
+            [MASK_LEVELS[suffix].index(label) + 1 for label in labels])
+        result[part] = hist[member].sum(axis=0), int(n_by_code[member].sum())
+    return result
+
+
+def histogram_stats(hist):
+    """Mean, std, skewness and kurtosis (Fisher, biased, as scipy.stats)
+    of the values counted in a one-HU histogram."""
+    values = np.arange(HU_MIN, HU_MAX + 1, dtype=np.float64)
+    n_values = hist.sum()
+    mean = np.dot(hist, values) / n_values
+    dev = values - mean
+    m_2, m_3, m_4 = (np.dot(hist, dev**k) / n_values for k in (2, 3, 4))
+    return mean, np.sqrt(m_2), m_3 / m_2**1.5, m_4 / m_2**2 - 3
+
+
+def coarse_histogram(hist):
+    """Density histogram with N_BINS bins of BIN_WIDTH HU from a one-HU histogram.
+    It is the same as numpy/pyplot histogram(bins=240, range=(-1020, 180), density=True):
+    the last bin also holds the values equal to HU_MAX.
+    :return: (counts, bin edges)
+    """
+    counts = hist[:N_BINS * BIN_WIDTH].reshape(N_BINS, BIN_WIDTH).sum(axis=1)
+    counts[-1] += hist[N_BINS * BIN_WIDTH:].sum()
+    bins = np.linspace(HU_MIN, HU_MAX, N_BINS + 1)
+    return counts / (counts.sum() * BIN_WIDTH), bins
+
+
+def band_fraction(counts, bins_med, low, high, closed=False):
+    """Fraction of the histogram with bin centers in [low, high) ([low, high] if closed)."""
+    upper = bins_med <= high if closed else bins_med < high
+    return np.sum(counts[(bins_med >= low) & upper]) / np.sum(counts)
+
+
+def plot_histogram(path, part, counts, bins, coeff=None, x_tofit=None, ill_curve=None):
+    """
+    Save the figure of a QCT histogram with its gaussian fit.
+    The figure is drawn with the Agg canvas, without pyplot, so that
+    it can be rendered in a worker process.
+    :param path: path of the PNG file
+    :param part: lung ROI name, for the title
+    :param counts: density histogram counts
+    :param bins: bin edges
+    :param coeff: (A, mu, sigma) of the accepted gaussian fit, or None
+    :param x_tofit: bin centers used for the fit
+    :param ill_curve: ill curve (histogram minus gaussian fit)
+    """
+    fig = Figure()
+    ax = fig.subplots()
+    bins_med = bins[:-1] + 2.5
+    # one filled step patch instead of a bar per bin: same picture, much faster to draw
+    ax.stairs(counts, bins, fill=True, alpha=0.5)
+
+    if coeff is not None:
+        ax.plot(x_tofit, gauss(x_tofit, *coeff),linestyle= '--',color='orange',
+            label='data for Gaussian Fit', linewidth= 4.0)
+        ax.plot(bins_med, gauss(bins_med, *coeff), color= 'crimson', label='Gaussian fit')
+        ax.plot(bins_med, ill_curve, color='purple', label='ill curve')
+
+    ax.axvline(x=-950, color='green', linestyle='dotted')
+    ax.axvline(x=-700, color='green', label='WAVE th range', linestyle='dotted')
+    ax.legend(loc='upper right')
+    ax.set_title(f"{part} lung [HU]")
+    fig.savefig(path)
+
+
+def plot_histograms(figures, workers=None):
+    """
+    Save several histogram figures in parallel (see plot_histogram).
+    :param figures: list of tuples of plot_histogram arguments
+    :param workers: number of processes (default: number of CPUs); 1 to plot in this process
+    """
+    if workers == 1 or len(figures) <= 1:
+        for figure in figures:
+            plot_histogram(*figure)
+        return
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for future in [pool.submit(plot_histogram, *figure) for figure in figures]:
+            future.result()
+
+
 class QCT():
     """
     Object to perform QCT analysis with clinical features
     on a .nii {SLICE_THICKNESS}mm CT scan with mask
     """
 
-    def __init__(self, base_dir, parts, out_dir, single_mode, st, ad):
+    def __init__(self, base_dir, parts, out_dir, single_mode, st, ad, index=None, store=None,
+                 crop=False, plots=True, plot_workers=None, memory_budget=None):
         """
         Constructor for the QCT class.
         :param base_dir: path to patient base directory
@@ -54,9 +377,23 @@ class QCT():
         :param single_mode: Boolean flag to activate single mode
         :param st: Slice thickness
         :param ad: Analysis date and time
+        :param index: SeriesIndex to read the DICOM tags from (optional)
+        :param store: ImageStore to read the images from (default: on disk)
+        :param crop: if True, work on the lung bounding box (see Rescaler.make_crop_box)
+        :param plots: if True, save the histogram figures after the features (see render_histograms)
+        :param plot_workers: number of processes to render the figures (default: number of CPUs)
+        :param memory_budget: if given, the histograms are accumulated over z-slabs of the
+            images, so that the working arrays take about this many MB (default: whole volumes)
         """
 
         self.base_dir = base_dir
+        self.index = index
+        self.store = store if store is not None else ImageStore()
+        self.crop = crop
+        self.plots = plots
+        self.plot_workers = plot_workers
+        self.memory_budget = None if memory_budget is None else memory_budget * 2**20
+        self.figures = []
         self.out_dir = out_dir
         self.parts = parts
         self.st = st
@@ -67,13 +404,60 @@ class QCT():
             self.dcmpaths = [os.path.join(base_dir, "CT")]
             self.patient_paths = [base_dir]
         else:
-            self.ct3_paths = glob.glob(base_dir + f"/*/CT_{st:.0f}mm.nii")
-            self.dcmpaths = glob.glob(base_dir + "/*/CT/")
-            self.patient_paths = glob.glob(base_dir + "/*/")
+            self.ct3_paths = self.store.glob(base_dir + f"/*/CT_{st:.0f}mm.nii")
+            self.dcmpaths = self.store.glob(base_dir + "/*/CT/")
+            self.patient_paths = self.store.glob(base_dir + "/*/")
 
         assert len(self.ct3_paths) == len(self.dcmpaths) == len (self.patient_paths) , "Wrong path length"
 
 
+    def patient_histograms(self, ct_3m, patient_path):
+        """
+        Histograms of all the regions of a patient (see region_histograms).
+        The CT and each mask file are read once, whole or a z-slab at a time
+        with a memory budget.
+        :param ct_3m: path of the CT_{st}mm image
+        :param patient_path: patient directory
+        """
+        box = read_crop_box(patient_path) if self.crop else None
+        mask_paths = {suffix: os.path.join(patient_path, f'mask_R231CW_{self.st:.0f}mm{suffix}.nii')
+            for suffix in sorted({REGIONS[part][0] for part in self.parts})}
+        if self.memory_budget is not None:
+            return self.patient_histograms_slabs(ct_3m, mask_paths, box)
+
+        images = {'CT': self.store.read_ct(ct_3m)}
+        for suffix, mask_path in mask_paths.items():
+            images[suffix] = self.store.read_labels(mask_path)
+        if box is not None:
+            images = {name: crop_image(image, box) for name, image in images.items()}
+        arrays = {name: sitk.GetArrayFromImage(image) for name, image in images.items()}
+
+        return region_histograms(arrays.pop('CT'), arrays, self.parts)
+
+    def patient_histograms_slabs(self, ct_3m, mask_paths, box=None):
+        """
+        Histograms of all the regions of a patient, accumulated over z-slabs
+        that fit in memory_budget (see patient_histograms).
+        :param ct_3m: path of the CT_{st}mm image
+        :param mask_paths: dict mask file suffix -> path
+        :param box: crop box (see Rescaler.make_crop_box)
+        """
+        volumes = {'CT': VolumeSlabs(self.store, ct_3m, CT_PIXEL_TYPE, box)}
+        for suffix, mask_path in mask_paths.items():
+            volumes[suffix] = VolumeSlabs(self.store, mask_path, LABEL_PIXEL_TYPE, box)
+        depth, n_y, n_x = volumes['CT'].shape
+        first, last = (0, depth) if box is None else \
+            (box['index'][2], box['index'][2] + box['size'][2])
+
+        # int16 CT, uint8 masks, and the int32 codes and HU of region_histograms
+        slab = slab_height(self.memory_budget, n_y * n_x * (2 + len(mask_paths) + 16))
+        totals = {part: (np.zeros(N_HU, dtype=np.int64), 0) for part in self.parts}
+        for start in range(first, last, slab):
+            arrays = {name: volume[start:min(start + slab, last)] for name, volume in volumes.items()}
+            for part, (hist, n_voxels) in region_histograms(arrays.pop('CT'), arrays, self.parts).items():
+                totals[part] = (totals[part][0] + hist, totals[part][1] + n_voxels)
+        return totals
+
     def run(self,):
         """
         Extract clinical features from histogram of voxel intensity.
@@ -82,194 +466,120 @@ class QCT():
         - Mean, std, kurtosis, skewness
         - Percentiles
         - WAVE (Area of gaussian fit), WAVE.th
+        Each patient is loaded once and all the regions are computed from memory;
+        the gaussian fits of all the regions of all the patients are done together
+        (see fit_healthy_peaks). The rows are written region by region.
+        The histogram figures are rendered afterwards, if plots is True.
+        :return: DataFrame of the clinical features
         """
-        features_df = pd.DataFrame()
-        with open(os.path.join(self.out_dir, 'clinical_features.csv'), 'w', encoding='utf-8') as fall:
-            fall_wr = csv.writer(fall, delimiter='\t')
-            plt.figure()
-
-            pbar = tqdm(total=len(self.parts)*len(self.ct3_paths), desc='Clinical features  ', colour='cyan')
+        for part in self.parts:
+            if part not in REGIONS:
+                raise NotImplementedError(f"Part {part} not implemented")
+
+        patients = []
+        pbar = tqdm(total=len(self.parts)*len(self.ct3_paths), desc='Clinical features  ', colour='cyan')
+        for ct_3m, dcmpath, patient_path in zip(self.ct3_paths,self.dcmpaths, self.patient_paths):
+            searchtag = series_header(dcmpath, self.index)
+            accnum = searchtag[0x008, 0x0050].value
+            try:
+                seriesDescription = str(searchtag[0x0008, 0x103e].value)
+                seriesDescription = seriesDescription.replace(' ', '').replace(',', '').replace('(', '').replace(')', '')
+            except:
+                seriesDescription = 'NA'
+
+            ct_nii_path = os.path.join(pathlib.Path(ct_3m).parent.absolute(), "CT.nii")
+            _, spacing, _, _ = self.store.geometry(ct_nii_path)
+
+            patients.append((accnum, seriesDescription, spacing,
+                self.patient_histograms(ct_3m, patient_path)))
+            pbar.update(len(self.parts))
+
+        # GAUSSIAN FIT of all the regions of all the patients at once #
+        bins = np.linspace(HU_MIN, HU_MAX, N_BINS + 1)
+        bins_med = bins[:-1] + 2.5
+        densities = {(i_pat, part): coarse_histogram(histograms[part][0])[0]
+            for i_pat, (_, _, _, histograms) in enumerate(patients) for part in self.parts}
+        fits = dict(zip(densities, fit_healthy_peaks(
+            np.array(list(densities.values())).reshape(len(densities), N_BINS), bins_med)))
+
+        rows = {part: [] for part in self.parts}
+        self.figures = []
+
+        for i_pat, (accnum, seriesDescription, spacing, histograms) in enumerate(patients):
             for part in self.parts:
-                for ct_3m, dcmpath, patient_path in zip(self.ct3_paths,self.dcmpaths, self.patient_paths):
-                    plt.clf()
-                    searchtag = dcmtagreader(dcmpath)
-                    accnum = searchtag[0x008, 0x0050].value
-
-                    if part=='bilat':
-                        maskpath = os.path.join(patient_path, f'mask_R231CW_{self.st:.0f}mm_bilat.nii')
-                    elif part in ('lower', 'upper'):
-                        maskpath = os.path.join(patient_path, f'mask_R231CW_{self.st:.0f}mm_upper.nii')
-                    elif part in ('left', 'right'):
-                        maskpath = os.path.join(patient_path, f'mask_R231CW_{self.st:.0f}mm.nii')
-                    elif part in ('ventral', 'dorsal'):
-                        maskpath = os.path.join(patient_path, f'mask_R231CW_{self.st:.0f}mm_ventral.nii')
-                    elif part in ['upper_ventral', 'upper_dorsal', 'lower_ventral', 'lower_dorsal']:
-                        maskpath = os.path.join(patient_path, f'mask_R231CW_{self.st:.0f}mm_mixed.nii')
-                    else:
-                        raise Exception(f"Part {part} not implemented")
-
-                    image, mask = sitk.ReadImage(ct_3m), sitk.ReadImage(maskpath)
-                    image_arr, mask_arr = sitk.GetArrayFromImage(image), sitk.GetArrayFromImage(mask)
-
-                    if part in ['bilat' ,'right', 'dorsal', 'lower' ]:
-                        grey_pixels = image_arr[mask_arr==10]
-                        mask_arr = mask_arr[mask_arr==10]
-                        mask_arr = np.sign(mask_arr)
-                    elif part in ['left', 'ventral', 'upper']:
-                        grey_pixels = image_arr[mask_arr==20]
-                        mask_arr = mask_arr[mask_arr==20]
-                        mask_arr = np.sign(mask_arr)
-                    elif part=='upper_ventral':
-                        grey_pixels = image_arr[mask_arr==42]
-                        mask_arr = mask_arr[mask_arr==42]
-                        mask_arr = np.sign(mask_arr)
-                    elif part=='upper_dorsal':
-                        grey_pixels = image_arr[mask_arr==22]
-                        mask_arr = mask_arr[mask_arr==22]
-                        mask_arr = np.sign(mask_arr)
-                    elif part=='lower_dorsal':
-                        grey_pixels = image_arr[mask_arr==11]
-                        mask_arr = mask_arr[mask_arr==11]
-                        mask_arr = np.sign(mask_arr)
-                    elif part=='lower_ventral':
-                        grey_pixels = image_arr[mask_arr==21]
-                        mask_arr = mask_arr[mask_arr==21]
-                        mask_arr = np.sign(mask_arr)
-                    else:
-                        raise NotImplementedError(f"Part {part} not implemented")
-
-                    ct_nii_path = os.path.join(pathlib.Path(ct_3m).parent.absolute(), "CT.nii")
-
-                    ctn = sitk.ReadImage(ct_nii_path)
-                    spacing = ctn.GetSpacing()
-                    volume = spacing[0]*spacing[1]* float(self.st) * (np.sum(mask_arr))
-
-                    grey_pixels = grey_pixels[grey_pixels<=180]
-                    grey_pixels = grey_pixels[grey_pixels>=-1020]
-
-                    ave = np.mean(grey_pixels)
-                    std = np.std(grey_pixels)
-                    skew, kurt = stats.skew(grey_pixels), stats.kurtosis(grey_pixels)
-
-                    # GAUSSIAN FIT #
-                    data = plt.hist(grey_pixels, bins=240, range=(-1020, 180), density=True, alpha=0.5)     
-                    counts = np.array(data[0])
-                    bins = np.array(data[1])
-
-                    bins_med = bins[:-1] + 2.5
-                    assert len(counts)==len(bins_med), "Something went wrong with the histogram"
-
-                    # Filter on range
-
-                    left_lim, right_lim = -950, -700
-                    x_range = [x for x in bins_med if left_lim < x < right_lim]
-                    y_range = [y for x,y in zip(bins_med, counts) if left_lim < x < right_lim]
-
-                    assert len(x_range)==len(y_range), "Something went wrong with cutting the histogram"
-
-                    i_max = np.argmax(y_range)
-                    y_smooth = scipy.signal.medfilt(y_range, kernel_size=7)
-                    grads = np.gradient(y_smooth)
-
-                    i_max = 0
-
-                    for i in range(len(grads)-1):
-                        if grads[i]*grads[i+1] <= 0:
-                            i_max = i
-                            break
-
-                    i_right = i_max + 7
-                    y_tofit = y_range[0:i_right]
-                    x_tofit = x_range[0:i_right]
-
-                    params_0 = [0.001, -800, 120]
-
-                    coeff, _ = curve_fit(gauss, x_tofit, y_tofit,
-                        p0=params_0, maxfev=10000,
-                        bounds=([0.00001, -1000, 5], [1, -600, 350]))
-
-                    if coeff[1]<-950 or coeff[1]>-750 or coeff[2]<5 or coeff[2]>150:
-                        wave = 'n.a.'
-                        #ill_curve=counts
-                        mean_ill, std_ill = ave, std
-
-                    else:
-                        gaussian_fit = gauss(x_tofit, *coeff)
-                        gauss_tot = gauss(bins_med, *coeff)
-
-                        plt.plot(x_tofit, gaussian_fit,linestyle= '--',color='orange',
-                            label='data for Gaussian Fit', linewidth= 4.0)
-                        plt.plot(bins_med, gauss_tot, color= 'crimson', label='Gaussian fit')
-
-                        wave = np.sum(gauss_tot)/np.sum(counts)
-                        wave = np.round(wave, 3)
-                        ill_curve = scipy.signal.medfilt(abs(counts - gauss_tot), kernel_size=5)
-
-                        mean_ill = np.sum([x*y for x,y in zip(bins_med, ill_curve)])/np.sum(ill_curve)
-                        std_ill = np.sqrt(np.sum([(x-mean_ill)**2 * y for x,y in zip(
-                            bins_med, ill_curve)])/np.sum(ill_curve))
-
-
-                        data_ill = stats.rv_histogram(histogram=(ill_curve, bins))
-                        plt.plot(bins_med, ill_curve, color='purple', label='ill curve')
-                        #quant_ill = data_ill.ppf([.25, .5, .75, .9])
-                    
-
-                    waveth = np.sum([c for b,c in zip(bins_med,counts) if -950<=b<=-700])
-                    waveth /= np.sum(counts)
-
-                    lims = [(-1000, -900), (-900, -500), (-500,-100), (-100,100)]
-                    vents = [np.sum([c for b,c in zip(bins_med, counts) if reg[0]<= b< reg[1]])/
-                        np.sum(counts) for reg in lims]
-
-                    plt.axvline(x=-950, color='green', linestyle='dotted')
-                    plt.axvline(x=-700, color='green', label='WAVE th range', linestyle='dotted')                             
-
-                    searchtag = dcmtagreader(dcmpath)
-                    try:
-                        seriesDescription = str(searchtag[0x0008, 0x103e].value)
-                        seriesDescription = seriesDescription.replace(' ', '').replace(',', '').replace('(', '').replace(')', '')
-                    except:
-                        seriesDescription = 'NA'
+                hist, n_voxels = histograms[part]
 
-                    result_all = {
-                        'AccessionNumber':   accnum,
-                        'Analysis date': self.ad,
-                        'Series description': seriesDescription,
-                        'Region': part,
-                        'volume':   np.round(volume/1000, 3),
-                        'mean':     np.round(ave, 3),
-                        'stddev':   np.round(std, 3),
-                        'skewness': np.round(skew, 3),
-                        'kurtosis': np.round(kurt, 3),
-                        'wave':     wave,
-                        'waveth':   np.round(waveth, 3),
-                        'mean_ill': np.round(mean_ill, 3),
-                        'std_ill':  np.round(std_ill, 3),
-                        'overinf'  :np.round(vents[0],3),
-                        'norm_aer' :np.round(vents[1],3),
-                        'non_aer'  :np.round(vents[2],3),
-                        'cons'  :   np.round(vents[3],3),
-                    }
+                volume = spacing[0]*spacing[1]* float(self.st) * n_voxels
 
-                    pbar.update(1)
+                ave, std, skew, kurt = histogram_stats(hist)
 
-                    if features_df.empty:
-                        features_df = pd.DataFrame({k: [v] for k, v in result_all.items()})
-                    else:
-                        new = pd.DataFrame({k: [v] for k, v in result_all.items()})
-                        features_df = pd.concat([features_df, new], ignore_index=True)
+                counts = densities[i_pat, part]
 
-                    if fall.tell()==0:
-                        fall_wr.writerow(result_all.keys())
-                    fall_wr.writerow(result_all.values())
+                assert len(counts)==len(bins_med), "Something went wrong with the histogram"
 
-                    plt.legend(loc='upper right')
-                    plt.title(f"{part} lung [HU]")
+                coeff, x_tofit, wave = fits[i_pat, part]
 
+                if isinstance(wave, str):
+                    #ill_curve=counts
+                    mean_ill, std_ill = ave, std
+                    fit_curves = ()
 
-                    if not os.path.isdir(os.path.join(self.out_dir, 'histograms')):
-                        os.mkdir(os.path.join(self.out_dir, 'histograms'))
-
-                    plt.savefig(os.path.join(self.out_dir, 'histograms', f"{accnum}_hist_{part}_{seriesDescription}_{self.ad}.png"))
+                else:
+                    gauss_tot = gauss(bins_med, *coeff)
 
+                    ill_curve = scipy.signal.medfilt(abs(counts - gauss_tot), kernel_size=5)
+
+                    mean_ill = np.dot(bins_med, ill_curve)/np.sum(ill_curve)
+                    std_ill = np.sqrt(np.dot((bins_med-mean_ill)**2, ill_curve)/np.sum(ill_curve))
+                    fit_curves = (coeff, x_tofit, ill_curve)
+
+
+                waveth = band_fraction(counts, bins_med, -950, -700, closed=True)
+
+                lims = [(-1000, -900), (-900, -500), (-500,-100), (-100,100)]
+                vents = [band_fraction(counts, bins_med, *reg) for reg in lims]
+
+                rows[part].append({
+                    'AccessionNumber':   accnum,
+                    'Analysis date': self.ad,
+                    'Series description': seriesDescription,
+                    'Region': part,
+                    'volume':   np.round(volume/1000, 3),
+                    'mean':     np.round(ave, 3),
+                    'stddev':   np.round(std, 3),
+                    'skewness': np.round(skew, 3),
+                    'kurtosis': np.round(kurt, 3),
+                    'wave':     wave,
+                    'waveth':   np.round(waveth, 3),
+                    'mean_ill': np.round(mean_ill, 3),
+                    'std_ill':  np.round(std_ill, 3),
+                    'overinf'  :np.round(vents[0],3),
+                    'norm_aer' :np.round(vents[1],3),
+                    'non_aer'  :np.round(vents[2],3),
+                    'cons'  :   np.round(vents[3],3),
+                })
+
+                self.figures.append((os.path.join(self.out_dir, 'histograms',
+                    f"{accnum}_hist_{part}_{seriesDescription}_{self.ad}.png"), part, counts, bins, *fit_curves))
+
+        # same row order as the region-major loop: all the patients of a region, then the next region
+        results = [result_all for part in self.parts for result_all in rows[part]]
+        with open(os.path.join(self.out_dir, 'clinical_features.csv'), 'w', encoding='utf-8') as fall:
+            fall_wr = csv.writer(fall, delimiter='\t')
+            if results:
+                fall_wr.writerow(results[0].keys())
+            for result_all in results:
+                fall_wr.writerow(result_all.values())
+
+        if self.plots:
+            self.render_histograms()
+        return pd.DataFrame(results)
+
+    def render_histograms(self):
+        """
+        Save the histogram figures of the last run, from the stored counts and fit
+        parameters, in a pool of processes.
+        """
+        if not os.path.isdir(os.path.join(self.out_dir, 'histograms')):
+            os.mkdir(os.path.join(self.out_dir, 'histograms'))
+        plot_histograms(self.figures, self.plot_workers)
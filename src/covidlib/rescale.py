@@ -1,14 +1,356 @@
 # pylint: disable=too-many-instance-attributes
 """Module to rescale voxels in .nii CT scans"""
 
-import glob
 import os
 import pathlib
 import numpy as np
 import SimpleITK as sitk
 import skimage.transform as skTrans
+from scipy import ndimage
 from tqdm import tqdm
-from covidlib.ctlibrary import EmptyMaskError
+from covidlib.ctlibrary import (LABEL_PIXEL_TYPE, EmptyMaskError, crop_image, read_crop_box,
+    write_crop_box)
+from covidlib.imagestore import ImageStore, VolumeSlabs, slab_height
+
+
+def _mirror_index(idx, size):
+    """Map (possibly out of range) indices into [0, size) by mirroring
+    around the first and last element, like scipy.ndimage mode='mirror'."""
+    if size == 1:
+        return np.zeros_like(idx)
+    period = 2 * (size - 1)
+    idx = np.abs(idx) % period
+    return np.where(idx >= size, period - idx, idx)
+
+
+def resample_z(img_array, n_z, slab=16):
+    """
+    Resample a volume along the first (z) axis only.
+    The output matches skimage.transform.resize(order=1) on the z axis:
+    half-voxel aligned linear interpolation between adjacent slices,
+    preceded by a gaussian anti-aliasing filter when downsampling.
+    Computation is done in float32, on slabs of output slices.
+
+    :param img_array: numpy array with shape (z, y, x), or VolumeSlabs
+    :param n_z: number of output slices
+    :param slab: number of output slices computed at a time
+    :return: array with shape (n_z, y, x) and the same dtype as the input
+    """
+    depth = img_array.shape[0]
+    factor = depth / n_z
+    sigma = max(0., (factor - 1) / 2)
+    halo = int(4 * sigma + 0.5) + 1 if sigma > 0 else 1
+
+    out = np.empty((n_z,) + img_array.shape[1:], dtype=img_array.dtype)
+    coords = (np.arange(n_z) + 0.5) * factor - 0.5
+    lower = np.floor(coords).astype(int)
+    weights = (coords - lower).astype(np.float32)[:, None, None]
+
+    for start in range(0, n_z, slab):
+        stop = min(start + slab, n_z)
+        first = lower[start] - halo
+        last = lower[stop - 1] + 1 + halo
+        src = img_array[_mirror_index(np.arange(first, last + 1), depth)].astype(np.float32)
+        if sigma > 0:
+            src = ndimage.gaussian_filter1d(src, sigma, axis=0, mode='mirror')
+
+        low = src[lower[start:stop] - first]
+        high = src[lower[start:stop] + 1 - first]
+        res = low + weights[start:stop] * (high - low)
+
+        if np.issubdtype(out.dtype, np.integer):
+            res = np.rint(res)
+        out[start:stop] = res
+
+    return out
+
+
+def resample_iso(image, iso_vox_dim, interpolator=sitk.sitkLinear,
+                 pixel_type=sitk.sitkFloat32, threads=None):
+    """
+    Resample an image to isotropic voxels with SimpleITK (multithreaded).
+    The output grid is the same as skimage.transform.resize would use:
+    int(round(n * spacing / iso_vox_dim)) voxels per axis, half-voxel aligned.
+
+    :param image: SimpleITK image
+    :param iso_vox_dim: isotropic voxel dimension in mm
+    :param interpolator: SimpleITK interpolator
+    :param pixel_type: pixel type of the output image
+    :param threads: number of threads (default: SimpleITK global default)
+    :return: resampled SimpleITK image, with spacing, origin and direction set
+    """
+    out_size, factors = _iso_grid(image.GetSize(), image.GetSpacing(), iso_vox_dim)
+    resampler = _iso_resampler(image, out_size, factors, interpolator, pixel_type, threads)
+    return resampler.Execute(image)
+
+
+def _iso_grid(in_size, spacing, iso_vox_dim):
+    """Size of the isotropic grid and input voxels per output voxel, along (x, y, z)."""
+    out_size = [max(1, int(round(n * sp / iso_vox_dim))) for n, sp in zip(in_size, spacing)]
+    factors = [n_in / n_out for n_in, n_out in zip(in_size, out_size)]
+    return out_size, factors
+
+
+def _iso_resampler(reference, out_size, factors, interpolator, pixel_type, threads, start=0):
+    """ResampleImageFilter onto the isotropic grid of a reference image,
+    from output slice start on (see resample_iso)."""
+    resampler = sitk.ResampleImageFilter()
+    resampler.SetSize(out_size)
+    resampler.SetOutputSpacing([sp * f for sp, f in zip(reference.GetSpacing(), factors)])
+    resampler.SetOutputDirection(reference.GetDirection())
+    resampler.SetOutputOrigin(reference.TransformContinuousIndexToPhysicalPoint(
+        [0.5 * factors[0] - 0.5, 0.5 * factors[1] - 0.5, (start + 0.5) * factors[2] - 0.5]))
+    resampler.SetInterpolator(interpolator)
+    resampler.SetOutputPixelType(pixel_type)
+    if threads is not None:
+        resampler.SetNumberOfThreads(threads)
+    return resampler
+
+
+def resample_iso_slabs(volume, iso_vox_dim, interpolator=sitk.sitkLinear,
+                       pixel_type=sitk.sitkFloat32, threads=None, slab=16):
+    """
+    Same as resample_iso, on slabs of output slices: each slab reads only
+    the input slices around it.
+
+    :param volume: VolumeSlabs of the input image
+    :param slab: number of output slices per slab
+    :return: generator of (start, stop, numpy array) of the output slabs
+    """
+    reference = volume.image(0, 1)
+    out_size, factors = _iso_grid(volume.size, volume.spacing, iso_vox_dim)
+    for start in range(0, out_size[2], slab):
+        stop = min(start + slab, out_size[2])
+        # input slices around the output ones, with one more on each side for the interpolation
+        first = max(0, int(np.floor((start + 0.5) * factors[2] - 0.5)) - 1)
+        last = min(volume.depth, int(np.floor((stop - 0.5) * factors[2] - 0.5)) + 3)
+        resampler = _iso_resampler(reference, out_size[:2] + [stop - start], factors,
+            interpolator, pixel_type, threads, start)
+        yield start, stop, sitk.GetArrayFromImage(resampler.Execute(volume.image(first, last)))
+
+
+def zoom_shape(in_shape, output_shape):
+    """Shape of the array returned by skimage.transform.resize (output_shape may be float)."""
+    return tuple(int(round(n * (1 / (n / out)))) for n, out in zip(in_shape, output_shape))
+
+
+def resize_slabs(volume, output_shape, order=1, anti_aliasing=None, slab=16):
+    """
+    Same as skimage.transform.resize(volume, output_shape, order, mode='reflect',
+    preserve_range=True, anti_aliasing), on slabs of output slices. Each slab
+    reads only the input slices it needs, with a halo for the anti-aliasing
+    filter and the interpolation.
+
+    :param volume: numpy array (z, y, x), or VolumeSlabs
+    :param output_shape: output shape, as for skimage (it may be float)
+    :param order: 0 (nearest neighbour) or 1 (linear)
+    :param anti_aliasing: as for skimage (default: when downsampling, except
+        integers with order 0)
+    :param slab: number of output slices per slab
+    :return: generator of (start, stop, array) of the output slabs. For order 1 the
+        arrays are float32 for float32 input, float64 otherwise; for order 0 they
+        have the input dtype
+    """
+    in_shape = np.array(volume.shape)
+    factors = in_shape / np.asarray(output_shape, dtype=np.float64)
+    out_shape = zoom_shape(volume.shape, output_shape)
+    grid = in_shape / np.array(out_shape)
+    if anti_aliasing is None:
+        anti_aliasing = not (np.issubdtype(volume.dtype, np.integer) and order == 0) and \
+            any(out < n for out, n in zip(output_shape, volume.shape))
+    sigma = np.maximum(0, (factors - 1) / 2) if anti_aliasing else np.zeros(3)
+    # halo of the gaussian filter (truncated at 4 sigma, as in scipy)
+    radius = int(4 * sigma[0] + 0.5)
+    float_type = np.float32 if volume.dtype == np.float32 else np.float64
+
+    # output z coordinates in the input, computed as scipy zoom does in grid mode
+    coords = (np.arange(out_shape[0]) + 0.5) * grid[0] - 0.5
+    inplane_zoom = [1., 1 / factors[1], 1 / factors[2]]
+    for start in range(0, out_shape[0], slab):
+        stop = min(start + slab, out_shape[0])
+        first = int(np.floor(coords[start])) - radius - 1
+        last = int(np.floor(coords[stop - 1])) + radius + 2
+        src = volume[_mirror_index(np.arange(first, last + 1), volume.shape[0])]
+        if order > 0:
+            src = src.astype(float_type)
+        if anti_aliasing:
+            src = ndimage.gaussian_filter(src, sigma, mode='mirror')
+        # the interpolation is separable: in-plane zoom of the slab, then along z
+        src = ndimage.zoom(src, inplane_zoom, order=order, mode='mirror', grid_mode=True)
+
+        coord = coords[start:stop]
+        if order == 0:
+            out = src[np.floor(coord + 0.5).astype(int) - first]
+        else:
+            lower = np.floor(coord).astype(int)
+            weight = (coord - lower).astype(src.dtype)[:, None, None]
+            out = (1 - weight) * src[lower - first] + weight * src[lower + 1 - first]
+        yield start, stop, out
+
+
+LABEL_INTERPOLATORS = {'nearest': sitk.sitkNearestNeighbor,
+                       'partial': sitk.sitkLabelLinear}
+
+
+def resample_labels(label_array, output_shape, mode='nearest'):
+    """
+    Resample a label map with skimage, without mixing the labels.
+
+    :param label_array: integer numpy array with the labels
+    :param output_shape: shape of the output array
+    :param mode: 'nearest' for nearest neighbour, 'partial' for partial volume:
+        each label indicator is interpolated linearly and every voxel
+        takes the label with the largest fraction
+    :return: uint8 array with the same labels as the input
+    """
+    label_array = label_array.astype(np.uint8)
+    if mode == 'nearest':
+        return skTrans.resize(label_array, output_shape, order=0,
+            preserve_range=True, anti_aliasing=False).astype(np.uint8)
+    if mode != 'partial':
+        raise ValueError(f"Unknown label resampling mode {mode}")
+
+    out = _vote((label, skTrans.resize((label_array == label).astype(np.float32), output_shape,
+        order=1, anti_aliasing=False)) for label in np.unique(label_array[label_array > 0]))
+    if out is None:
+        return resample_labels(label_array, output_shape, 'nearest')
+    return out
+
+
+def _vote(fractions):
+    """
+    Partial volume labels: every voxel takes the label with the largest
+    fraction, or the background if its fraction is the largest.
+
+    :param fractions: iterable of (label, fraction array), in increasing label order
+    :return: uint8 label array, or None if there are no labels
+    """
+    out, best, total = None, None, None
+    for label, fraction in fractions:
+        if out is None:
+            out = np.full(fraction.shape, label, dtype=np.uint8)
+            best, total = fraction, fraction.copy()
+        else:
+            better = fraction > best
+            out[better] = label
+            best = np.maximum(best, fraction)
+            total += fraction
+    if out is None:
+        return None
+
+    # the indicators sum up to one: the background fraction comes for free
+    out[1 - total >= best] = 0
+    return out
+
+
+class _Indicator():
+    """Lazy float32 indicator of a label in a label volume (see resize_slabs)."""
+
+    def __init__(self, volume, label):
+        self.volume = volume
+        self.label = label
+        self.shape = volume.shape
+        self.dtype = np.dtype(np.float32)
+
+    def __getitem__(self, index):
+        return (self.volume[index] == self.label).astype(np.float32)
+
+
+def resample_labels_slabs(volume, output_shape, mode='nearest', slab=16):
+    """
+    Same as resample_labels, on slabs of output slices (see resize_slabs).
+
+    :param volume: uint8 numpy array (z, y, x), or VolumeSlabs
+    :return: generator of (start, stop, uint8 array) of the output slabs
+    """
+    if mode not in ('nearest', 'partial'):
+        raise ValueError(f"Unknown label resampling mode {mode}")
+    labels = []
+    if mode == 'partial':
+        found = set()
+        for start in range(0, volume.shape[0], slab):
+            found.update(np.unique(volume[start:start + slab]).tolist())
+        labels = sorted(found - {0})
+    if not labels:
+        for start, stop, out in resize_slabs(volume, output_shape, order=0,
+                                             anti_aliasing=False, slab=slab):
+            yield start, stop, out.astype(np.uint8)
+        return
+
+    slabs = [resize_slabs(_Indicator(volume, label), output_shape, order=1,
+        anti_aliasing=False, slab=slab) for label in labels]
+    for parts in zip(*slabs):
+        start, stop, _ = parts[0]
+        yield start, stop, _vote((label, fraction) for label, (_, _, fraction) in zip(labels, parts))
+
+
+def collect_slabs(slabs, shape, dtype):
+    """
+    Assemble output slabs into one array. Float values are rounded and clipped
+    to an integer dtype, as ctlibrary.cast_image does.
+
+    :param slabs: iterable of (start, stop, array)
+    :param shape: shape of the whole array
+    :param dtype: dtype of the whole array
+    """
+    out = np.empty(shape, dtype=dtype)
+    for start, stop, array in slabs:
+        if np.issubdtype(dtype, np.integer) and np.issubdtype(array.dtype, np.floating):
+            limits = np.iinfo(dtype)
+            array = np.clip(np.rint(array), limits.min, limits.max)
+        out[start:stop] = array
+    return out
+
+
+def _midpoints(nonzero):
+    """Midpoint between the first and the last True along the last axis.
+    Rows with no True give the midpoint of the whole axis."""
+    size = nonzero.shape[-1]
+    first = np.argmax(nonzero, axis=-1)
+    last = size - 1 - np.argmax(nonzero[..., ::-1], axis=-1)
+    return (first + last) // 2
+
+
+def subroi_labels(lung):
+    """
+    Upper/lower and ventral/dorsal label map of a bilateral lung mask.
+
+    :param lung: boolean numpy array (z, y, x) with the lung voxels
+    :return: uint8 array with labels 11, 21, 22, 42 (see Rescaler.make_subroi_mask)
+    """
+    n_z, n_y, _ = lung.shape
+    mid_z = _midpoints(lung.any(axis=(1, 2)))
+    mid_y = _midpoints(lung.any(axis=2))
+
+    upper = (np.arange(n_z) >= mid_z).astype(np.uint8)
+    ventral = (np.arange(n_y)[None, :] >= mid_y[:, None]).astype(np.uint8)
+
+    factor = (1 + upper)[:, None, None] * (11 + 10 * ventral)[:, :, None]
+    return (lung * factor).astype(np.uint8)
+
+
+def lung_bbox(lung, spacing, margin=10.):
+    """
+    Bounding box of the lungs, enlarged by a margin and clipped to the image.
+
+    :param lung: boolean numpy array (z, y, x) with the lung voxels
+    :param spacing: voxel spacing (x, y, z) in mm
+    :param margin: margin in mm
+    :return: (index, size) of the box in (x, y, z) order. The whole image
+        is returned if there are no lung voxels
+    """
+    shape = lung.shape[::-1]
+    index, size = [], []
+    for axis, (n_vox, sp) in enumerate(zip(shape, spacing)):
+        others = tuple(a for a in range(3) if a != 2 - axis)
+        nonzero = np.flatnonzero(lung.any(axis=others))
+        if len(nonzero) == 0:
+            return (0, 0, 0), shape
+        pad = int(np.ceil(margin / sp))
+        first, last = max(0, nonzero[0] - pad), min(n_vox, nonzero[-1] + 1 + pad)
+        index.append(first)
+        size.append(last - first)
+    return tuple(index), tuple(size)
 
 
 class Rescaler():
@@ -16,15 +358,39 @@ class Rescaler():
     It supports both Z-rescaling to 3mm
     and isotropic voxel rescaling."""
 
-    def __init__(self, base_dir, single_mode, slice_thk=3 ,iso_vox_dim=1.15):
+    def __init__(self, base_dir, single_mode, slice_thk=3 ,iso_vox_dim=1.15,
+                 backend='skimage', threads=None, mask_mode='nearest', store=None,
+                 crop=False, crop_margin=10., memory_budget=None):
         """Constructor for the Rescaler class.
 
         :param base_dir: Patient base directory
         :param single_mode: Flag to activate single mode (default is multiple)
         :param slice_thk: Slice thickness in mm
-        :param iso_vox_dim: Isotropic voxel dimension"""
+        :param iso_vox_dim: Isotropic voxel dimension
+        :param backend: ISO resampling backend, 'skimage' or 'sitk' (multithreaded)
+        :param threads: number of threads for the 'sitk' backend
+        :param mask_mode: ISO resampling of the masks, 'nearest' or 'partial' (volume)
+        :param store: ImageStore to read and write the images (default: on disk)
+        :param crop: if True, the ISO images are cropped in-plane to the lung
+            bounding box (see make_crop_box)
+        :param crop_margin: margin around the lungs in mm
+        :param memory_budget: if given, the z and ISO rescaling read the images and
+            compute in z-slabs, so that their working arrays take about this many MB
+            (default: whole volumes)"""
+
+        if backend not in ('skimage', 'sitk'):
+            raise ValueError(f"Unknown resampling backend {backend}")
+        if mask_mode not in LABEL_INTERPOLATORS:
+            raise ValueError(f"Unknown mask resampling mode {mask_mode}")
 
         self.base_dir = base_dir
+        self.store = store if store is not None else ImageStore()
+        self.backend = backend
+        self.threads = threads
+        self.mask_mode = mask_mode
+        self.crop = crop
+        self.crop_margin = crop_margin
+        self.memory_budget = None if memory_budget is None else memory_budget * 2**20
         self.iso_vox_dim = iso_vox_dim
         self.st = slice_thk
         self.iso_ct_name = f"CT_ISO_{iso_vox_dim:.2f}.nii"
@@ -37,8 +403,8 @@ class Rescaler():
             self.nii_paths = [os.path.join(self.base_dir, "CT.nii")]
 
         else:
-            self.pre_paths = glob.glob(self.base_dir + '/*')
-            self.nii_paths = glob.glob(self.base_dir + '/*/CT.nii')
+            self.pre_paths = self.store.glob(self.base_dir + '/*')
+            self.nii_paths = self.store.glob(self.base_dir + '/*/CT.nii')
 
     def run_xmm(self, x=3.0):
         """
@@ -49,54 +415,104 @@ class Rescaler():
         x = int(x)
         pbar = tqdm(total=len(self.nii_paths), colour='green', desc=f'Rescaling to {self.st:.0f}mm   ')
         for image_path, pre_path in zip(self.nii_paths, self.pre_paths):
-            image_itk = sitk.ReadImage(image_path)
-            img_array = sitk.GetArrayFromImage(image_itk)
-            _, _, sp_z = image_itk.GetSpacing()
+            if self.memory_budget is None:
+                image_itk = self.store.read_image(image_path)
+                img_array = sitk.GetArrayFromImage(image_itk)
+            else:
+                # the slices are read slab by slab while resampling: the first one gives the geometry
+                img_array = VolumeSlabs(self.store, image_path)
+                image_itk = img_array.image(0, 1)
+            depth = img_array.shape[0]
+            sp_x, sp_y, sp_z = image_itk.GetSpacing()
 
             if int(sp_z)<11:
                 if int(sp_z)!=x:
                     #if they are not x mm, rescale them on Z
                     n_x = image_itk.GetWidth()
                     n_y = image_itk.GetHeight()
-                    n_z = int(image_itk.GetDepth() * sp_z / x)
-                    img_array= skTrans.resize(img_array, (n_z,n_y,n_x), order=1, preserve_range=True)
-                    image_itk = sitk.GetImageFromArray(img_array)
+                    n_z = int(depth * sp_z / x)
+                    img_array = resample_z(img_array, n_z, self._z_slab(img_array.shape, n_z))
+                    image_xmm = sitk.GetImageFromArray(img_array)
+
+                    # carry the geometry: new z spacing, half-voxel shift of the origin
+                    factor = depth / n_z
+                    image_xmm.SetSpacing((sp_x, sp_y, sp_z * factor))
+                    image_xmm.SetDirection(image_itk.GetDirection())
+                    image_xmm.SetOrigin(image_itk.TransformContinuousIndexToPhysicalPoint(
+                        (0., 0., 0.5 * factor - 0.5)))
+                    image_itk = image_xmm
                     pbar.update(1)
                 else:
+                    if self.memory_budget is not None:
+                        image_itk = img_array.image(0, depth)
                     pbar.update(1)
 
-                sitk.WriteImage(image_itk, os.path.join(pre_path, self.mm3_ct_name))
+                self.store.write_ct(image_itk, os.path.join(pre_path, self.mm3_ct_name))
             else:
                 raise Exception('Unrealistic spacing value: ', sp_z)
 
 
+    def _z_slab(self, shape, n_z):
+        """Output slices per slab of resample_z (16 without a memory budget)."""
+        if self.memory_budget is None:
+            return 16
+        factor = shape[0] / n_z
+        halo = int(2 * max(0., factor - 1) + 0.5) + 1
+        slice_bytes = 4 * shape[1] * shape[2]
+        # float32 source slices (raw and filtered), two interpolation ends and the result
+        return slab_height(self.memory_budget, slice_bytes * (2 * factor + 3),
+            slice_bytes * 2 * (2 * halo + 2))
+
+    def _iso_slab(self, in_shape, out_shape):
+        """Output slices per slab of the ISO resampling, within memory_budget."""
+        factor = in_shape[0] / out_shape[0]
+        in_slice = 8 * in_shape[1] * in_shape[2]
+        out_slice = 8 * out_shape[1] * out_shape[2]
+        halo = int(2 * max(0., factor - 1) + 0.5) + 3
+        # float64 source slices (raw and filtered), their in-plane zoom and the result
+        return slab_height(self.memory_budget, 2 * factor * in_slice + (factor + 3) * out_slice,
+            2 * halo * (in_slice + out_slice))
+
     def run_iso(self,):
         """
         Take x mm CT.nii and rescale to isotropic CT.nii.
         Also take x mm mask.nii and rescale to isotropic mask.nii.
+        The left/right label map is resampled once, without mixing labels,
+        and the bilateral ISO mask (label 1) is derived from it.
         """
         if self.single_mode:
             self.mask_paths = [os.path.join(self.base_dir , f'mask_R231CW_{self.st:.0f}mm.nii')]
             self.mask_bilat_paths = [os.path.join(self.base_dir , f'mask_R231CW_{self.st:.0f}mm_bilat.nii')]
         else:
-            self.mask_paths = glob.glob(self.base_dir + f'/*/mask_R231CW_{self.st:.0f}mm.nii')
-            self.mask_bilat_paths = glob.glob(self.base_dir + f'/*/mask_R231CW_{self.st:.0f}mm_bilat.nii')
+            self.mask_paths = self.store.glob(self.base_dir + f'/*/mask_R231CW_{self.st:.0f}mm.nii')
+            self.mask_bilat_paths = self.store.glob(self.base_dir + f'/*/mask_R231CW_{self.st:.0f}mm_bilat.nii')
+
+        pbar = tqdm(total=len(self.nii_paths)*3, colour='white', desc='Rescaling to ISO   ')
 
-        pbar = tqdm(total=len(self.nii_paths)*4, colour='white', desc='Rescaling to ISO   ')
+        for image_path, mask_path, pre_path in zip(self.nii_paths,
+        self.mask_paths, self.pre_paths):
+            box = read_crop_box(pre_path) if self.crop else None
 
-        for image_path, mask_path, mask_bilat_path, pre_path in zip(self.nii_paths,
-        self.mask_paths, self.mask_bilat_paths, self.pre_paths):
-            
-            image_itk =sitk.ReadImage(image_path)
+            if self.memory_budget is not None:
+                self.run_iso_slabs(image_path, mask_path, pre_path, pbar, box)
+                continue
+
+            image_itk = self.store.read_image(image_path)
             try:
-                mask_itk = sitk.ReadImage(mask_path)
-                mask_bilat =sitk.ReadImage(mask_bilat_path)
+                mask_itk = self.store.read_labels(mask_path)
             except RuntimeError:
-                raise FileNotFoundError(f"File not found: {mask_path} or {mask_bilat_path}")
+                raise FileNotFoundError(f"File not found: {mask_path}")
+
+            if self.backend == 'sitk':
+                self.run_iso_sitk(image_itk, mask_itk, pre_path, pbar, box)
+                continue
+
+            if box is not None:
+                image_itk = crop_image(image_itk, box, inplane=True)
+                mask_itk = crop_image(mask_itk, box, inplane=True)
 
             img_array = sitk.GetArrayFromImage(image_itk)
             mask_array = sitk.GetArrayFromImage(mask_itk)
-            mask_bilat_array = sitk.GetArrayFromImage(mask_bilat)
 
             n_x = image_itk.GetWidth() * image_itk.GetSpacing()[0] / self.iso_vox_dim
             n_y = image_itk.GetHeight() * image_itk.GetSpacing()[1] / self.iso_vox_dim
@@ -106,117 +522,154 @@ class Rescaler():
 
             img_array = skTrans.resize(img_array, (n_z,n_y,n_x), order=1, preserve_range=True)
             pbar.update(1)
-            mask_array = skTrans.resize(mask_array, (n_z,n_y,n_x), order=1, preserve_range=True)
-            pbar.update(1)
-            mask_bilat_array = np.sign(skTrans.resize(mask_bilat_array,
-            (n_z,n_y,n_x), order=1, preserve_range=True))
+            mask_array = resample_labels(mask_array, (n_z,n_y,n_x), self.mask_mode)
+            mask_bilat_array = (mask_array > 0).astype(np.uint8)
 
-            sitk.WriteImage(sitk.GetImageFromArray(img_array),
+            self.store.write_ct(sitk.GetImageFromArray(img_array),
                 os.path.join(pre_path, f"CT_ISO_{self.iso_vox_dim:.2f}.nii"))
-            sitk.WriteImage(sitk.GetImageFromArray(mask_array),
+            self.store.write_labels(sitk.GetImageFromArray(mask_array),
                 os.path.join(pre_path, f"mask_R231CW_ISO_{self.iso_vox_dim:.2f}.nii"))
-            sitk.WriteImage(sitk.GetImageFromArray(mask_bilat_array),
+            self.store.write_labels(sitk.GetImageFromArray(mask_bilat_array),
                 os.path.join(pre_path, f'mask_R231CW_ISO_{self.iso_vox_dim:.2f}_bilat.nii'))
             pbar.update(1)
 
-
-    def make_upper_mask(self,):
+    def run_iso_sitk(self, image_itk, mask_itk, pre_path, pbar, box=None):
         """
-        Create a mask for the upper and lower lungs.
-        We simply use the midpoint slice between the two external nonzero slices
-        - Upper lung voxel value: 20
-        - Lower lung voxel value: 10
+        ISO rescaling of one patient with the SimpleITK backend.
+        The mask lies on the grid of the CT_{st}mm image, which covers
+        the same physical extent as the native CT: its geometry is taken
+        from the header of that file. The output images keep their spacing.
+        If a crop box is given, both images are cropped in-plane first.
         """
-        if self.single_mode:
-            self.mask_paths = [os.path.join(self.base_dir , f'mask_R231CW_{self.st:.0f}mm.nii')]
-            self.mask_bilat_paths = [os.path.join(self.base_dir , f'mask_R231CW_{self.st:.0f}mm_bilat.nii')]
+        size, spacing, origin, direction = self.store.geometry(os.path.join(pre_path, self.mm3_ct_name))
+        if size != mask_itk.GetSize():
+            raise ValueError(f"Mask size {mask_itk.GetSize()} does not match {self.mm3_ct_name} {size}")
+        mask_itk.SetSpacing(spacing)
+        mask_itk.SetOrigin(origin)
+        mask_itk.SetDirection(direction)
+        if box is not None:
+            image_itk = crop_image(image_itk, box, inplane=True)
+            mask_itk = crop_image(mask_itk, box, inplane=True)
+        pbar.update(1)
+
+        iso_image = resample_iso(image_itk, self.iso_vox_dim, threads=self.threads)
+        pbar.update(1)
+        iso_mask = resample_iso(mask_itk, self.iso_vox_dim,
+            interpolator=LABEL_INTERPOLATORS[self.mask_mode],
+            pixel_type=sitk.sitkUInt8, threads=self.threads)
+        iso_bilat = sitk.Cast(iso_mask > 0, sitk.sitkUInt8)
+
+        self.store.write_ct(iso_image, os.path.join(pre_path, f"CT_ISO_{self.iso_vox_dim:.2f}.nii"))
+        self.store.write_labels(iso_mask, os.path.join(pre_path, f"mask_R231CW_ISO_{self.iso_vox_dim:.2f}.nii"))
+        self.store.write_labels(iso_bilat,
+            os.path.join(pre_path, f'mask_R231CW_ISO_{self.iso_vox_dim:.2f}_bilat.nii'))
+        pbar.update(1)
+
+
+    def run_iso_slabs(self, image_path, mask_path, pre_path, pbar, box=None):
+        """
+        ISO rescaling of one patient in z-slabs, within memory_budget.
+        The native CT and the mask are read a slab at a time and only the
+        ISO outputs are kept whole. The images are the same as with run_iso
+        (for the skimage backend, up to float rounding before the cast to int16).
+        """
+        if not self.store.exists(mask_path):
+            raise FileNotFoundError(f"File not found: {mask_path}")
+        image = VolumeSlabs(self.store, image_path, box=box)
+        if self.backend == 'sitk':
+            # the mask lies on the CT_{st}mm grid (see run_iso_sitk)
+            size, spacing, origin, direction = self.store.geometry(os.path.join(pre_path, self.mm3_ct_name))
+            mask = VolumeSlabs(self.store, mask_path, LABEL_PIXEL_TYPE, box, (spacing, origin, direction))
+            if size[2] != mask.depth:
+                raise ValueError(f"Mask depth {mask.depth} does not match {self.mm3_ct_name} {size}")
         else:
-            self.mask_paths = glob.glob(self.base_dir + f'/*/mask_R231CW_{self.st}mm.nii')
-            self.mask_bilat_paths = glob.glob(self.base_dir + f'/*/mask_R231CW_{self.st:.0f}mm_bilat.nii')
-
-        for bilat_mask in self.mask_bilat_paths:
-            mask = sitk.ReadImage(bilat_mask)
-            mask_array = sitk.GetArrayFromImage(mask)
- 
-
-            if np.sum(np.sign(mask_array))<20*len(mask_array):
-                raise EmptyMaskError(np.sum(np.sign(mask_array)))
-
-            n_vox = [np.sum(lung_slice) for lung_slice in mask_array]
-
-            # 0 0 0 0 1 4 6 8 10 35 23 11 6 2 0 0 0
-            # left--> ^           right --> ^
-
-            left  = next((i for i, val in enumerate(n_vox) if val != 0), None)
-            right = len(n_vox)-1-next((i for i, v in enumerate(reversed(n_vox)) if v!=0),None)
-            mid = (left + right)//2
-
-            for i in range(mid, len(n_vox)):
-                mask_array[i,:,:] *= 2
-
-            new_mask = sitk.GetImageFromArray(mask_array)
-            out_path =  pathlib.Path(bilat_mask).parent
-            sitk.WriteImage(new_mask, os.path.join(out_path, f'mask_R231CW_{self.st:.0f}mm_upper.nii'))
-
-    def make_ventral_mask(self,):
+            mask = VolumeSlabs(self.store, mask_path, LABEL_PIXEL_TYPE, box)
+        pbar.update(1)
+
+        if self.backend == 'sitk':
+            out_size, _ = _iso_grid(image.size, image.spacing, self.iso_vox_dim)
+            out_shape = tuple(out_size[::-1])
+            slab = self._iso_slab(image.shape, out_shape)
+            img_array = collect_slabs(resample_iso_slabs(image, self.iso_vox_dim,
+                threads=self.threads, slab=slab), out_shape, np.int16)
+            pbar.update(1)
+            mask_out_size, _ = _iso_grid(mask.size, mask.spacing, self.iso_vox_dim)
+            mask_array = collect_slabs(resample_iso_slabs(mask, self.iso_vox_dim,
+                interpolator=LABEL_INTERPOLATORS[self.mask_mode], pixel_type=sitk.sitkUInt8,
+                threads=self.threads, slab=slab), tuple(mask_out_size[::-1]), np.uint8)
+        else:
+            shape = [n * sp / self.iso_vox_dim for n, sp in zip(image.shape, image.spacing[::-1])]
+            out_shape = zoom_shape(image.shape, shape)
+            slab = self._iso_slab(image.shape, out_shape)
+            img_array = collect_slabs(resize_slabs(image, shape, order=1, slab=slab), out_shape, np.int16)
+            pbar.update(1)
+            mask_array = collect_slabs(resample_labels_slabs(mask, shape, self.mask_mode, slab),
+                zoom_shape(mask.shape, shape), np.uint8)
+
+        iso_image = sitk.GetImageFromArray(img_array)
+        iso_mask = sitk.GetImageFromArray(mask_array)
+        if self.backend == 'sitk':
+            # same geometry as resample_iso
+            for iso, volume in ((iso_image, image), (iso_mask, mask)):
+                out_size, factors = _iso_grid(volume.size, volume.spacing, self.iso_vox_dim)
+                resampler = _iso_resampler(volume.image(0, 1), out_size, factors,
+                    sitk.sitkLinear, sitk.sitkFloat32, None)
+                iso.SetSpacing(resampler.GetOutputSpacing())
+                iso.SetOrigin(resampler.GetOutputOrigin())
+                iso.SetDirection(resampler.GetOutputDirection())
+        iso_bilat = sitk.Cast(iso_mask > 0, sitk.sitkUInt8)
+
+        self.store.write_ct(iso_image, os.path.join(pre_path, f"CT_ISO_{self.iso_vox_dim:.2f}.nii"))
+        self.store.write_labels(iso_mask, os.path.join(pre_path, f"mask_R231CW_ISO_{self.iso_vox_dim:.2f}.nii"))
+        self.store.write_labels(iso_bilat,
+            os.path.join(pre_path, f'mask_R231CW_ISO_{self.iso_vox_dim:.2f}_bilat.nii'))
+        pbar.update(1)
+
+    def make_crop_box(self,):
         """
-        Create a mask for the frontal and dorsal lungs.
-        For each slice, we calculate the average y coordinate of the nonzero voxels.
-        - Ventral lung voxel value: 20
-        - Dorsal lung voxel value: 10
+        Compute the lung bounding box of each patient on the bilateral
+        {st}mm mask, with a margin of crop_margin mm, and store it as
+        patient metadata. The box refers to the CT_{st}mm grid, which has
+        the same rows and columns as the native CT.
         """
         if self.single_mode:
-            self.mask_paths = [os.path.join(self.base_dir , f'mask_R231CW_{self.st:.0f}mm.nii')]
-            self.mask_bilat_paths = [os.path.join(self.base_dir , f'mask_R231CW_{self.st:.0f}mm_bilat.nii')]
+            bilat_paths = [os.path.join(self.base_dir , f'mask_R231CW_{self.st:.0f}mm_bilat.nii')]
         else:
-            self.mask_paths = glob.glob(self.base_dir +f'/*/mask_R231CW_{self.st:.0f}mm.nii')
-            self.mask_bilat_paths = glob.glob(self.base_dir + f'/*/mask_R231CW_{self.st:.0f}mm_bilat.nii')
+            bilat_paths = self.store.glob(self.base_dir + f'/*/mask_R231CW_{self.st:.0f}mm_bilat.nii')
 
-        for bilat_mask in self.mask_bilat_paths:
-            mask = sitk.ReadImage(bilat_mask)
-            mask_array = sitk.GetArrayFromImage(mask)
-
-            for i,lung_slice in enumerate(mask_array):
-
-                row_totals = [np.sum(row) for row in lung_slice]
-
-                left  = next((i for i, val in enumerate(row_totals) if val != 0), 0)
-                right = len(row_totals)-1-next((k for k, v in enumerate(reversed(row_totals)) if v!=0), 0)
-                mid = (left + right)//2
-
-                for y in range(mid, len(row_totals)):
-                    mask_array[i,y,:] *= 2
+        for bilat_mask in bilat_paths:
+            pre_path = os.path.dirname(bilat_mask)
+            _, spacing, _, _ = self.store.geometry(os.path.join(pre_path, self.mm3_ct_name))
+            lung = sitk.GetArrayFromImage(self.store.read_labels(bilat_mask)) > 0
+            index, size = lung_bbox(lung, spacing, self.crop_margin)
+            write_crop_box(pre_path, index, size, self.mm3_ct_name, self.crop_margin)
 
-            new_mask = sitk.GetImageFromArray(mask_array)
-            out_path =  pathlib.Path(bilat_mask).parent
-            sitk.WriteImage(new_mask, os.path.join(out_path, f'mask_R231CW_{self.st:.0f}mm_ventral.nii'))
-
-    def make_mixed_mask(self,):
+    def make_subroi_mask(self,):
         """
-        Create a mask for the intersection between UL and VD masks.
+        Create the sub-ROI label map from the bilateral mask, in a single pass.
+        - Upper/lower: we use the midpoint slice between the two external nonzero slices
+        - Ventral/dorsal: for each slice, we use the midpoint row between
+          the two external nonzero rows
         The subROIs are labeled according to the following rule:
         - upper_dorsal = 22
         - upper_ventral = 42
         - lower_dorsal = 11
         - lower_ventral = 21
+        so that upper = {22, 42}, lower = {11, 21}, ventral = {21, 42}, dorsal = {11, 22}.
         """
         if self.single_mode:
-            self.maskul_paths = [os.path.join(self.base_dir ,     f'mask_R231CW_{self.st:.0f}mm_upper.nii')]
-            self.maskvd_paths = [os.path.join(self.base_dir ,     f'mask_R231CW_{self.st:.0f}mm_ventral.nii')]
-            #self.mask_mixed_paths = [os.path.join(self.base_dir , f'mask_R231CW_{self.st:.0f}mm_mixed.nii')]
+            self.mask_bilat_paths = [os.path.join(self.base_dir , f'mask_R231CW_{self.st:.0f}mm_bilat.nii')]
         else:
-            self.maskul_paths = glob.glob(self.base_dir +         f'/*/mask_R231CW_{self.st:.0f}mm_upper.nii')
-            self.maskvd_paths = glob.glob(self.base_dir +         f'/*/mask_R231CW_{self.st:.0f}mm_ventral.nii')
-            #self.mask_mixed_paths = glob.glob(self.base_dir +     f'/*/mask_R231CW_{self.st:.0f}mm_mixed.nii')
+            self.mask_bilat_paths = self.store.glob(self.base_dir + f'/*/mask_R231CW_{self.st:.0f}mm_bilat.nii')
 
-        for ul_mask, vd_mask in zip(self.maskul_paths, self.maskvd_paths,):
+        for bilat_mask in self.mask_bilat_paths:
+            mask = self.store.read_labels(bilat_mask)
+            lung = sitk.GetArrayFromImage(mask) > 0
 
-            ulmask = sitk.ReadImage(ul_mask)
-            vdmask = sitk.ReadImage(vd_mask)
-            ulmask_array = 0.1 * sitk.GetArrayFromImage(ulmask)
-            vdmask_array = np.ones(shape=ulmask_array.shape) + sitk.GetArrayFromImage(vdmask)
+            if np.count_nonzero(lung)<20*len(lung):
+                raise EmptyMaskError(np.count_nonzero(lung))
 
-            tot_array = np.multiply(ulmask_array, vdmask_array)
-            new_mask = sitk.GetImageFromArray(tot_array)
-            mixed_mask = os.path.join( pathlib.Path(ul_mask).parent.absolute(), f'mask_R231CW_{self.st:.0f}mm_mixed.nii')
-            sitk.WriteImage(new_mask, mixed_mask)
\ No newline at end of file
+            new_mask = sitk.GetImageFromArray(subroi_labels(lung))
+            new_mask.CopyInformation(mask)
+            out_path =  pathlib.Path(bilat_mask).parent
+            self.store.write_labels(new_mask, os.path.join(out_path, f'mask_R231CW_{self.st:.0f}mm_mixed.nii'))
@@ -0,0 +1,262 @@
+"""Module to segment the lungs of several patients in batches.
+The lungmask inference is split into its three steps (preprocessing,
+U-Net, postprocessing): volumes are read and preprocessed on a background
+thread, while the slices of consecutive patients are packed into
+fixed-size batches for the network. The network works slice by slice,
+so the masks are the same as with LMInferer.apply.
+The network runs either in PyTorch (through a lungmask LMInferer) or in
+ONNX Runtime, from a copy of the model exported once and cached
+(per lungmask version, which ships the weights).
+The ONNX backend needs the optional dependencies onnxruntime and onnx
+(pip install covidlib[onnx])."""
+
+import os
+import tempfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import SimpleITK as sitk
+import torch
+from lungmask import utils
+from lungmask.mask import get_model
+
+from covidlib.maskcache import lungmask_version
+
+ONNX_CACHE = os.path.join(os.path.expanduser('~'), '.cache', 'clearlung')
+
+
+class _Volume():
+    """Preprocessed volume waiting for its slices to be segmented."""
+
+    def __init__(self, key, image):
+        """Constructor for the _Volume class.
+        :param key: identifier of the volume (e.g. the path of the CT)
+        :param image: SimpleITK image
+        """
+        self.key = key
+        self.image = image
+        self.orientation = sitk.DICOMOrientImageFilter_GetOrientationFromDirectionCosines(
+            image.GetDirection())
+        if self.orientation != 'LPS':
+            image = sitk.DICOMOrient(image, 'LPS')
+        raw = sitk.GetArrayFromImage(image)
+        self.shape = raw.shape
+
+        slices, self.boxes = utils.preprocess(raw, resolution=[256, 256])
+        slices[slices > 600] = 600
+        self.slices = np.divide(slices + 1024, 1624).astype(np.float32)
+        self.predictions = []
+        self.n_done = 0
+
+    @property
+    def complete(self):
+        """True when all the slices have been segmented."""
+        return self.n_done == len(self.slices)
+
+    def finish(self, volume_postprocessing=True):
+        """Postprocess the predictions and bring them back on the original grid.
+        :return: uint8 label array with the same shape as the image array
+        """
+        outmask = np.concatenate(self.predictions) if self.predictions else \
+            np.empty((0, 256, 256), dtype=np.uint8)
+        if volume_postprocessing:
+            outmask = utils.postprocessing(outmask, disable_tqdm=True)
+        outmask = np.asarray([utils.reshape_mask(outmask[i], self.boxes[i], self.shape[1:])
+            for i in range(outmask.shape[0])], dtype=np.uint8)
+
+        if self.orientation != 'LPS':
+            outmask = sitk.GetImageFromArray(outmask)
+            outmask = sitk.DICOMOrient(outmask, self.orientation)
+            outmask = sitk.GetArrayFromImage(outmask)
+        return outmask.astype(np.uint8)
+
+
+def torch_predictor(inferer):
+    """Network of a lungmask LMInferer, as a function of a batch of slices.
+    :param inferer: lungmask LMInferer
+    :return: function mapping a float32 array (n, 256, 256) to uint8 labels (n, 256, 256)
+    """
+    def predict(slices):
+        with torch.inference_mode():
+            tensor = torch.as_tensor(slices[:, None, ::], dtype=torch.float32, device=inferer.device)
+            return torch.max(inferer.model(tensor), 1)[1].detach().cpu().numpy().astype(np.uint8)
+    return predict
+
+
+def require_onnx():
+    """Check that the optional dependencies of the ONNX backend are installed.
+    :raises ImportError: if onnxruntime or onnx is missing
+    """
+    for module in ('onnxruntime', 'onnx'):
+        try:
+            __import__(module)
+        except ImportError as err:
+            raise ImportError(f"The ONNX segmentation backend needs the {module} package, "
+                "install it with: pip install covidlib[onnx]") from err
+
+
+def _export_path(modelname, suffix):
+    """Default path of an ONNX export of a lungmask model, in ONNX_CACHE and keyed
+    by the lungmask version. If the version is unknown the export is not reused
+    across runs: it goes to a new temporary directory."""
+    version = lungmask_version()
+    if version is None:
+        return os.path.join(tempfile.mkdtemp(prefix='clearlung-'), f'{modelname}{suffix}')
+    return os.path.join(ONNX_CACHE, f'{modelname}-{version}{suffix}')
+
+
+def export_onnx(modelname='R231CovidWeb', path=None):
+    """Export a lungmask model to ONNX, unless it is already cached.
+
+    :param modelname: lungmask model name
+    :param path: path of the .onnx file
+        (default: ONNX_CACHE/<modelname>-<lungmask version>.onnx)
+    :return: path of the .onnx file
+    """
+    if path is None:
+        path = _export_path(modelname, '.onnx')
+    if os.path.exists(path):
+        return path
+
+    require_onnx()
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    model = get_model(modelname)
+    dummy = torch.zeros((1, 1, 256, 256), dtype=torch.float32)
+    # write to a temporary file, so that an interrupted export is not cached
+    tmp_path = path + '.part'
+    torch.onnx.export(model, dummy, tmp_path, input_names=['input'], output_names=['logits'],
+        dynamic_axes={'input': {0: 'batch'}, 'logits': {0: 'batch'}}, opset_version=13)
+    os.replace(tmp_path, path)
+    return path
+
+
+def quantize_onnx(modelname='R231CovidWeb', path=None):
+    """Post-training dynamic int8 quantization of a lungmask model, unless it is already cached.
+    The weights of the convolutions are stored as uint8, the activations are
+    quantized at run time (ONNX Runtime ConvInteger).
+
+    :param modelname: lungmask model name
+    :param path: path of the quantized .onnx file
+        (default: ONNX_CACHE/<modelname>-<lungmask version>.int8.onnx)
+    :return: path of the quantized .onnx file
+    """
+    require_onnx()
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+    from onnxruntime.quantization.shape_inference import quant_pre_process
+
+    if path is None:
+        path = _export_path(modelname, '.int8.onnx')
+    if os.path.exists(path):
+        return path
+
+    float_path = export_onnx(modelname)
+    # fold the batch normalization into the convolutions before quantizing them
+    pre_path = path + '.pre'
+    quant_pre_process(float_path, pre_path, skip_symbolic_shape=True)
+    tmp_path = path + '.part'
+    quantize_dynamic(pre_path, tmp_path, op_types_to_quantize=['Conv'], weight_type=QuantType.QUInt8)
+    os.remove(pre_path)
+    os.replace(tmp_path, path)
+    return path
+
+
+def onnx_predictor(modelname='R231CovidWeb', path=None, threads=None, quantized=False):
+    """Network of a lungmask model in ONNX Runtime (CPU execution provider).
+
+    :param modelname: lungmask model name, exported on first use (see export_onnx)
+    :param path: path of the .onnx file (default: the cached export of modelname)
+    :param threads: number of intra-op threads (default: ONNX Runtime default)
+    :param quantized: if True, run the int8 model (see quantize_onnx)
+    :return: function mapping a float32 array (n, 256, 256) to uint8 labels (n, 256, 256)
+    """
+    require_onnx()
+    import onnxruntime
+
+    if path is None:
+        path = quantize_onnx(modelname) if quantized else export_onnx(modelname)
+
+    options = onnxruntime.SessionOptions()
+    if threads is not None:
+        options.intra_op_num_threads = threads
+    session = onnxruntime.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+
+    def predict(slices):
+        logits = session.run(None, {'input': np.ascontiguousarray(slices[:, None], dtype=np.float32)})[0]
+        return np.argmax(logits, axis=1).astype(np.uint8)
+    return predict
+
+
+class BatchSegmenter():
+    """Lung segmentation of several volumes with cross-patient batches."""
+
+    def __init__(self, predict, batch_size=32, prefetch=2, volume_postprocessing=True):
+        """Constructor for the BatchSegmenter class.
+
+        :param predict: network as a function of a batch of slices
+            (see torch_predictor and onnx_predictor)
+        :param batch_size: number of slices per network call
+        :param prefetch: number of volumes read and preprocessed ahead
+        :param volume_postprocessing: if True, apply the lungmask postprocessing
+            (connected components analysis)
+        """
+        if batch_size < 1:
+            raise ValueError("batch_size must be positive")
+        self.predict = predict
+        self.batch_size = batch_size
+        self.prefetch = max(1, prefetch)
+        self.volume_postprocessing = volume_postprocessing
+
+    def _predict(self, batch, owners):
+        """Run the network on a batch and scatter the labels back to the volumes."""
+        labels = self.predict(np.concatenate(batch))
+
+        start = 0
+        for volume, count in owners:
+            volume.predictions.append(labels[start:start + count])
+            volume.n_done += count
+            start += count
+
+    def run(self, keys, read):
+        """Segment a sequence of volumes.
+
+        :param keys: identifiers of the volumes, e.g. paths
+        :param read: function returning the SimpleITK image of a key
+        :return: generator of (key, image, label array), in the order of keys
+        """
+        keys = list(keys)
+        load = lambda key: _Volume(key, read(key))
+
+        with ThreadPoolExecutor(max_workers=1) as pool:
+            futures = deque(pool.submit(load, key) for key in keys[:self.prefetch])
+            next_key = len(futures)
+            waiting = deque()
+            batch, owners, filled = [], [], 0
+
+            while futures:
+                volume = futures.popleft().result()
+                if next_key < len(keys):
+                    futures.append(pool.submit(load, keys[next_key]))
+                    next_key += 1
+                waiting.append(volume)
+
+                start = 0
+                while start < len(volume.slices):
+                    count = min(self.batch_size - filled, len(volume.slices) - start)
+                    batch.append(volume.slices[start:start + count])
+                    owners.append((volume, count))
+                    filled += count
+                    start += count
+
+                    if filled == self.batch_size:
+                        self._predict(batch, owners)
+                        batch, owners, filled = [], [], 0
+                        while waiting and waiting[0].complete:
+                            done = waiting.popleft()
+                            yield done.key, done.image, done.finish(self.volume_postprocessing)
+
+            if filled:
+                self._predict(batch, owners)
+            while waiting:
+                done = waiting.popleft()
+                yield done.key, done.image, done.finish(self.volume_postprocessing)
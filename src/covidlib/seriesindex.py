@@ -0,0 +1,207 @@
+"""Module to keep a persistent index of the ingested DICOM series.
+The index is a SQLite database keyed by SeriesInstanceUID: it is filled
+once when a series is ingested and queried by all the later stages."""
+
+import os
+import sqlite3
+from datetime import datetime
+
+import numpy as np
+from pydicom.dataset import Dataset
+
+from covidlib.ctlibrary import SERIES_TAGS, dcmtagreader, dcmtagreaderCTDI
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS series (
+    series_uid       TEXT PRIMARY KEY,
+    accession_number TEXT,
+    patient_id       TEXT,
+    study_uid        TEXT,
+    folder           TEXT UNIQUE,
+    header           TEXT,
+    ctdi             REAL,
+    ctdi_done        INTEGER NOT NULL DEFAULT 0,
+    ingested_at      TEXT,
+    analysed_at      TEXT
+);
+CREATE INDEX IF NOT EXISTS series_accession ON series (accession_number);
+"""
+
+# columns added after the first version of the schema: definition and
+# the statement filling them in the rows of an older index
+ADDED_COLUMNS = {
+    'ctdi_done': ('INTEGER NOT NULL DEFAULT 0',
+                  "UPDATE series SET ctdi_done = 1 WHERE ctdi IS NOT NULL"),
+}
+
+
+def _tag_value(header: Dataset, tag, default=None):
+    """Return the value of a tag as a string, or default if missing."""
+    try:
+        return str(header[tag].value)
+    except KeyError:
+        return default
+
+
+class SeriesIndex():
+    """Persistent index of the DICOM series seen by the pipeline."""
+
+    def __init__(self, db_path):
+        """Constructor for the SeriesIndex class.
+        The database is created if it does not exist.
+
+        :param db_path: path to the SQLite database file
+        """
+        self.db_path = db_path
+        db_dir = os.path.dirname(os.path.abspath(db_path))
+        if not os.path.isdir(db_dir):
+            os.makedirs(db_dir)
+
+        self.conn = sqlite3.connect(db_path, timeout=30)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.executescript(SCHEMA)
+        columns = {row['name'] for row in self.conn.execute("PRAGMA table_info(series)")}
+        with self.conn:
+            for name, (definition, fill) in ADDED_COLUMNS.items():
+                if name not in columns:
+                    self.conn.execute(f"ALTER TABLE series ADD COLUMN {name} {definition}")
+                    self.conn.execute(fill)
+
+    def register(self, folder, header=None):
+        """Add (or refresh) a series in the index.
+
+        :param folder: path to the directory containing the .dcm slices
+        :param header: pydicom Dataset with the series tags.
+            If None, it is read from the folder.
+        :return: the SeriesInstanceUID of the series
+        """
+        if header is None:
+            header = dcmtagreader(folder)
+
+        reduced = Dataset()
+        for tag in SERIES_TAGS:
+            if tag in header:
+                reduced.add(header[tag])
+
+        series_uid = _tag_value(reduced, (0x0020, 0x000e))
+        if series_uid is None:
+            series_uid = 'folder:' + os.path.abspath(folder)
+
+        folder = os.path.abspath(folder)
+        with self.conn:
+            # a folder reused by a new series belongs to the last one registered
+            self.conn.execute("UPDATE series SET folder = NULL WHERE folder = ? AND series_uid != ?",
+                (folder, series_uid))
+            # the stored CTDI and analysis date of a known series are kept
+            self.conn.execute(
+                "INSERT INTO series (series_uid, accession_number, patient_id, "
+                "study_uid, folder, header, ingested_at) VALUES (?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT(series_uid) DO UPDATE SET "
+                "accession_number = excluded.accession_number, patient_id = excluded.patient_id, "
+                "study_uid = excluded.study_uid, folder = excluded.folder, "
+                "header = excluded.header, ingested_at = excluded.ingested_at",
+                (series_uid,
+                 _tag_value(reduced, (0x0008, 0x0050)),
+                 _tag_value(reduced, (0x0010, 0x0020)),
+                 _tag_value(reduced, (0x0020, 0x000d)),
+                 folder,
+                 reduced.to_json(),
+                 datetime.now().strftime("%Y%m%d_%H%M%S")))
+        return series_uid
+
+    def _row(self, folder):
+        """Index row for a series folder, registering the series if needed."""
+        query = "SELECT * FROM series WHERE folder = ?"
+        row = self.conn.execute(query, (os.path.abspath(folder),)).fetchone()
+        if row is None:
+            self.register(folder)
+            row = self.conn.execute(query, (os.path.abspath(folder),)).fetchone()
+        return row
+
+    def header(self, folder):
+        """Series header of a folder, as a pydicom Dataset.
+
+        :param folder: path to the directory containing the .dcm slices
+        """
+        return Dataset.from_json(self._row(folder)['header'])
+
+    def ctdi(self, folder):
+        """Mean CTDIvol of a series. It is computed on first request and then stored,
+        also when the series has no CTDIvol (NULL ctdi, ctdi_done set).
+
+        :param folder: path to the directory containing the .dcm slices
+        :return: the mean CTDIvol, NaN if the slices have none
+        """
+        row = self._row(folder)
+        if row['ctdi_done']:
+            return np.nan if row['ctdi'] is None else row['ctdi']
+
+        ctdi_mean, _ = dcmtagreaderCTDI(folder)
+        with self.conn:
+            self.conn.execute("UPDATE series SET ctdi = ?, ctdi_done = 1 WHERE series_uid = ?",
+                (None if np.isnan(ctdi_mean) else float(ctdi_mean), row['series_uid']))
+        return ctdi_mean
+
+    def lookup(self, series_uid=None, accnumber=None):
+        """Find a series by SeriesInstanceUID or AccessionNumber.
+
+        :param series_uid: SeriesInstanceUID of the series
+        :param accnumber: AccessionNumber of the series
+        :return: list of matching rows, as dictionaries
+        """
+        if series_uid is not None:
+            rows = self.conn.execute("SELECT * FROM series WHERE series_uid = ?", (series_uid,))
+        elif accnumber is not None:
+            rows = self.conn.execute("SELECT * FROM series WHERE accession_number = ?",
+                (str(accnumber),))
+        else:
+            raise ValueError("Either series_uid or accnumber must be given")
+        return [dict(row) for row in rows.fetchall()]
+
+    def is_analysed(self, series_uid):
+        """Check if a series has already been analysed.
+
+        :param series_uid: SeriesInstanceUID of the series
+        """
+        row = self.conn.execute("SELECT analysed_at FROM series WHERE series_uid = ?",
+            (series_uid,)).fetchone()
+        return row is not None and row['analysed_at'] is not None
+
+    def mark_analysed(self, folder, ad):
+        """Record that the series in a folder has been analysed.
+        The series is identified by the SeriesInstanceUID of its headers,
+        so a folder that now holds another series does not mark the old one.
+
+        :param folder: path to the directory containing the .dcm slices
+        :param ad: Analysis date and time
+        """
+        series_uid = self.register(folder)
+        with self.conn:
+            self.conn.execute("UPDATE series SET analysed_at = ? WHERE series_uid = ?",
+                (ad, series_uid))
+
+    def close(self):
+        """Close the database connection."""
+        self.conn.close()
+
+
+def series_header(folder, index=None):
+    """Series header of a folder, taken from the index if available.
+
+    :param folder: path to the directory containing the .dcm slices
+    :param index: SeriesIndex instance or None
+    """
+    if index is not None:
+        return index.header(folder)
+    return dcmtagreader(folder)
+
+
+def series_ctdi(folder, index=None):
+    """Mean CTDIvol and header of a series, taken from the index if available.
+
+    :param folder: path to the directory containing the .dcm slices
+    :param index: SeriesIndex instance or None
+    """
+    if index is not None:
+        return index.ctdi(folder), index.header(folder)
+    return dcmtagreaderCTDI(folder)
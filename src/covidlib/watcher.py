@@ -11,6 +11,7 @@ import pyinotify
 MODEL = os.path.join(pathlib.Path(__file__).parent.absolute(), "model")
 OUTPUT = "/media/kobayashi/Archivio6T/CLEARLUNG/results"
 HISTORY = "/media/kobayashi/Archivio6T/CLEARLUNG/clearlung-history/"
+INDEX = "/media/kobayashi/Archivio6T/CLEARLUNG/clearlung-index.sqlite"
 
 class EventProcessor(pyinotify.ProcessEvent):
     """Helper to process notifying events"""
@@ -25,7 +26,8 @@ def process_generator(cls, method):
         if event.maskname=="IN_CREATE|IN_ISDIR":
             print(f"Starting pipeline for {event.pathname}")
             os.system(f"clearlung --single --automatic --base_dir {event.pathname} --target_dir CT " + \
-            		f"--model {MODEL} --subroi --output_dir {OUTPUT} --tag 0 --history_path {HISTORY}")
+            		f"--model {MODEL} --subroi --output_dir {OUTPUT} --tag 0 --history_path {HISTORY} " + \
+            		f"--index_path {INDEX} --skip_analysed")
 
     _method_name.__name__ = f"process_{method}"
     setattr(cls, _method_name.__name__, _method_name)
@@ -0,0 +1,57 @@
+"""Synthetic DICOM series for the tests."""
+
+import os
+
+from pydicom.dataset import FileMetaDataset, Dataset
+from pydicom.uid import ExplicitVRLittleEndian, generate_uid
+
+
+def write_series(folder, series_uid, accnumber):
+    """Write a one-slice DICOM series header in a folder,
+    overwriting the slice of a previous call in place."""
+    os.makedirs(folder, exist_ok=True)
+    meta = FileMetaDataset()
+    meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    meta.MediaStorageSOPClassUID = '1.2.840.10008.5.1.4.1.1.2'
+    meta.MediaStorageSOPInstanceUID = generate_uid()
+    ds = Dataset()
+    ds.file_meta = meta
+    ds.SOPInstanceUID = meta.MediaStorageSOPInstanceUID
+    ds.SeriesInstanceUID = series_uid
+    ds.AccessionNumber = accnumber
+    ds.Modality = 'CT'
+    ds.save_as(os.path.join(folder, 'slice.dcm'))
+
+
+def write_ct_series(folder, stored, slope=1, intercept=-1024):
+    """Write a CT series with pixel data, one file per slice.
+
+    :param stored: uint16 array (z, y, x) of stored pixel values
+    :param slope: RescaleSlope of every slice
+    :param intercept: RescaleIntercept of every slice
+    """
+    os.makedirs(folder, exist_ok=True)
+    series_uid = generate_uid()
+    for k, pixels in enumerate(stored):
+        meta = FileMetaDataset()
+        meta.TransferSyntaxUID = ExplicitVRLittleEndian
+        meta.MediaStorageSOPClassUID = '1.2.840.10008.5.1.4.1.1.2'
+        meta.MediaStorageSOPInstanceUID = generate_uid()
+        ds = Dataset()
+        ds.file_meta = meta
+        ds.SOPInstanceUID = meta.MediaStorageSOPInstanceUID
+        ds.SeriesInstanceUID = series_uid
+        ds.Modality = 'CT'
+        ds.ImagePositionPatient = [0., 0., float(k)]
+        ds.ImageOrientationPatient = [1., 0., 0., 0., 1., 0.]
+        ds.PixelSpacing = [0.8, 0.8]
+        ds.SliceThickness = 1.
+        ds.RescaleSlope = slope
+        ds.RescaleIntercept = intercept
+        ds.Rows, ds.Columns = pixels.shape
+        ds.SamplesPerPixel = 1
+        ds.PhotometricInterpretation = 'MONOCHROME2'
+        ds.BitsAllocated, ds.BitsStored, ds.HighBit = 16, 16, 15
+        ds.PixelRepresentation = 0
+        ds.PixelData = pixels.astype('<u2').tobytes()
+        ds.save_as(os.path.join(folder, f'slice{k:03d}.dcm'))
@@ -0,0 +1,21 @@
+"""Tests of the cached DICOM header readers."""
+
+import os
+
+from covidlib.ctlibrary import dcmtagreader
+
+from dicomseries import write_series
+
+
+def test_header_cache_sees_files_overwritten_in_place(tmp_path):
+    folder = str(tmp_path / 'CT')
+    write_series(folder, '1.2.3', 'A1')
+    assert dcmtagreader(folder).AccessionNumber == 'A1'
+    folder_mtime = os.stat(folder).st_mtime_ns
+
+    # a series re-sent with the same file names keeps the folder mtime
+    write_series(folder, '1.2.4', 'A2345')
+    assert os.stat(folder).st_mtime_ns == folder_mtime
+    header = dcmtagreader(folder)
+    assert header.AccessionNumber == 'A2345'
+    assert header.SeriesInstanceUID == '1.2.4'
@@ -0,0 +1,53 @@
+"""Tests of the csv files written by the radiomic feature extraction."""
+
+import os
+
+import numpy as np
+import pandas as pd
+import SimpleITK as sitk
+
+from covidlib.extract import FeaturesExtractor
+from dicomseries import write_series
+from test_roicache import phantom
+
+PARAMS = [1, -1020, 180, 25]
+
+
+def extractor(base_dir, output_dir, features=None):
+    return FeaturesExtractor(base_dir=base_dir, single_mode=True, output_dir=output_dir,
+        maskname='mask', ivd=1.4, tag='test', ford_p=PARAMS, glcm_p=PARAMS, glszm_p=PARAMS,
+        glrlm_p=PARAMS, ngtdm_p=PARAMS, gldm_p=PARAMS, shape3d_p=PARAMS, ad='20261018_120000',
+        features=features)
+
+
+def read(path):
+    with open(path, encoding='utf-8') as a_file:
+        return a_file.read()
+
+
+def test_model_only_run_does_not_append(tmp_path):
+    base_dir, output_dir = str(tmp_path / 'patient'), str(tmp_path / 'results')
+    os.makedirs(output_dir)
+    write_series(os.path.join(base_dir, 'CT'), '1.2.3', 'ACC1')
+    image, mask = phantom()
+    sitk.WriteImage(image, os.path.join(base_dir, 'CT_ISO_1.40.nii'))
+    sitk.WriteImage(mask == 1, os.path.join(base_dir, 'mask.nii'))
+
+    full = extractor(base_dir, output_dir).run()
+    total = os.path.join(output_dir, 'radiomic_total.csv')
+    append = os.path.join(output_dir, 'radiomic_features_append.csv')
+    before = read(total), read(append)
+    assert len(pd.read_csv(total, sep='\t')) == 1
+    assert any(name.startswith('GLCM') for name in pd.read_csv(total, sep='\t'))
+
+    model = ['Mean_5', 'Contrast_25']
+    model_df = extractor(base_dir, output_dir, features=model).run()
+    assert (read(total), read(append)) == before
+
+    # only the per-run file and the returned DataFrame get the NaN-padded row
+    features = pd.read_csv(os.path.join(output_dir, 'radiomic_features.csv'), sep='\t')
+    assert list(features) == list(full) == list(model_df)
+    assert len(features) == 1
+    for name in model:
+        np.testing.assert_allclose(features[name].astype(float), full[name].astype(float))
+    assert np.isnan(features['Contrast_5'][0])
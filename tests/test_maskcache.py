@@ -0,0 +1,29 @@
+"""Tests of the lung mask cache."""
+
+from importlib.metadata import PackageNotFoundError
+
+import pytest
+
+from covidlib import maskcache
+
+
+def test_unknown_lungmask_version_is_none(monkeypatch):
+    def not_found(name):
+        raise PackageNotFoundError(name)
+
+    monkeypatch.setattr(maskcache, 'version', not_found)
+    assert maskcache.lungmask_version() is None
+
+
+def test_lungmask_version(monkeypatch):
+    monkeypatch.setattr(maskcache, 'version', lambda name: '0.2.20')
+    assert maskcache.lungmask_version() == '0.2.20'
+
+
+def test_other_errors_are_not_hidden(monkeypatch):
+    def broken(name):
+        raise ValueError('broken metadata')
+
+    monkeypatch.setattr(maskcache, 'version', broken)
+    with pytest.raises(ValueError):
+        maskcache.lungmask_version()
@@ -0,0 +1,34 @@
+"""Tests of the in-process DICOM loader."""
+
+import numpy as np
+import SimpleITK as sitk
+
+from covidlib.niftiz import load_series
+
+from dicomseries import write_ct_series
+
+
+def stored_pixels():
+    """Stored values of a 3-slice series, covering the whole uint16 range."""
+    stored = np.random.default_rng(0).integers(0, 4096, (3, 8, 10)).astype(np.uint16)
+    stored[0, 0, 0], stored[2, 7, 9] = 0, 65535
+    return stored
+
+
+def test_integer_rescaling_stays_int16(tmp_path):
+    stored = np.random.default_rng(0).integers(0, 4096, (3, 8, 10)).astype(np.uint16)
+    write_ct_series(str(tmp_path), stored, slope=1, intercept=-1024)
+    image = load_series(str(tmp_path))
+    assert image.GetPixelID() == sitk.sitkInt16
+    # rows are stored bottom-up
+    np.testing.assert_array_equal(sitk.GetArrayFromImage(image), stored[:, ::-1].astype(np.int32) - 1024)
+
+
+def test_rescaling_out_of_int16_range_is_not_wrapped(tmp_path):
+    stored = stored_pixels()
+    write_ct_series(str(tmp_path), stored, slope=2, intercept=-1024)
+    image = load_series(str(tmp_path))
+    assert image.GetPixelID() == sitk.sitkFloat32
+    hu = sitk.GetArrayFromImage(image)
+    np.testing.assert_array_equal(hu, stored[:, ::-1].astype(np.float64) * 2 - 1024)
+    assert hu.max() == 2 * 65535 - 1024 and hu.min() == -1024
@@ -0,0 +1,84 @@
+"""Tests of the batched gaussian fit of the healthy lung peak against scipy curve_fit."""
+
+import numpy as np
+import pytest
+import scipy.signal
+from scipy.optimize import curve_fit
+
+from covidlib.qct import (FIT_BOUNDS, FIT_P0, FIT_RANGE, MU_RANGE, SIGMA_RANGE,
+    fit_healthy_peak, fit_healthy_peaks, gauss)
+
+BINS_MED = np.arange(-1020, 180, 5) + 2.5
+
+
+def reference_fit(counts, bins_med):
+    """Fit of one histogram with curve_fit, as before the batched solver."""
+    left_lim, right_lim = FIT_RANGE
+    x_range = [x for x in bins_med if left_lim < x < right_lim]
+    y_range = [y for x, y in zip(bins_med, counts) if left_lim < x < right_lim]
+    grads = np.gradient(scipy.signal.medfilt(y_range, kernel_size=7))
+    i_max = 0
+    for i in range(len(grads) - 1):
+        if grads[i] * grads[i + 1] <= 0:
+            i_max = i
+            break
+    x_tofit, y_tofit = x_range[:i_max + 7], y_range[:i_max + 7]
+
+    coeff, _ = curve_fit(gauss, x_tofit, y_tofit, p0=FIT_P0, maxfev=10000, bounds=FIT_BOUNDS)
+    if not (MU_RANGE[0] <= coeff[1] <= MU_RANGE[1] and SIGMA_RANGE[0] <= coeff[2] <= SIGMA_RANGE[1]):
+        return coeff, 'n.a.'
+    return coeff, np.round(np.sum(gauss(bins_med, *coeff)) / np.sum(counts), 3)
+
+
+def histogram(rng, peak, width, healthy=0.7, n_voxels=200000):
+    """Density histogram of a healthy peak over a broad component of denser tissue."""
+    n_peak = int(healthy * n_voxels)
+    values = np.concatenate([rng.normal(peak, width, n_peak),
+        rng.normal(-300, 250, n_voxels - n_peak)])
+    counts, _ = np.histogram(values, bins=240, range=(-1020, 180), density=True)
+    return counts
+
+
+@pytest.fixture
+def histograms():
+    rng = np.random.default_rng(0)
+    peaks = [(-860, 60), (-840, 80), (-820, 100), (-880, 50), (-800, 90), (-850, 70)]
+    # the healthy peak is below MU_RANGE: not an acceptable fit
+    peaks += [(-1000, 40), (-990, 35)]
+    return np.array([histogram(rng, peak, width) for peak, width in peaks])
+
+
+def test_fit_matches_curve_fit(histograms):
+    results = fit_healthy_peaks(histograms, BINS_MED)
+    assert len(results) == len(histograms)
+
+    waves = []
+    for counts, (coeff, x_tofit, wave) in zip(histograms, results):
+        ref_coeff, ref_wave = reference_fit(counts, BINS_MED)
+        waves.append(wave)
+        if ref_wave == 'n.a.':
+            assert wave == 'n.a.'
+            continue
+        np.testing.assert_allclose(coeff, ref_coeff, rtol=1e-3)
+        assert wave == pytest.approx(ref_wave, abs=1e-3)
+        assert x_tofit[0] > FIT_RANGE[0] and x_tofit[-1] < FIT_RANGE[1]
+
+    # both outcomes are covered
+    assert waves.count('n.a.') == 2
+    assert all(wave != 'n.a.' for wave in waves[:6])
+
+
+def test_single_fit_is_the_batched_one(histograms):
+    coeff, _, wave = fit_healthy_peak(histograms[0], BINS_MED)
+    batch_coeff, _, batch_wave = fit_healthy_peaks(histograms, BINS_MED)[0]
+    np.testing.assert_array_equal(coeff, batch_coeff)
+    assert wave == batch_wave
+
+
+def test_non_finite_histogram_is_not_fitted(histograms):
+    counts = histograms[:2].copy()
+    counts[1, 50] = np.nan
+    results = fit_healthy_peaks(counts, BINS_MED)
+    assert results[0][2] != 'n.a.'
+    assert results[1][2] == 'n.a.'
+    assert np.isnan(results[1][0]).all()
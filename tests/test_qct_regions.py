@@ -0,0 +1,78 @@
+"""Regression tests of the sub-ROI label map and of the QCT region histograms."""
+
+import numpy as np
+
+from covidlib.qct import HU_MIN, N_HU, REGIONS, region_histograms
+from covidlib.rescale import subroi_labels
+
+
+def lung_phantom():
+    """Box-shaped lung: slices 2-5, rows 1-4, columns 1-8 of a (8, 6, 10) volume."""
+    lung = np.zeros((8, 6, 10), dtype=bool)
+    lung[2:6, 1:5, 1:9] = True
+    return lung
+
+
+def test_subroi_labels():
+    lung = lung_phantom()
+    # the lungs of slice 4 only span rows 3-4, so its ventral/dorsal split moves
+    lung[4, 1:3] = False
+
+    expected = np.zeros(lung.shape, dtype=np.uint8)
+    # midpoint slice (2 + 5) // 2 = 3: slice 2 is lower, slices 3-5 upper
+    expected[2, 1:2, 1:9] = 11
+    expected[2, 2:5, 1:9] = 21
+    # midpoint row (1 + 4) // 2 = 2 in slices 3 and 5, (3 + 4) // 2 = 3 in slice 4
+    expected[[3, 5], 1:2, 1:9] = 22
+    expected[[3, 5], 2:5, 1:9] = 42
+    expected[4, 3:5, 1:9] = 42
+
+    labels = subroi_labels(lung)
+    assert labels.dtype == np.uint8
+    np.testing.assert_array_equal(labels, expected)
+
+
+def test_region_histograms():
+    lung = lung_phantom()
+    # HU grows along the columns, the top lung slice is below the histogram range
+    image = np.broadcast_to(-1000 + 10 * np.arange(10, dtype=np.int16), lung.shape).copy()
+    image[5] = -1030
+
+    left_right = np.zeros(lung.shape, dtype=np.uint8)
+    left_right[:, :, :5] = 10
+    left_right[:, :, 5:] = 20
+    masks = {
+        '': left_right * lung,
+        '_bilat': (10 * lung).astype(np.uint8),
+        '_mixed': subroi_labels(lung),
+    }
+
+    result = region_histograms(image, masks, list(REGIONS))
+    assert set(result) == set(REGIONS)
+
+    counts = {part: n_voxels for part, (_, n_voxels) in result.items()}
+    assert counts == {
+        'bilat': 128, 'right': 64, 'left': 64,
+        'lower': 32, 'upper': 96, 'dorsal': 32, 'ventral': 96,
+        'lower_dorsal': 8, 'lower_ventral': 24, 'upper_dorsal': 24, 'upper_ventral': 72,
+    }
+
+    hist, _ = result['right']
+    assert hist.shape == (N_HU,)
+    # columns 1-4, 3 slices in range, 4 rows
+    expected = np.zeros(N_HU, dtype=np.int64)
+    expected[[-990 - HU_MIN, -980 - HU_MIN, -970 - HU_MIN, -960 - HU_MIN]] = 12
+    np.testing.assert_array_equal(hist, expected)
+
+    hist, _ = result['upper_ventral']
+    expected = np.zeros(N_HU, dtype=np.int64)
+    expected[np.arange(-990, -910, 10) - HU_MIN] = 6
+    np.testing.assert_array_equal(hist, expected)
+
+    # every region against a direct count of its voxels
+    for part, (hist, n_voxels) in result.items():
+        suffix, labels = REGIONS[part]
+        hu = image[np.isin(masks[suffix], labels)]
+        assert n_voxels == hu.size
+        hu = hu[(hu >= HU_MIN) & (hu < HU_MIN + N_HU)]
+        np.testing.assert_array_equal(hist, np.bincount(hu - HU_MIN, minlength=N_HU))
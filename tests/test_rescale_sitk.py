@@ -0,0 +1,43 @@
+"""Tests of the SimpleITK ISO backend of Rescaler."""
+
+import os
+
+import numpy as np
+import SimpleITK as sitk
+
+from covidlib.rescale import Rescaler
+
+
+def test_run_iso_sitk_after_run_xmm(tmp_path):
+    base_dir = str(tmp_path)
+    ct = sitk.GetImageFromArray(
+        np.random.default_rng(0).integers(-1000, 200, (90, 64, 70)).astype(np.int16))
+    ct.SetSpacing((0.8, 0.8, 1.0))
+    sitk.WriteImage(ct, os.path.join(base_dir, 'CT.nii'))
+
+    rescaler = Rescaler(base_dir=base_dir, single_mode=True, iso_vox_dim=1.6, backend='sitk')
+    rescaler.run_xmm(3)
+
+    # the lungmask output lies on the 3 mm grid, without geometry
+    mask = np.zeros((30, 64, 70), np.uint8)
+    mask[5:25, 10:50, 5:30] = 1
+    mask[5:25, 10:50, 35:65] = 2
+    sitk.WriteImage(sitk.GetImageFromArray(mask), os.path.join(base_dir, 'mask_R231CW_3mm.nii'))
+    sitk.WriteImage(sitk.GetImageFromArray((mask > 0).astype(np.uint8)),
+        os.path.join(base_dir, 'mask_R231CW_3mm_bilat.nii'))
+
+    rescaler.run_iso()
+
+    iso_ct = sitk.ReadImage(os.path.join(base_dir, 'CT_ISO_1.60.nii'))
+    iso_mask = sitk.ReadImage(os.path.join(base_dir, 'mask_R231CW_ISO_1.60.nii'))
+    iso_bilat = sitk.ReadImage(os.path.join(base_dir, 'mask_R231CW_ISO_1.60_bilat.nii'))
+    assert iso_ct.GetSize() == (35, 32, 56)
+    assert iso_mask.GetSize() == iso_ct.GetSize()
+    assert iso_bilat.GetSize() == iso_ct.GetSize()
+
+    labels = sitk.GetArrayFromImage(iso_mask)
+    assert set(np.unique(labels)) == {0, 1, 2}
+    np.testing.assert_array_equal(sitk.GetArrayFromImage(iso_bilat), labels > 0)
+    # the lungs keep their physical volume: 20 slices of 3 mm, 40 x 25 + 40 x 30 voxels of 0.8 mm
+    expected = 60 * 0.64 * (40 * 25 + 40 * 30) / 1.6**3
+    assert abs(np.count_nonzero(labels) - expected) < 0.1 * expected
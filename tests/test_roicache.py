@@ -0,0 +1,109 @@
+"""Tests of the ROI cache shared by the radiomics feature classes."""
+
+import numpy as np
+import pytest
+import SimpleITK as sitk
+from radiomics import firstorder, glcm, gldm, glrlm, glszm, ngtdm, shape
+from scipy import ndimage
+
+from covidlib.extract import RoiCache, cache_supported
+
+JOBS = [(firstorder.RadiomicsFirstOrder,
+         dict(voxelArrayShift=0, resegmentRange=[-1020, 180], binWidth=5, binCount=240))]
+JOBS += [(glcm.RadiomicsGLCM, dict(resegmentRange=[-1020, 180], binWidth=b, binCount=1200 // b))
+         for b in (5, 25, 50)]
+JOBS += [(cls, dict(resegmentRange=['-1020', '180'], binWidth='25', binCount=48))
+         for cls in (glszm.RadiomicsGLSZM, glrlm.RadiomicsGLRLM, ngtdm.RadiomicsNGTDM,
+                     gldm.RadiomicsGLDM, shape.RadiomicsShape)]
+
+
+def phantom(seed=0, size=(24, 40, 44)):
+    """Smooth noise CT with an ellipsoidal lung, split in labels 1 and 2, and a margin."""
+    rng = np.random.default_rng(seed)
+    n_z, n_y, n_x = size
+    ct = (ndimage.gaussian_filter(rng.normal(0, 1, size), 1.5) * 1500 - 750).clip(-1024, 400)
+    z, y, x = np.ogrid[:n_z, :n_y, :n_x]
+    lung = ((z - n_z / 2) / (n_z * .4))**2 + ((y - n_y / 2) / (n_y * .35))**2 + \
+        ((x - n_x / 2) / (n_x * .4))**2 < 1
+    labels = lung.astype(np.uint8)
+    labels[lung & (x > n_x / 2)] = 2
+    image = sitk.GetImageFromArray(ct.astype(np.int16))
+    image.SetSpacing((1.4, 1.4, 1.4))
+    mask = sitk.GetImageFromArray(labels)
+    mask.CopyInformation(image)
+    return image, mask
+
+
+def assert_same_features(expected, actual):
+    assert list(expected) == list(actual)
+    for name in expected:
+        np.testing.assert_allclose(float(actual[name]), float(expected[name]), rtol=1e-9, err_msg=name)
+
+
+@pytest.mark.parametrize('label', [1, 2])
+def test_cache_on_matches_cache_off(label):
+    image, mask = phantom()
+    cached = RoiCache(image, mask, label=label, enabled=True)
+    stock = RoiCache(image, mask, label=label, enabled=False)
+    for feature_class, settings in JOBS:
+        reference = feature_class(image, mask, **dict(settings, label=label)).execute()
+        assert_same_features(reference, stock.features(feature_class, settings).execute())
+        assert_same_features(reference, cached.features(feature_class, settings).execute())
+    # the stock classes use no cached array
+    assert not stock.binned and not stock.glcms
+    assert cached.binned and cached.glcms
+
+
+def test_cache_supported_versions():
+    assert cache_supported('3.0.1')
+    assert cache_supported('v3.1.0')
+    assert not cache_supported('3.2.0')
+    assert not cache_supported('4.0')
+    assert not cache_supported('unknown')
+    assert RoiCache(*phantom()).enabled == cache_supported()
+
+
+def glcm_pair(image, mask, roi, settings):
+    """Stock and cached GLCM classes, executed, for the same settings."""
+    stock = glcm.RadiomicsGLCM(image, mask, **dict(settings, label=1))
+    cached = roi.features(glcm.RadiomicsGLCM, settings)
+    return (stock, stock.execute()), (cached, cached.execute())
+
+
+@pytest.mark.skipif(not cache_supported(), reason='GLCM derivation needs a checked pyradiomics version')
+def test_coarse_glcm_is_block_sum_of_fine():
+    image, mask = phantom(seed=1)
+    roi = RoiCache(image, mask)
+    widths = (5, 25, 50)
+    for bin_width in widths:
+        settings = dict(resegmentRange=[-1020, 180], binWidth=bin_width, binCount=1200 // bin_width)
+        (stock, expected), (cached, actual) = glcm_pair(image, mask, roi, settings)
+        np.testing.assert_allclose(cached.P_glcm, stock.P_glcm, rtol=1e-12, atol=1e-15)
+        assert_same_features(expected, actual)
+    # bin counts 48 and 24 are derived from 240
+    assert len(roi.nested) == len(widths) - 1 and all(roi.nested.values())
+    assert sorted(next(iter(roi.glcms.values()))) == [240]
+
+
+@pytest.mark.skipif(not cache_supported(), reason='GLCM derivation needs a checked pyradiomics version')
+def test_non_nested_bins_fall_back():
+    # on [0, 1] the 10th edge of 30 bins is 0.3, the 4th of 10 bins 0.30000000000000004:
+    # the voxels at 0.3 fall in fine bin 10 but in coarse bin 3
+    image, mask = phantom(seed=2)
+    values = np.round(np.random.default_rng(2).uniform(0, 1, image.GetSize()[::-1]), 1)
+    lung = sitk.GetArrayViewFromImage(mask) == 1
+    values[tuple(np.argwhere(lung)[:3].T)] = 0., 1., .3
+    float_image = sitk.GetImageFromArray(values)
+    float_image.CopyInformation(image)
+
+    roi = RoiCache(float_image, mask)
+    fine, coarse = {'binCount': 30}, {'binCount': 10}
+    glcm_pair(float_image, mask, roi, fine)
+    assert not roi.is_nested(fine, coarse, 3)
+    assert roi.coarse_glcm(coarse, roi.discretized(coarse)[1]) is None
+
+    (stock, expected), (cached, actual) = glcm_pair(float_image, mask, roi, coarse)
+    np.testing.assert_allclose(cached.P_glcm, stock.P_glcm, rtol=1e-12, atol=1e-15)
+    assert_same_features(expected, actual)
+    # bin counts which do not divide the finer one are computed directly
+    assert roi.coarse_glcm({'binCount': 7}, roi.discretized({'binCount': 7})[1]) is None
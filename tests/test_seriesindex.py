@@ -0,0 +1,89 @@
+"""Tests of the persistent series index."""
+
+import os
+import sqlite3
+
+import numpy as np
+
+from covidlib import seriesindex
+from covidlib.seriesindex import SeriesIndex
+
+from dicomseries import write_series
+
+
+def test_register_keeps_ctdi_and_analysis(tmp_path):
+    folder = str(tmp_path / 'p1' / 'CT')
+    write_series(folder, '1.2.3', 'A1')
+    index = SeriesIndex(str(tmp_path / 'index.sqlite'))
+    try:
+        assert index.register(folder) == '1.2.3'
+        with index.conn:
+            index.conn.execute("UPDATE series SET ctdi = 7.5 WHERE series_uid = '1.2.3'")
+        index.mark_analysed(folder, '20240101_120000')
+
+        index.register(folder)
+        row = index.lookup(series_uid='1.2.3')[0]
+        assert row['ctdi'] == 7.5
+        assert row['analysed_at'] == '20240101_120000'
+    finally:
+        index.close()
+
+
+def test_analysed_is_keyed_on_the_series(tmp_path):
+    folder = str(tmp_path / 'p1' / 'CT')
+    write_series(folder, '1.2.3', 'A1')
+    index = SeriesIndex(str(tmp_path / 'index.sqlite'))
+    try:
+        index.mark_analysed(folder, '20240101_120000')
+
+        # a new study under the same folder name is not analysed
+        write_series(folder, '1.2.4', 'A2')
+        assert not index.is_analysed(index.register(folder))
+        assert index.is_analysed('1.2.3')
+
+        # the old series re-sent into a new folder is
+        moved = str(tmp_path / 'p2' / 'CT')
+        write_series(moved, '1.2.3', 'A1')
+        assert index.is_analysed(index.register(moved))
+        assert index.lookup(series_uid='1.2.3')[0]['folder'] == os.path.abspath(moved)
+    finally:
+        index.close()
+
+
+def test_missing_ctdi_is_computed_once(tmp_path, monkeypatch):
+    folder = str(tmp_path / 'p1' / 'CT')
+    write_series(folder, '1.2.3', 'A1')
+    calls = []
+
+    def no_ctdi(path):
+        calls.append(path)
+        return np.nan, None
+
+    monkeypatch.setattr(seriesindex, 'dcmtagreaderCTDI', no_ctdi)
+    index = SeriesIndex(str(tmp_path / 'index.sqlite'))
+    try:
+        assert np.isnan(index.ctdi(folder))
+        assert np.isnan(index.ctdi(folder))
+        assert len(calls) == 1
+        row = index.lookup(series_uid='1.2.3')[0]
+        assert row['ctdi'] is None and row['ctdi_done'] == 1
+    finally:
+        index.close()
+
+
+def test_older_index_gets_the_ctdi_flag(tmp_path):
+    db_path = str(tmp_path / 'index.sqlite')
+    conn = sqlite3.connect(db_path)
+    conn.execute("CREATE TABLE series (series_uid TEXT PRIMARY KEY, accession_number TEXT, "
+        "patient_id TEXT, study_uid TEXT, folder TEXT UNIQUE, header TEXT, ctdi REAL, "
+        "ingested_at TEXT, analysed_at TEXT)")
+    conn.execute("INSERT INTO series (series_uid, ctdi) VALUES ('1.2.3', 7.5), ('1.2.4', NULL)")
+    conn.commit()
+    conn.close()
+
+    index = SeriesIndex(db_path)
+    try:
+        assert index.lookup(series_uid='1.2.3')[0]['ctdi_done'] == 1
+        assert index.lookup(series_uid='1.2.4')[0]['ctdi_done'] == 0
+    finally:
+        index.close()